@@ -0,0 +1,576 @@
+# SPDX-FileCopyrightText: Magenta ApS
+#
+# SPDX-License-Identifier: MPL-2.0
+
+import asyncio
+import queue
+import threading
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple, Type
+
+import pika
+from pika.adapters.asyncio_connection import AsyncioConnection
+from pika.exceptions import (
+    AMQPChannelError,
+    AMQPConnectionError,
+    NackError,
+    ProbableAuthenticationError,
+    StreamLostError,
+)
+from structlog import get_logger
+
+from app.config import Settings
+
+# Errors after which the connection is torn down and re-established
+RECONNECT_ERRORS = (AMQPConnectionError, AMQPChannelError, StreamLostError)
+
+EXCHANGE_NAME = "org-struktur-changes-topic"
+
+
+class PublisherStats:
+    """Counters describing the health of an AMQP publisher."""
+
+    def __init__(self):
+        self.publishes = 0
+        self.publish_failures = 0
+        self.connects = 0
+        self.reconnects = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.latency_last = 0.0
+
+    def record_publish(self, latency: float) -> None:
+        self.publishes += 1
+        self.latency_total += latency
+        self.latency_last = latency
+        self.latency_max = max(self.latency_max, latency)
+
+    def as_dict(self) -> Dict[str, Any]:
+        latency_avg = self.latency_total / self.publishes if self.publishes else 0.0
+        return {
+            "publishes": self.publishes,
+            "publish_failures": self.publish_failures,
+            "connects": self.connects,
+            "reconnects": self.reconnects,
+            "publish_latency_last": self.latency_last,
+            "publish_latency_avg": latency_avg,
+            "publish_latency_max": self.latency_max,
+        }
+
+
+class AMQPPublisher(ABC):
+    """Long-lived publisher for the SD-Mox AMQP exchange.
+
+    A single connection is kept open for the lifetime of the process, and a
+    small pool of channels (each with its own exclusive reply queue) is
+    reused across publishes. Broken connections are re-established with
+    exponential backoff.
+    """
+
+    def __init__(self, settings: Settings, exchange_name: str = EXCHANGE_NAME):
+        self.settings = settings
+        self.exchange_name = exchange_name
+        self.stats = PublisherStats()
+
+    def _parameters(self) -> pika.ConnectionParameters:
+        credentials = pika.PlainCredentials(
+            self.settings.amqp_username, self.settings.amqp_password
+        )
+        return pika.ConnectionParameters(
+            host=self.settings.amqp_host,
+            port=self.settings.amqp_port,
+            virtual_host=self.settings.amqp_virtual_host,
+            credentials=credentials,
+            heartbeat=self.settings.amqp_heartbeat,
+            blocked_connection_timeout=self.settings.amqp_blocked_timeout,
+        )
+
+    def _on_response(self, ch, method, props, body):
+        # We never expect a result from SD!
+        logger = get_logger()
+        logger.error("Uventet svar fra SD AMQP", body=body)
+
+    def _record_publish(self, start: float) -> None:
+        latency = time.monotonic() - start
+        self.stats.record_publish(latency)
+        get_logger().info("Published to SD-Mox AMQP", latency=latency)
+
+    @abstractmethod
+    async def publish(self, body: str) -> None:
+        """Publish a payload to the SD-Mox exchange.
+
+        The publish is retried once on a fresh connection, if the existing
+        connection turns out to be broken.
+
+        Args:
+            body: The XML payload to be published.
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    async def close(self) -> None:
+        """Close the connection and all pooled channels."""
+        raise NotImplementedError()
+
+
+class BlockingAMQPPublisher(AMQPPublisher):
+    """AMQP publisher using pika's BlockingConnection.
+
+    The connection is only used from a single worker thread, so publishing,
+    and connecting with backoff, never block the event loop. Publishes are
+    sent one at a time. While idle, heartbeats are serviced every
+    heartbeat_interval seconds, so the broker keeps the connection open.
+    """
+
+    def __init__(self, settings: Settings, exchange_name: str = EXCHANGE_NAME):
+        super().__init__(settings, exchange_name)
+        self._lock = threading.RLock()
+        self._connection: Optional[pika.BlockingConnection] = None
+        self._channels: "queue.LifoQueue[Tuple[Any, str]]" = queue.LifoQueue()
+        self._worker: Optional[ThreadPoolExecutor] = None
+        self.heartbeat_interval = settings.amqp_heartbeat / 2
+        self._heartbeats: Optional[threading.Thread] = None
+        self._stop_heartbeats = threading.Event()
+
+    def _get_worker(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._worker is None:
+                self._worker = ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix="sdmox-amqp"
+                )
+            return self._worker
+
+    def _start_heartbeats(self) -> None:
+        """Service heartbeats on the worker thread until the publisher closes."""
+
+        def run() -> None:
+            while not self._stop_heartbeats.wait(self.heartbeat_interval):
+                try:
+                    self._get_worker().submit(self._service_heartbeats)
+                except RuntimeError:
+                    # The worker was shut down by close
+                    return
+
+        if self._heartbeats is None:
+            self._stop_heartbeats.clear()
+            self._heartbeats = threading.Thread(
+                target=run, name="sdmox-amqp-heartbeats", daemon=True
+            )
+            self._heartbeats.start()
+
+    def _service_heartbeats(self) -> None:
+        with self._lock:
+            connection = self._connection
+            if connection is None or not connection.is_open:
+                return
+            try:
+                connection.process_data_events(time_limit=0)
+            except RECONNECT_ERRORS:
+                # The next publish connects again
+                get_logger().warning("SD-Mox AMQP connection lost while idle")
+                self._discard_connection()
+
+    def _connect(self) -> pika.BlockingConnection:
+        """Establish a connection to the AMQP broker, retrying with backoff."""
+        logger = get_logger()
+        delay = self.settings.amqp_reconnect_delay
+        attempt = 1
+        while True:
+            try:
+                logger.info("Establishing connection to SD-Mox AMQP", attempt=attempt)
+                connection = pika.BlockingConnection(self._parameters())
+                self.stats.connects += 1
+                self._start_heartbeats()
+                return connection
+            except ProbableAuthenticationError:
+                # Retrying will not fix misconfigured credentials
+                raise
+            except AMQPConnectionError:
+                if attempt >= self.settings.amqp_reconnect_attempts:
+                    raise
+                logger.warning("SD-Mox AMQP connection failed", retry_in=delay)
+                time.sleep(delay)
+                delay = min(delay * 2, self.settings.amqp_reconnect_max_delay)
+                attempt += 1
+
+    def _ensure_connection(self) -> pika.BlockingConnection:
+        if self._connection is None or self._connection.is_closed:
+            self._discard_connection()
+            self._connection = self._connect()
+        return self._connection
+
+    def _discard_connection(self) -> None:
+        """Drop the current connection and all channels opened on it."""
+        self._channels = queue.LifoQueue()
+        connection, self._connection = self._connection, None
+        if connection is not None and connection.is_open:
+            try:
+                connection.close()
+            except Exception:  # pragma: no cover
+                get_logger().warning("Unable to close SD-Mox AMQP connection")
+
+    def _open_channel(self) -> Tuple[Any, str]:
+        connection = self._ensure_connection()
+        channel = connection.channel()
+        result = channel.queue_declare("", exclusive=True)
+        callback_queue = result.method.queue
+        channel.basic_consume(
+            queue=callback_queue,
+            on_message_callback=self._on_response,
+        )
+        return channel, callback_queue
+
+    def _acquire_channel(self) -> Tuple[Any, str]:
+        try:
+            channel, callback_queue = self._channels.get_nowait()
+        except queue.Empty:
+            return self._open_channel()
+        if channel.is_closed:
+            return self._open_channel()
+        return channel, callback_queue
+
+    def _release_channel(self, channel: Any, callback_queue: str) -> None:
+        if (
+            channel.is_open
+            and self._channels.qsize() < self.settings.amqp_channel_pool_size
+        ):
+            self._channels.put_nowait((channel, callback_queue))
+        elif channel.is_open:
+            channel.close()
+
+    def _publish_once(self, body: str) -> None:
+        connection = self._ensure_connection()
+        # Service heartbeats and detect connections dropped while idle
+        connection.process_data_events(time_limit=0)
+        channel, callback_queue = self._acquire_channel()
+        channel.basic_publish(
+            exchange=self.exchange_name,
+            routing_key="#",
+            properties=pika.BasicProperties(reply_to=callback_queue),
+            body=body,
+        )
+        self._release_channel(channel, callback_queue)
+
+    def publish_blocking(self, body: str) -> None:
+        """Publish a payload to the SD-Mox exchange, blocking until sent."""
+        logger = get_logger()
+        start = time.monotonic()
+        with self._lock:
+            try:
+                try:
+                    self._publish_once(body)
+                except RECONNECT_ERRORS:
+                    logger.warning("SD-Mox AMQP connection lost, reconnecting")
+                    self._discard_connection()
+                    self.stats.reconnects += 1
+                    self._publish_once(body)
+            except Exception:
+                self.stats.publish_failures += 1
+                raise
+        self._record_publish(start)
+
+    async def publish(self, body: str) -> None:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._get_worker(), self.publish_blocking, body)
+
+    async def close(self) -> None:
+        self._stop_heartbeats.set()
+        heartbeats, self._heartbeats = self._heartbeats, None
+        if heartbeats is not None:
+            await asyncio.to_thread(heartbeats.join)
+        with self._lock:
+            worker, self._worker = self._worker, None
+        if worker is not None:
+            await asyncio.get_running_loop().run_in_executor(
+                worker, self._discard_connection
+            )
+            worker.shutdown(wait=False)
+        else:
+            with self._lock:
+                self._discard_connection()
+
+
+class _ConfirmChannel:
+    """A channel in confirm mode, tracking unconfirmed deliveries."""
+
+    def __init__(self, channel: Any, callback_queue: str):
+        self.channel = channel
+        self.callback_queue = callback_queue
+        self.delivery_tag = 0
+        self.pending: Dict[int, asyncio.Future] = {}
+
+    @property
+    def is_open(self) -> bool:
+        return self.channel.is_open
+
+    def publish(self, exchange: str, body: str) -> asyncio.Future:
+        """Publish body, returning a future resolved when the broker confirms."""
+        future = asyncio.get_running_loop().create_future()
+        self.channel.basic_publish(
+            exchange=exchange,
+            routing_key="#",
+            properties=pika.BasicProperties(reply_to=self.callback_queue),
+            body=body,
+        )
+        self.delivery_tag += 1
+        self.pending[self.delivery_tag] = future
+        return future
+
+    def on_delivery_confirmation(self, frame: Any) -> None:
+        method = frame.method
+        if method.multiple:
+            tags = [tag for tag in self.pending if tag <= method.delivery_tag]
+        else:
+            tags = [method.delivery_tag]
+        for tag in tags:
+            future = self.pending.pop(tag, None)
+            if future is None or future.done():
+                continue
+            if isinstance(method, pika.spec.Basic.Ack):
+                future.set_result(None)
+            else:
+                future.set_exception(NackError([]))
+
+    def fail_pending(self, exc: BaseException) -> None:
+        pending, self.pending = self.pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(exc)
+
+
+class AsyncioAMQPPublisher(AMQPPublisher):
+    """AMQP publisher using pika's asyncio adapter.
+
+    Publishes never block the event loop. Channels are put in confirm mode,
+    and publish waits (asynchronously) for the broker to confirm the message.
+    """
+
+    def __init__(
+        self,
+        settings: Settings,
+        exchange_name: str = EXCHANGE_NAME,
+        connection_factory: Callable[..., Any] = AsyncioConnection,
+    ):
+        super().__init__(settings, exchange_name)
+        self.connection_factory = connection_factory
+        self._lock: Optional[asyncio.Lock] = None
+        self._connection: Any = None
+        self._channels: List[_ConfirmChannel] = []
+        self._next_channel = 0
+
+    @staticmethod
+    async def _wait_for_callback(start: Callable[[Callable], None]) -> Any:
+        """Run start with a callback, and wait for the callback to be called."""
+        future = asyncio.get_running_loop().create_future()
+
+        def callback(result: Any) -> None:
+            if not future.done():
+                future.set_result(result)
+
+        start(callback)
+        return await future
+
+    async def _open_connection(self) -> Any:
+        opened = asyncio.get_running_loop().create_future()
+
+        def on_open(connection: Any) -> None:
+            if not opened.done():
+                opened.set_result(connection)
+
+        def on_open_error(connection: Any, exc: Any) -> None:
+            if not isinstance(exc, BaseException):
+                exc = AMQPConnectionError(exc)
+            if not opened.done():
+                opened.set_exception(exc)
+
+        self.connection_factory(
+            parameters=self._parameters(),
+            on_open_callback=on_open,
+            on_open_error_callback=on_open_error,
+            on_close_callback=self._on_connection_closed,
+            custom_ioloop=asyncio.get_running_loop(),
+        )
+        return await opened
+
+    async def _connect(self) -> Any:
+        """Establish a connection to the AMQP broker, retrying with backoff."""
+        logger = get_logger()
+        delay = self.settings.amqp_reconnect_delay
+        attempt = 1
+        while True:
+            try:
+                logger.info("Establishing connection to SD-Mox AMQP", attempt=attempt)
+                connection = await asyncio.wait_for(
+                    self._open_connection(), self.settings.amqp_publish_timeout
+                )
+                self.stats.connects += 1
+                return connection
+            except ProbableAuthenticationError:
+                # Retrying will not fix misconfigured credentials
+                raise
+            except (AMQPConnectionError, asyncio.TimeoutError):
+                if attempt >= self.settings.amqp_reconnect_attempts:
+                    raise
+                logger.warning("SD-Mox AMQP connection failed", retry_in=delay)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.settings.amqp_reconnect_max_delay)
+                attempt += 1
+
+    async def _open_channel(self, connection: Any) -> _ConfirmChannel:
+        channel = await self._wait_for_callback(
+            lambda callback: connection.channel(on_open_callback=callback)
+        )
+        frame = await self._wait_for_callback(
+            lambda callback: channel.queue_declare(
+                "", exclusive=True, callback=callback
+            )
+        )
+        confirm_channel = _ConfirmChannel(channel, frame.method.queue)
+        channel.add_on_close_callback(
+            lambda channel, exc: confirm_channel.fail_pending(AMQPChannelError(exc))
+        )
+        channel.basic_consume(
+            queue=confirm_channel.callback_queue,
+            on_message_callback=self._on_response,
+        )
+        await self._wait_for_callback(
+            lambda callback: channel.confirm_delivery(
+                ack_nack_callback=confirm_channel.on_delivery_confirmation,
+                callback=callback,
+            )
+        )
+        return confirm_channel
+
+    def _ready(self) -> bool:
+        return (
+            self._connection is not None
+            and self._connection.is_open
+            and len(self._channels) == self.settings.amqp_channel_pool_size
+            and all(channel.is_open for channel in self._channels)
+        )
+
+    async def _ensure_channels(self) -> List[_ConfirmChannel]:
+        if self._ready():
+            return self._channels
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self._connection is None or not self._connection.is_open:
+                self._channels = []
+                self._connection = await self._connect()
+            self._channels = [channel for channel in self._channels if channel.is_open]
+            while len(self._channels) < self.settings.amqp_channel_pool_size:
+                channel = await asyncio.wait_for(
+                    self._open_channel(self._connection),
+                    self.settings.amqp_publish_timeout,
+                )
+                self._channels.append(channel)
+        return self._channels
+
+    def _on_connection_closed(self, connection: Any, exc: Any) -> None:
+        if connection is not self._connection:
+            return
+        get_logger().warning("SD-Mox AMQP connection closed", reason=str(exc))
+        self._discard_connection(AMQPConnectionError(exc))
+
+    def _discard_connection(self, exc: BaseException) -> None:
+        """Drop the current connection, failing all unconfirmed publishes."""
+        channels, self._channels = self._channels, []
+        for channel in channels:
+            channel.fail_pending(exc)
+        connection, self._connection = self._connection, None
+        if connection is not None and connection.is_open:
+            connection.close()
+
+    async def _publish_once(self, body: str) -> None:
+        channels = await self._ensure_channels()
+        channel = channels[self._next_channel % len(channels)]
+        self._next_channel += 1
+        confirmation = channel.publish(self.exchange_name, body)
+        await asyncio.wait_for(confirmation, self.settings.amqp_publish_timeout)
+
+    async def publish(self, body: str) -> None:
+        logger = get_logger()
+        start = time.monotonic()
+        try:
+            await self._publish_once(body)
+        except RECONNECT_ERRORS as exc:
+            logger.warning("SD-Mox AMQP connection lost, reconnecting")
+            self._discard_connection(exc)
+            self.stats.reconnects += 1
+            try:
+                await self._publish_once(body)
+            except BaseException:
+                self.stats.publish_failures += 1
+                raise
+        except BaseException:
+            self.stats.publish_failures += 1
+            raise
+        self._record_publish(start)
+
+    async def close(self) -> None:
+        self._discard_connection(AMQPConnectionError("Publisher closed"))
+
+
+PUBLISHER_CLASSES: Dict[str, Type[AMQPPublisher]] = {
+    "blocking": BlockingAMQPPublisher,
+    "asyncio": AsyncioAMQPPublisher,
+}
+
+_publishers: Dict[Tuple, AMQPPublisher] = {}
+_publishers_lock = threading.Lock()
+
+
+def _publisher_key(settings: Settings) -> Tuple:
+    # Every setting a publisher is built from, changing any gives a new one
+    return (
+        settings.amqp_publisher,
+        settings.amqp_host,
+        settings.amqp_port,
+        settings.amqp_virtual_host,
+        settings.amqp_username,
+        settings.amqp_password,
+        settings.amqp_heartbeat,
+        settings.amqp_blocked_timeout,
+        settings.amqp_publish_timeout,
+        settings.amqp_channel_pool_size,
+        settings.amqp_reconnect_attempts,
+        settings.amqp_reconnect_delay,
+        settings.amqp_reconnect_max_delay,
+    )
+
+
+def get_amqp_publisher(settings: Settings) -> AMQPPublisher:
+    """Return the process-wide publisher for the broker configured in settings."""
+    key = _publisher_key(settings)
+    with _publishers_lock:
+        if key not in _publishers:
+            publisher_class = PUBLISHER_CLASSES[settings.amqp_publisher]
+            _publishers[key] = publisher_class(settings)
+        return _publishers[key]
+
+
+def get_amqp_stats() -> Dict[str, Dict[str, Any]]:
+    """Return statistics for every publisher created in this process."""
+    return {
+        f"{kind} {host}:{port}/{vhost}": publisher.stats.as_dict()
+        for (kind, host, port, vhost, *_), publisher in _publishers.items()
+    }
+
+
+async def close_amqp_publishers(keep: Optional[Settings] = None) -> None:
+    """Close all publishers, used on application shutdown.
+
+    With keep, the publisher for the settings keep is left open.
+    """
+    with _publishers_lock:
+        kept = _publisher_key(keep) if keep is not None else None
+        publishers = [
+            publisher for key, publisher in _publishers.items() if key != kept
+        ]
+        for key in [key for key in _publishers if key != kept]:
+            del _publishers[key]
+    for publisher in publishers:
+        await publisher.close()
@@ -0,0 +1,150 @@
+# SPDX-FileCopyrightText: Magenta ApS
+#
+# SPDX-License-Identifier: MPL-2.0
+
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Generic, Hashable, Optional
+from typing import OrderedDict as OrderedDictType
+from typing import Tuple, TypeVar
+
+from structlog import get_logger
+
+from app import deadline
+
+KeyType = TypeVar("KeyType", bound=Hashable)
+ValueType = TypeVar("ValueType")
+
+
+class AsyncTTLCache(Generic[KeyType, ValueType]):
+    """Asynchronous cache with time-to-live and stale-while-revalidate.
+
+    Entries younger than ttl are served directly from the cache. Entries
+    older than ttl, but younger than ttl + stale_ttl, are served while a
+    background task refreshes them. Older entries are loaded again before
+    being returned.
+
+    Concurrent loads of the same key share a single call to the loader. The
+    loader runs without a deadline, see app.deadline, and each caller waits
+    for it under its own.
+    With max_size, the least recently used entries are evicted beyond it.
+    Every value the loader returns is cached, including None.
+
+    Example:
+
+        async def load(key):
+            return await expensive_lookup(key)
+
+        cache = AsyncTTLCache(load, ttl=60, stale_ttl=600)
+        value = await cache.get("key")
+    """
+
+    def __init__(
+        self,
+        loader: Callable[[KeyType], Awaitable[ValueType]],
+        ttl: float,
+        stale_ttl: float = 0,
+        clock: Callable[[], float] = time.monotonic,
+        max_size: Optional[int] = None,
+    ):
+        self.loader = loader
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.clock = clock
+        self.max_size = max_size
+
+        self._entries: OrderedDictType[KeyType, Tuple[float, ValueType]] = OrderedDict()
+        self._inflight: Dict[KeyType, "asyncio.Task[ValueType]"] = {}
+
+    async def get(self, key: KeyType) -> ValueType:
+        """Return the value for key, loading it if missing or expired."""
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            loaded_at, value = entry
+            age = self.clock() - loaded_at
+            if age < self.ttl:
+                return value
+            if age < self.ttl + self.stale_ttl:
+                self.refresh(key)
+                return value
+        # Giving up on a shared load must not cancel it for other callers
+        return await deadline.wait_for(
+            asyncio.shield(self._load(key)), operation="cache load"
+        )
+
+    def peek(self, key: KeyType) -> Optional[ValueType]:
+        """Return the cached value for key regardless of age, or None."""
+        entry = self._entries.get(key)
+        return entry[1] if entry is not None else None
+
+    def put(self, key: KeyType, value: ValueType, age: float = 0) -> None:
+        """Store value for key, superseding any load of key in flight.
+
+        age is how many seconds old value already is.
+        """
+        self._inflight.pop(key, None)
+        self._store(key, value, age)
+
+    def invalidate(self, key: Optional[KeyType] = None) -> None:
+        """Forget key, or everything if no key is given.
+
+        Loads already in flight are left to finish, but their results are
+        not stored.
+        """
+        if key is None:
+            self._entries.clear()
+            self._inflight.clear()
+            return
+        self._entries.pop(key, None)
+        self._inflight.pop(key, None)
+
+    def invalidate_where(self, predicate: Callable[[KeyType], bool]) -> None:
+        """Forget every key for which predicate is true."""
+        for key in [key for key in self._entries if predicate(key)]:
+            del self._entries[key]
+        for key in [key for key in self._inflight if predicate(key)]:
+            del self._inflight[key]
+
+    def _load(self, key: KeyType) -> "asyncio.Task[ValueType]":
+        """Start loading key, unless a load of key is already in flight."""
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.get_running_loop().create_task(
+                self._run_loader(key), context=deadline.without_deadline()
+            )
+            self._inflight[key] = task
+            task.add_done_callback(lambda task: self._forget_task(key, task))
+        return task
+
+    async def _run_loader(self, key: KeyType) -> ValueType:
+        value = await self.loader(key)
+        # Only store the value if the key was not invalidated while loading
+        if self._inflight.get(key) is asyncio.current_task():
+            self._store(key, value)
+        return value
+
+    def _store(self, key: KeyType, value: ValueType, age: float = 0) -> None:
+        self._entries[key] = (self.clock() - age, value)
+        self._entries.move_to_end(key)
+        if self.max_size is not None and len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def _forget_task(self, key: KeyType, task: "asyncio.Task[ValueType]") -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+
+    def refresh(self, key: KeyType) -> None:
+        """Refresh key in the background, keeping the stale value on errors."""
+
+        def log_failure(task: "asyncio.Task[ValueType]") -> None:
+            if not task.cancelled() and task.exception() is not None:
+                get_logger().warning(
+                    "Background cache refresh failed",
+                    key=key,
+                    error=str(task.exception()),
+                )
+
+        if key not in self._inflight:
+            self._load(key).add_done_callback(log_failure)
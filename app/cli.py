@@ -10,6 +10,7 @@ import json
 
 import click
 
+from app.dar_index import build_index, read_export
 from app.sd_mox import SDMox
 from app.util import async_to_sync, first_of_month
 
@@ -24,25 +25,25 @@ clickDate = click.DateTime(formats=["%Y-%m-%d"])
     help="TODO",
     show_default=True,
 )
-@click.option("--to-date", type=clickDate, help="TODO")
 @click.option("--overrides", multiple=True)
 @click.pass_context
-def sd_mox_cli(ctx, from_date, to_date, overrides):
+def sd_mox_cli(ctx, from_date, overrides):
     """Tool to make changes in SD."""
 
     from_date = from_date.date()
-    to_date = to_date.date() if to_date else None
-    if to_date and from_date > to_date:
-        raise click.ClickException("from_date must be smaller than to_date")
 
     overrides = dict(override.split("=") for override in overrides)
 
-    sdmox = SDMox(from_date, to_date, overrides=overrides)
-
     ctx.ensure_object(dict)
-    ctx.obj["sdmox"] = sdmox
+    ctx.obj["overrides"] = overrides
     ctx.obj["from_date"] = from_date
-    ctx.obj["to_date"] = to_date
+
+
+def get_cli_sdmox(ctx) -> SDMox:
+    """Construct SDMox on first use, commands not talking to SD do not need it."""
+    if "sdmox" not in ctx.obj:
+        ctx.obj["sdmox"] = SDMox(overrides=ctx.obj["overrides"])
+    return ctx.obj["sdmox"]
 
 
 @sd_mox_cli.command()
@@ -52,10 +53,11 @@ def sd_mox_cli(ctx, from_date, to_date, overrides):
 @click.option("--unit-name")
 @async_to_sync
 async def check_name(ctx, unit_uuid, print_department, unit_name):
-    mox = ctx.obj["sdmox"]
+    mox = get_cli_sdmox(ctx)
 
     unit_uuid = str(unit_uuid)
     department, errors = await mox._check_department(
+        ctx.obj["from_date"],
         unit_uuid=unit_uuid,
         unit_name=unit_name,
     )
@@ -77,11 +79,30 @@ async def check_name(ctx, unit_uuid, print_department, unit_name):
 async def set_name(ctx, unit_uuid, new_unit_name, dry_run):
     unit_uuid = str(unit_uuid)
 
-    mox = ctx.obj["sdmox"]
+    mox = get_cli_sdmox(ctx)
     await mox.rename_unit(
         unit_uuid, new_unit_name, at=ctx.obj["from_date"], dry_run=dry_run
     )
 
 
+@sd_mox_cli.command()
+@click.option(
+    "--export",
+    type=click.File("r", encoding="utf-8"),
+    required=True,
+    help="DAR bulk export of adresser or adgangsadresser, CSV or NDJSON.",
+)
+@click.option(
+    "--index",
+    type=click.Path(dir_okay=False, writable=True),
+    required=True,
+    help="Index file to build or replace, see DAR_INDEX_PATH.",
+)
+def build_dar_index(export, index):
+    """Build the local DAR address index from a bulk export."""
+    count = build_index(read_export(export), index)
+    click.echo(f"Indexed {count} addresses in {index}")
+
+
 if __name__ == "__main__":
     sd_mox_cli()
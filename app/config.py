@@ -2,39 +2,138 @@
 #
 # SPDX-License-Identifier: MPL-2.0
 
-from typing import Dict, List, Optional
+from typing import Any, Dict, FrozenSet, List, Literal, Optional
 from uuid import UUID
 
-from pydantic import AnyHttpUrl, BaseSettings, HttpUrl, PositiveInt
+from pydantic import (
+    AnyHttpUrl,
+    BaseSettings,
+    HttpUrl,
+    NonNegativeFloat,
+    PositiveFloat,
+    PositiveInt,
+    root_validator,
+)
 from pydantic.tools import parse_obj_as
+from structlog import get_logger
 
 from app.pydantic_types import Domain, Port
 
 
 class Settings(BaseSettings):
     mora_url: AnyHttpUrl = parse_obj_as(AnyHttpUrl, "https://moradev.magentahosted.dk")
+    mora_timeout: PositiveFloat = PositiveFloat(10)
+    mora_pool_size: PositiveInt = PositiveInt(20)
     saml_token: Optional[UUID] = None
 
-    triggered_uuids: List[UUID]
+    triggered_uuids: FrozenSet[UUID]
     ou_levelkeys: List[str]
+    class_map_ttl: PositiveFloat = PositiveFloat(3600)
+    class_map_stale_ttl: PositiveFloat = PositiveFloat(86400)
+    scope_negative_ttl: PositiveFloat = PositiveFloat(300)
 
     amqp_username: str
     amqp_password: str
     amqp_host: Domain = Domain("msg-amqp.silkeborgdata.dk")
     amqp_virtual_host: str
     amqp_port: Port = Port(5672)
-    amqp_check_waittime: PositiveInt = PositiveInt(3)
-    amqp_check_retries: PositiveInt = PositiveInt(6)
+    amqp_check_first_delay: PositiveFloat = PositiveFloat(0.5)
+    amqp_check_backoff: PositiveFloat = PositiveFloat(2)
+    amqp_check_max_delay: PositiveFloat = PositiveFloat(3)
+    amqp_check_jitter: NonNegativeFloat = NonNegativeFloat(0.1)
+    amqp_check_deadline: PositiveFloat = PositiveFloat(18)
+    amqp_check_learn_delay: bool = False
+    # Deprecated, see map_deprecated_check_settings
+    amqp_check_retries: Optional[PositiveInt] = None
+    amqp_check_waittime: Optional[PositiveInt] = None
+    amqp_publisher: Literal["blocking", "asyncio"] = "blocking"
+    amqp_publish_timeout: PositiveFloat = PositiveFloat(10)
+    amqp_heartbeat: PositiveInt = PositiveInt(60)
+    amqp_blocked_timeout: PositiveFloat = PositiveFloat(30)
+    amqp_channel_pool_size: PositiveInt = PositiveInt(2)
+    amqp_reconnect_attempts: PositiveInt = PositiveInt(5)
+    amqp_reconnect_delay: PositiveFloat = PositiveFloat(0.5)
+    amqp_reconnect_max_delay: PositiveFloat = PositiveFloat(10)
 
     sd_username: str
     sd_password: str
     sd_institution: str
     sd_base_url: HttpUrl = parse_obj_as(HttpUrl, "https://service.sd.dk/sdws/")
+    sd_timeout: PositiveFloat = PositiveFloat(10)
+    sd_max_concurrency: PositiveInt = PositiveInt(8)
+    sd_cache_ttl: PositiveFloat = PositiveFloat(60)
+    sd_cache_size: PositiveInt = PositiveInt(1024)
+    sd_mirror: bool = False
+    sd_mirror_max_age: PositiveFloat = PositiveFloat(600)
+    sd_mirror_refresh_interval: PositiveFloat = PositiveFloat(300)
+    sd_mirror_max_dates: PositiveInt = PositiveInt(4)
+    sd_snapshot_ttl: PositiveFloat = PositiveFloat(300)
+    sd_snapshot_stale_ttl: NonNegativeFloat = NonNegativeFloat(3600)
+    sd_snapshot_path: Optional[str] = None
+
+    dar_url: AnyHttpUrl = parse_obj_as(AnyHttpUrl, "https://dawa.aws.dk/")
+    dar_timeout: PositiveFloat = PositiveFloat(10)
+    dar_cache_ttl: PositiveFloat = PositiveFloat(86400)
+    dar_cache_size: PositiveInt = PositiveInt(4096)
+    dar_index_path: Optional[str] = None
+
+    trigger_timeout: PositiveInt = PositiveInt(60)
+    trigger_deadline_margin: NonNegativeFloat = NonNegativeFloat(5)
 
     jaeger_service: str = "SDMox"
     jaeger_hostname: Optional[str] = None
     jaeger_port: Port = Port(6831)
 
+    @root_validator(pre=True)
+    def map_deprecated_check_settings(cls, values: Dict[str, Any]) -> Dict[str, Any]:
+        """Map AMQP_CHECK_RETRIES and AMQP_CHECK_WAITTIME onto their successors.
+
+        Verification used to wait waittime seconds before each of retries
+        probes. Unless set explicitly, the deadline becomes retries times
+        waittime, and no wait between probes exceeds waittime.
+        """
+        retries = values.get("amqp_check_retries")
+        waittime = values.get("amqp_check_waittime")
+        if retries is None and waittime is None:
+            return values
+        get_logger().warning(
+            "AMQP_CHECK_RETRIES and AMQP_CHECK_WAITTIME are deprecated, "
+            "use AMQP_CHECK_DEADLINE and AMQP_CHECK_MAX_DELAY instead"
+        )
+        try:
+            retries = int(retries if retries is not None else 6)
+            waittime = float(waittime if waittime is not None else 3)
+        except (TypeError, ValueError):
+            # Left for the field validators to report
+            return values
+        values = dict(values)
+        values.setdefault("amqp_check_deadline", retries * waittime)
+        values.setdefault("amqp_check_max_delay", waittime)
+        return values
+
+
+_settings: Optional[Settings] = None
+
 
 def get_settings(**overrides) -> Settings:
-    return Settings(**overrides)
+    """Return the process-wide settings.
+
+    The environment is only parsed on first use, and again on reload_settings.
+    Passing overrides always constructs fresh settings, bypassing the memo.
+    """
+    global _settings
+    if overrides:
+        return Settings(**overrides)
+    if _settings is None:
+        _settings = Settings()  # type: ignore[call-arg]
+    return _settings
+
+
+def reload_settings() -> Settings:
+    """Parse the environment again and replace the process-wide settings.
+
+    If the new environment is invalid the previous settings are kept.
+    """
+    global _settings
+    _settings = Settings()  # type: ignore[call-arg]
+    return _settings
@@ -0,0 +1,245 @@
+# SPDX-FileCopyrightText: Magenta ApS
+#
+# SPDX-License-Identifier: MPL-2.0
+
+import asyncio
+from abc import ABC, abstractmethod
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import aiohttp
+from structlog import get_logger
+
+from app import deadline
+from app.cache import AsyncTTLCache
+from app.config import Settings
+from app.dar_index import DARRecord, ReloadingDARIndex, dar_record
+
+
+class DARLookupError(Exception):
+    """Raised when DAR could not be asked about an address."""
+
+
+class BaseDARResolver(ABC):
+    """Resolves DAR address ids to structured addresses."""
+
+    @abstractmethod
+    async def resolve(self, address_id: str) -> Optional[DARRecord]:
+        """Return the address of address_id, or None if DAR does not know it.
+
+        Raise DARLookupError if DAR could not be asked.
+        """
+        raise NotImplementedError()
+
+    async def resolve_many(
+        self, address_ids: Iterable[str]
+    ) -> Dict[str, Optional[DARRecord]]:
+        """Resolve several ids, in as few requests as possible."""
+        address_ids = list(dict.fromkeys(address_ids))
+        addresses = await asyncio.gather(*map(self.resolve, address_ids))
+        return dict(zip(address_ids, addresses))
+
+    async def close(self) -> None:
+        pass
+
+
+class DARResolver(BaseDARResolver):
+    """Resolve DAR address ids to structured addresses online.
+
+    An id is looked up on all four endpoints at once, and the first endpoint
+    in ENDPOINTS order that knows the id wins. Ids requested in the same
+    iteration of the event loop are looked up together, in a single request
+    per endpoint, bounded by timeout only. Each caller waits for its id under
+    its own deadline. Results, including ids not found, are cached.
+
+    Example:
+
+        resolver = DARResolver("https://dawa.aws.dk/")
+        address = await resolver.resolve("0a3f507b-7750-32b8-e044-0003ba298018")
+    """
+
+    ENDPOINTS = (
+        "adresser",
+        "adgangsadresser",
+        "historik/adresser",
+        "historik/adgangsadresser",
+    )
+
+    def __init__(
+        self,
+        base_url: str,
+        timeout: float = 10,
+        cache_ttl: float = 86400,
+        cache_size: int = 4096,
+        pool_size: int = 10,
+        batch_size: int = 100,
+    ):
+        self.base_url = base_url.rstrip("/") + "/"
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.batch_size = batch_size
+
+        self.cache: AsyncTTLCache[str, Optional[DARRecord]] = AsyncTTLCache(
+            self._enqueue, ttl=cache_ttl, max_size=cache_size
+        )
+        self._pending: Dict[str, "asyncio.Future[Optional[DARRecord]]"] = {}
+
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._session_loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # Sessions are bound to the event loop they were created in
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._session_loop != loop:
+            connector = aiohttp.TCPConnector(limit=self.pool_size)
+            self._session = aiohttp.ClientSession(connector=connector)
+            self._session_loop = loop
+        return self._session
+
+    async def resolve(self, address_id: str) -> Optional[DARRecord]:
+        return await self.cache.get(address_id)
+
+    def _enqueue(self, address_id: str) -> "asyncio.Future[Optional[DARRecord]]":
+        # Called by the cache on a miss, lookups are made on the next iteration
+        loop = asyncio.get_running_loop()
+        if not self._pending:
+            # Batches mix ids of several requests, none of their deadlines apply
+            loop.call_soon(self._flush, context=deadline.without_deadline())
+        future = self._pending.get(address_id)
+        if future is None:
+            future = self._pending[address_id] = loop.create_future()
+        return future
+
+    def _flush(self) -> None:
+        pending, self._pending = self._pending, {}
+        address_ids = list(pending)
+        for start in range(0, len(address_ids), self.batch_size):
+            batch = {
+                address_id: pending[address_id]
+                for address_id in address_ids[start : start + self.batch_size]
+            }
+            asyncio.ensure_future(self._resolve_batch(batch))
+
+    async def _resolve_batch(
+        self, batch: Dict[str, "asyncio.Future[Optional[DARRecord]]"]
+    ) -> None:
+        address_ids = list(batch)
+        responses = await asyncio.gather(
+            *(self._lookup(endpoint, address_ids) for endpoint in self.ENDPOINTS),
+            return_exceptions=True,
+        )
+        for address_id, future in batch.items():
+            if future.done():
+                continue
+            try:
+                future.set_result(self._first_hit(address_id, responses))
+            except Exception as e:
+                future.set_exception(e)
+
+    @staticmethod
+    def _first_hit(address_id: str, responses: List) -> Optional[DARRecord]:
+        for endpoint, response in zip(DARResolver.ENDPOINTS, responses):
+            if isinstance(response, BaseException):
+                # A lower priority endpoint may not decide the result
+                raise DARLookupError(
+                    "Lookup of {} in DAR {} failed".format(address_id, endpoint)
+                ) from response
+            if address_id in response:
+                return response[address_id]
+        return None
+
+    async def _lookup(
+        self, endpoint: str, address_ids: List[str]
+    ) -> Dict[str, DARRecord]:
+        """Look up address_ids on a single endpoint, return addresses by id."""
+        params: List[Tuple[str, str]] = [
+            ("id", "|".join(address_ids)),
+            ("noformat", "1"),
+            ("struktur", "mini"),
+        ]
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        session = self._get_session()
+        async with session.get(
+            self.base_url + endpoint, params=params, timeout=timeout
+        ) as response:
+            response.raise_for_status()
+            found = await response.json()
+        get_logger().debug(
+            "DAR lookup",
+            endpoint=endpoint,
+            requested=len(address_ids),
+            found=len(found),
+        )
+        # Historic endpoints return all versions, the last is the most recent
+        return {address["id"]: dar_record(address) for address in found}
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+
+class IndexedDARResolver(BaseDARResolver):
+    """Resolve DAR address ids from a local index, see app.dar_index.
+
+    Ids missing from the index are resolved by the fallback resolver.
+    """
+
+    def __init__(self, index: ReloadingDARIndex, fallback: BaseDARResolver):
+        self.index = index
+        self.fallback = fallback
+
+    async def resolve(self, address_id: str) -> Optional[DARRecord]:
+        record = self.index.lookup(address_id)
+        if record is not None:
+            return record
+        return await self.fallback.resolve(address_id)
+
+    async def close(self) -> None:
+        self.index.close()
+        await self.fallback.close()
+
+
+_resolvers: Dict[Tuple, BaseDARResolver] = {}
+
+
+def _resolver_key(settings: Settings) -> Tuple:
+    return (
+        settings.dar_url,
+        settings.dar_timeout,
+        settings.dar_cache_ttl,
+        settings.dar_cache_size,
+        settings.dar_index_path,
+    )
+
+
+def get_dar_resolver(settings: Settings) -> BaseDARResolver:
+    """Return the process-wide DAR resolver for the DAR configured in settings.
+
+    With dar_index_path set, addresses are resolved from the local index, and
+    only missing ones are looked up online.
+    """
+    key = _resolver_key(settings)
+    if key not in _resolvers:
+        resolver: BaseDARResolver = DARResolver(
+            base_url=settings.dar_url,
+            timeout=settings.dar_timeout,
+            cache_ttl=settings.dar_cache_ttl,
+            cache_size=settings.dar_cache_size,
+        )
+        if settings.dar_index_path is not None:
+            index = ReloadingDARIndex(settings.dar_index_path)
+            resolver = IndexedDARResolver(index, fallback=resolver)
+        _resolvers[key] = resolver
+    return _resolvers[key]
+
+
+async def close_dar_resolvers(keep: Optional[Settings] = None) -> None:
+    """Close all DAR resolvers, used on application shutdown.
+
+    With keep, the resolver for the settings keep is left open.
+    """
+    kept = _resolver_key(keep) if keep is not None else None
+    resolvers = [resolver for key, resolver in _resolvers.items() if key != kept]
+    for key in [key for key in _resolvers if key != kept]:
+        del _resolvers[key]
+    for resolver in resolvers:
+        await resolver.close()
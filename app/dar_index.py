@@ -0,0 +1,240 @@
+# SPDX-FileCopyrightText: Magenta ApS
+#
+# SPDX-License-Identifier: MPL-2.0
+
+import csv
+import json
+import mmap
+import os
+import struct
+import tempfile
+import time
+from typing import IO, Dict, Iterable, Iterator, NamedTuple, Optional, Tuple
+from uuid import UUID
+
+from structlog import get_logger
+
+# File layout:
+#   header:  MAGIC, version, number of records
+#   index:   per record, sorted by id: id (16 bytes), data offset, data length
+#   data:    per record: betegnelse, street, zip code and city, UTF-8 encoded
+#            and separated by FIELD_SEPARATOR
+MAGIC = b"SDMOXDAR"
+VERSION = 1
+HEADER = struct.Struct("<8sII")
+ENTRY = struct.Struct("<16sII")
+FIELD_SEPARATOR = "\x1f"
+
+
+class DARRecord(NamedTuple):
+    """A DAR address, with the parts SD wants as separate fields."""
+
+    betegnelse: str
+    street: str
+    zip_code: str
+    city: str
+
+
+def dar_record(row: dict) -> DARRecord:
+    """Build a DARRecord from a DAR address with id, betegnelse and postnr.
+
+    The street is betegnelse without its trailing zip code and postal
+    district. postnr and postnrnavn are taken from the address when present,
+    and otherwise read from the last part of betegnelse.
+    """
+    betegnelse = row["betegnelse"]
+    street, _, postal = betegnelse.rpartition(", ")
+    if row.get("postnr") is not None and row.get("postnrnavn") is not None:
+        zip_code, city = str(row["postnr"]), row["postnrnavn"]
+        suffix = f", {zip_code} {city}"
+        if betegnelse.endswith(suffix):
+            street = betegnelse[: -len(suffix)]
+    else:
+        zip_code, _, city = postal.partition(" ")
+    return DARRecord(betegnelse, street, zip_code, city)
+
+
+def read_export(export: IO[str]) -> Iterator[Tuple[str, DARRecord]]:
+    """Read addresses from a DAR bulk export.
+
+    Both CSV and newline delimited JSON exports of the adresser or
+    adgangsadresser endpoints are understood. Only the id, betegnelse, postnr
+    and postnrnavn fields are used.
+    """
+    first_line = export.readline()
+    export.seek(0)
+    if first_line.lstrip().startswith(("{", "[")):
+        if first_line.lstrip().startswith("["):
+            rows: Iterable[dict] = json.load(export)
+        else:
+            rows = (json.loads(line) for line in export if line.strip())
+    else:
+        rows = csv.DictReader(export)
+
+    for row in rows:
+        yield row["id"], dar_record(row)
+
+
+def build_index(records: Iterable[Tuple[str, DARRecord]], path: str) -> int:
+    """Write records to a new index at path, and return the number written.
+
+    Records are streamed to a temporary file, so only the index entries are
+    held in memory. The last record of an id wins. The index is written next
+    to path and moved in place when complete, so running processes never see
+    a partial index.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    # Offset and length in the temporary file of the data of each id
+    entries: Dict[bytes, Tuple[int, int]] = {}
+    index_name = None
+    try:
+        with tempfile.TemporaryFile(dir=directory) as data:
+            size = 0
+            for address_id, record in records:
+                encoded = FIELD_SEPARATOR.join(record).encode("utf-8")
+                entries[UUID(address_id).bytes] = (size, len(encoded))
+                data.write(encoded)
+                size += len(encoded)
+
+            # Copy the data in the order it was written, leaving out records
+            # replaced by a later one with the same id
+            written = sorted(entries.items(), key=lambda entry: entry[1][0])
+            offsets = {}
+            offset = HEADER.size + ENTRY.size * len(entries)
+            for key, (_, length) in written:
+                offsets[key] = offset
+                offset += length
+
+            with tempfile.NamedTemporaryFile(dir=directory, delete=False) as index_file:
+                index_name = index_file.name
+                index_file.write(HEADER.pack(MAGIC, VERSION, len(entries)))
+                for key in sorted(entries):
+                    index_file.write(ENTRY.pack(key, offsets[key], entries[key][1]))
+                data.seek(0)
+                position = 0
+                for _, (start, length) in written:
+                    if start != position:
+                        data.seek(start)
+                    index_file.write(data.read(length))
+                    position = start + length
+        os.replace(index_name, path)
+        index_name = None
+    finally:
+        if index_name is not None:
+            os.unlink(index_name)
+    return len(entries)
+
+
+class DARIndex:
+    """Read-only, memory-mapped index of DAR addresses built by build_index.
+
+    Lookups are a binary search over the sorted ids, without reading the
+    whole file into memory.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as index_file:
+            self.stat = os.fstat(index_file.fileno())
+            if self.stat.st_size < HEADER.size:
+                raise ValueError(f"{path} is not a DAR index")
+            self._mmap = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self._validate()
+        except ValueError:
+            self._mmap.close()
+            raise
+
+    def _validate(self) -> None:
+        """Raise ValueError unless the file is a complete index."""
+        magic, version, self.count = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{self.path} is not a version {VERSION} DAR index")
+        data_start = HEADER.size + ENTRY.size * self.count
+        if data_start > len(self._mmap):
+            raise ValueError(f"{self.path} is truncated")
+        end = max(
+            (
+                offset + length
+                for _, offset, length in ENTRY.iter_unpack(
+                    self._mmap[HEADER.size : data_start]
+                )
+            ),
+            default=data_start,
+        )
+        if end != len(self._mmap):
+            raise ValueError(f"{self.path} is truncated")
+
+    def _key(self, position: int) -> bytes:
+        start = HEADER.size + ENTRY.size * position
+        return self._mmap[start : start + 16]
+
+    def lookup(self, address_id: str) -> Optional[DARRecord]:
+        try:
+            key = UUID(address_id).bytes
+        except ValueError:
+            return None
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low == self.count or self._key(low) != key:
+            return None
+        _, offset, length = ENTRY.unpack_from(
+            self._mmap, HEADER.size + ENTRY.size * low
+        )
+        fields = self._mmap[offset : offset + length].decode("utf-8")
+        return DARRecord(*fields.split(FIELD_SEPARATOR))
+
+    def __len__(self) -> int:
+        return self.count
+
+    def close(self) -> None:
+        self._mmap.close()
+
+
+class ReloadingDARIndex:
+    """DARIndex which picks up a rebuilt index file.
+
+    The file is checked for changes at most every check_interval seconds.
+    """
+
+    def __init__(self, path: str, check_interval: float = 60):
+        self.path = path
+        self.check_interval = check_interval
+        self.index = DARIndex(path)
+        self._checked_at = time.monotonic()
+
+    def _reload_if_changed(self) -> None:
+        now = time.monotonic()
+        if now - self._checked_at < self.check_interval:
+            return
+        self._checked_at = now
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return
+        previous = self.index.stat
+        if (stat.st_ino, stat.st_mtime_ns) != (previous.st_ino, previous.st_mtime_ns):
+            get_logger().info("Reloading DAR index", path=self.path)
+            try:
+                index = DARIndex(self.path)
+            except (OSError, ValueError) as e:
+                # Keep answering from the old index until the file is fixed
+                get_logger().warning(
+                    "Unable to reload DAR index", path=self.path, error=str(e)
+                )
+                return
+            # Lookups in progress hold no references into the old mapping
+            old, self.index = self.index, index
+            old.close()
+
+    def lookup(self, address_id: str) -> Optional[DARRecord]:
+        self._reload_if_changed()
+        return self.index.lookup(address_id)
+
+    def close(self) -> None:
+        self.index.close()
@@ -0,0 +1,117 @@
+# SPDX-FileCopyrightText: Magenta ApS
+#
+# SPDX-License-Identifier: MPL-2.0
+
+import asyncio
+import time
+from contextlib import contextmanager
+from contextvars import Context, ContextVar, copy_context
+from typing import Any, Awaitable, Callable, Coroutine, Iterator, Optional, TypeVar
+
+from fastapi import Request, Response
+from fastapi.routing import APIRoute
+
+from app.config import get_settings
+
+T = TypeVar("T")
+
+_deadline: ContextVar[Optional[float]] = ContextVar("deadline", default=None)
+
+
+class DeadlineExceeded(Exception):
+    """Raised when the deadline of the current request has passed."""
+
+
+@contextmanager
+def deadline(seconds: float) -> Iterator[float]:
+    """Let the code within run for at most seconds.
+
+    Nested deadlines never extend an outer deadline.
+    """
+    expires = time.monotonic() + seconds
+    outer = _deadline.get()
+    if outer is not None:
+        expires = min(expires, outer)
+    token = _deadline.set(expires)
+    try:
+        yield expires
+    finally:
+        _deadline.reset(token)
+
+
+def without_deadline() -> Context:
+    """Return a copy of the current context without a deadline.
+
+    Work shared by several requests runs in it, so it does not end at the
+    deadline of whichever request happened to start it.
+    """
+    context = copy_context()
+    context.run(_deadline.set, None)
+    return context
+
+
+def remaining() -> Optional[float]:
+    """Return seconds left of the current deadline, or None without one."""
+    expires = _deadline.get()
+    if expires is None:
+        return None
+    return expires - time.monotonic()
+
+
+def check(operation: str = "request") -> None:
+    """Raise DeadlineExceeded if the current deadline has passed."""
+    left = remaining()
+    if left is not None and left <= 0:
+        raise DeadlineExceeded(f"Deadline exceeded during {operation}")
+
+
+def bounded(timeout: Optional[float], operation: str = "request") -> Optional[float]:
+    """Return timeout shortened to the time left of the current deadline."""
+    check(operation)
+    left = remaining()
+    if left is None:
+        return timeout
+    if timeout is None:
+        return left
+    return min(timeout, left)
+
+
+async def wait_for(
+    awaitable: Awaitable[T], timeout: Optional[float] = None, operation: str = "request"
+) -> T:
+    """Await awaitable for at most timeout, and never past the current deadline.
+
+    Raise DeadlineExceeded if the deadline was what ran out, otherwise
+    asyncio.TimeoutError as asyncio.wait_for does.
+    """
+    try:
+        limit = bounded(timeout, operation)
+    except DeadlineExceeded:
+        # Do not leave the coroutine un-awaited
+        if asyncio.iscoroutine(awaitable):
+            awaitable.close()
+        raise
+    try:
+        return await asyncio.wait_for(awaitable, limit)
+    except asyncio.TimeoutError:
+        check(operation)
+        raise
+
+
+class DeadlineRoute(APIRoute):
+    """Route which runs every request under a deadline.
+
+    The deadline is the trigger timeout registered with MO, less a margin
+    for getting the response back before MO gives up waiting.
+    """
+
+    def get_route_handler(self) -> Callable[[Request], Coroutine[Any, Any, Response]]:
+        handler = super().get_route_handler()
+
+        async def deadline_handler(request: Request) -> Response:
+            settings = get_settings()
+            seconds = settings.trigger_timeout - settings.trigger_deadline_margin
+            with deadline(seconds):
+                return await handler(request)
+
+        return deadline_handler
@@ -1,20 +1,25 @@
 # SPDX-FileCopyrightText: Magenta ApS
 #
 # SPDX-License-Identifier: MPL-2.0
+import asyncio
 from datetime import date
 from functools import partial
 from typing import Any, Dict, Optional, Union
 from uuid import UUID
 
+from aiohttp import ClientConnectionError
 from fastapi import Depends, HTTPException, Query, status
-from os2mo_helpers.mora_helpers import MoraHelper
-from requests.exceptions import ConnectionError
+from structlog import get_logger
 
 from app.config import get_settings
+from app.mo import AsyncMoraHelper
 from app.models import DetailError
-from app.sd_mox import SDMox, SDMoxInterface
+from app.scope import get_scope_index
+from app.sd_mox import SDMoxInterface, get_sdmox
 from app.util import first_of_month
 
+OUT_OF_SCOPE = "The requested organizational unit is outside the configured allow list"
+
 
 def should_mox_run(mo_ou: dict):
     """Determine whether sdmox should trigger code for this organizational unit.
@@ -22,9 +27,10 @@ def should_mox_run(mo_ou: dict):
     This is determined by whether the UUID of the unit is in the
     triggered_uuids settings variable.
     """
+    triggered_uuids = get_settings().triggered_uuids
     # TODO: Consider a parent iterator
     while mo_ou and mo_ou["uuid"]:
-        if UUID(mo_ou["uuid"]) in get_settings().triggered_uuids:
+        if UUID(mo_ou["uuid"]) in triggered_uuids:
             return True
         mo_ou = mo_ou["parent"]
     return False
@@ -34,7 +40,7 @@ async def _ou_edit_name(ou_uuid: UUID, new_name: str, at: date, dry_run: bool):
     assert new_name is not None, "_ou_edit_name called without new_name"
 
     print("Changing name")
-    mox: SDMoxInterface = SDMox(from_date=at)
+    mox: SDMoxInterface = get_sdmox()
     await mox.rename_unit(ou_uuid, new_name, at=at, dry_run=dry_run)
 
 
@@ -42,10 +48,20 @@ async def _ou_edit_parent(ou_uuid: UUID, new_parent: UUID, at: date, dry_run: bo
     assert new_parent is not None, "_ou_edit_name called without new_parent"
 
     print("Changing parent")
-    mox: SDMoxInterface = SDMox(from_date=at)
+    mox: SDMoxInterface = get_sdmox()
     await mox.move_unit(ou_uuid, new_parent, at=at, dry_run=dry_run)
 
 
+async def _ou_edit_name_and_parent(
+    ou_uuid: UUID, new_name: str, new_parent: UUID, at: date, dry_run: bool
+):
+    get_logger().info("Changing name and parent", unit_uuid=str(ou_uuid))
+    mox: SDMoxInterface = get_sdmox()
+    await mox.rename_and_move_unit(
+        ou_uuid, new_name, new_parent, at=at, dry_run=dry_run
+    )
+
+
 def get_date(
     date: Optional[date] = Query(
         None,
@@ -63,11 +79,25 @@ def get_date(
     return first_of_month()
 
 
-def _verify_ou_ok(uuid: UUID, at: date, mora_helper: MoraHelper):
+async def _verify_ou_ok(uuid: UUID, at: date, mora_helper: AsyncMoraHelper):
+    # Units seen before are checked without asking MO
+    scope_index = get_scope_index(get_settings())
+    in_scope = scope_index.in_scope(uuid, at)
+    if in_scope is None:
+        in_scope = await _read_ou_in_scope(uuid, at, mora_helper)
+
+    if not in_scope:
+        raise HTTPException(
+            # TODO: Change to 304_NOT_MODIFIED when #41894 is merged.
+            status_code=status.HTTP_200_OK,
+            detail=OUT_OF_SCOPE,
+        )
+
+
+async def _read_ou_in_scope(uuid: UUID, at: date, mora_helper: AsyncMoraHelper):
     try:
-        # TODO: AIOHTTP MoraHelpers?
-        mo_ou = mora_helper.read_ou(uuid, at=at)
-    except ConnectionError:
+        mo_ou = await mora_helper.read_ou(uuid, at=at)
+    except (ClientConnectionError, asyncio.TimeoutError):
         raise HTTPException(
             status_code=status.HTTP_502_BAD_GATEWAY,
             detail="Could not establish a connection to MO",
@@ -79,12 +109,8 @@ def _verify_ou_ok(uuid: UUID, at: date, mora_helper: MoraHelper):
             detail="The requested organizational unit was not found in MO",
         )
 
-    if not should_mox_run(mo_ou):
-        raise HTTPException(
-            # TODO: Change to 304_NOT_MODIFIED when #41894 is merged.
-            status_code=status.HTTP_200_OK,
-            detail="The requested organizational unit is outside the configured allow list",
-        )
+    get_scope_index(get_settings()).learn(mo_ou, at)
+    return should_mox_run(mo_ou)
 
 
 _verify_ou_ok_responses: Dict[Union[int, str], Dict[str, Any]] = {
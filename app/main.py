@@ -12,22 +12,44 @@
 # ellers går tilbagemeldingen fra SD tilsyneladende i ged.
 # - Der er indført et check for det i sd_mox.py
 
+import asyncio
 import sys
 
 sys.path.insert(0, "/")
 
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Set
 from uuid import UUID
 
-from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse, PlainTextResponse, RedirectResponse
+from fastapi import FastAPI, Query, Request, Response
+from fastapi.responses import (
+    JSONResponse,
+    PlainTextResponse,
+    RedirectResponse,
+    StreamingResponse,
+)
 from os2mo_fastapi_utils.tracing import setup_instrumentation, setup_logging
 from structlog.processors import KeyValueRenderer
 
-from app.config import get_settings
+from app.amqp import close_amqp_publishers, get_amqp_stats
+from app.config import get_settings, reload_settings
+from app.dar import close_dar_resolvers
+from app.deadline import DeadlineExceeded
+from app.mo import close_async_mora_helpers, get_async_mora_helper
 from app.routers import api, trigger_api
-from app.sd_mox import SDMoxError
-from app.sd_tree_org import department_identifier_list, sd_tree_org
+from app.scope import close_scope_indexes, get_scope_index
+from app.sd_mox import SDMox, SDMoxError, get_sdmox, set_sdmox
+from app.sd_tree_org import (
+    OrganisationSnapshot,
+    TreeFormat,
+    department_identifier_list,
+    forget_organisation_snapshots,
+    get_organisation_snapshot,
+    ndjson_tree,
+    nest_tree_nodes,
+    sd_tree_org,
+    tree_nodes,
+    warm_organisation_snapshot,
+)
 
 tags_metadata: List[Dict[str, Any]] = [
     {
@@ -58,7 +80,24 @@ app = FastAPI(
 @app.on_event("startup")
 async def startup_event():
     # Called for validation side-effect
-    get_settings()
+    settings = get_settings()
+    # Construct the shared SDMox once, and fail fast on missing NY-levels
+    sdmox = get_sdmox()
+    await sdmox.load_levels()
+    sdmox.start_mirror()
+    get_scope_index(settings).start(get_async_mora_helper(settings))
+    warm_organisation_snapshot(settings)
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await get_sdmox().close()
+    await close_scope_indexes()
+    await close_amqp_publishers()
+    await close_async_mora_helpers()
+    await close_dar_resolvers()
+    for task in list(_closing):
+        task.cancel()
 
 
 @app.get(
@@ -79,14 +118,135 @@ def info() -> Dict[str, Any]:
     }
 
 
+@app.get("/amqp", tags=["Meta"], summary="Print AMQP publisher statistics")
+def amqp() -> Dict[str, Dict[str, Any]]:
+    """Print publish latency and reconnect counts for the AMQP publishers."""
+    return get_amqp_stats()
+
+
+@app.post("/cache/invalidate", tags=["Meta"], summary="Invalidate cached MO class maps")
+def cache_invalidate() -> Dict[str, str]:
+    """Invalidate cached MO class maps, so they are fetched on next use."""
+    get_sdmox().class_maps.invalidate()
+    return {"status": "OK"}
+
+
+@app.post("/settings/reload", tags=["Meta"], summary="Reload settings")
+async def settings_reload() -> Dict[str, str]:
+    """Reload settings from the environment without restarting.
+
+    The shared SDMox is rebuilt with the new settings, and its NY-levels are
+    loaded before it replaces the old one. The AMQP publisher, MO and DAR
+    clients and the SD snapshot are rebuilt on first use with the new
+    settings. Requests already in flight finish with the settings they
+    started with, and the clients built from the old settings are closed
+    once they can no longer be in use.
+    """
+    settings = reload_settings()
+    sdmox = SDMox()
+    await sdmox.load_levels()
+    previous = get_sdmox()
+    set_sdmox(sdmox)
+    sdmox.start_mirror()
+    get_scope_index(settings).start(get_async_mora_helper(settings))
+    forget_organisation_snapshots(keep=settings)
+    warm_organisation_snapshot(settings)
+    await previous.close()
+
+    task = asyncio.ensure_future(close_stale_clients(settings.trigger_timeout))
+    _closing.add(task)
+    task.add_done_callback(_closing.discard)
+    return {"status": "OK"}
+
+
+_closing: Set["asyncio.Task[None]"] = set()
+
+
+async def close_stale_clients(delay: float) -> None:
+    """Close clients built from replaced settings, after delay seconds.
+
+    delay is the longest a request may take, so no request still uses them.
+    """
+    await asyncio.sleep(delay)
+    settings = get_settings()
+    await close_amqp_publishers(keep=settings)
+    await close_async_mora_helpers(keep=settings)
+    await close_dar_resolvers(keep=settings)
+
+
+def snapshot_headers(snapshot: OrganisationSnapshot) -> Dict[str, str]:
+    return {"ETag": f'"{snapshot.etag}"', "Age": str(int(snapshot.age()))}
+
+
+def is_not_modified(request: Request, etag: str) -> bool:
+    """Return whether the If-None-Match header of request matches etag."""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is None:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+
 @app.get(
     "/tree",
     tags=["Meta"],
     summary="Printout org tree from SD",
     response_class=PlainTextResponse,
 )
-async def tree(root_uuid: Optional[UUID] = None) -> str:
-    return await sd_tree_org(root_uuid)
+async def tree(
+    request: Request,
+    root_uuid: Optional[List[UUID]] = Query(
+        None, description="Only print the trees below these units."
+    ),
+    max_depth: Optional[int] = Query(
+        None, ge=0, description="Only print units this many levels below the roots."
+    ),
+    level: Optional[List[str]] = Query(
+        None, description="Only list units at these NY-levels, json and ndjson only."
+    ),
+    format: TreeFormat = Query(TreeFormat.text, description="Output format."),
+) -> Response:
+    """Printout org tree from SD.
+
+    The json and ndjson formats list each unit with its uuid, identifier,
+    name, level, parent and depth below its root. json nests the units below
+    each unit in children, ndjson streams one unit per line.
+
+    Served from a shared snapshot of SD, the Age header tells how old it is.
+    """
+    snapshot = await get_organisation_snapshot(get_settings())
+    headers = snapshot_headers(snapshot)
+    if is_not_modified(request, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+
+    root_uuids = [str(uuid) for uuid in root_uuid] if root_uuid else None
+    unknown = [
+        uuid for uuid in root_uuids or [] if uuid not in snapshot.organisation.positions
+    ]
+    if unknown:
+        return JSONResponse(
+            status_code=404,
+            content={"detail": f"Ukendte enheder i SD: {', '.join(unknown)}"},
+        )
+
+    if format == TreeFormat.text:
+        if level:
+            return JSONResponse(
+                status_code=400,
+                content={"detail": "level kræver format json eller ndjson"},
+            )
+        return StreamingResponse(
+            sd_tree_org(snapshot, root_uuids, max_depth),
+            media_type="text/plain",
+            headers=headers,
+        )
+
+    nodes = tree_nodes(snapshot, root_uuids, max_depth, set(level) if level else None)
+    if format == TreeFormat.ndjson:
+        return StreamingResponse(
+            ndjson_tree(nodes), media_type="application/x-ndjson", headers=headers
+        )
+    return JSONResponse(nest_tree_nodes(snapshot, nodes), headers=headers)
 
 
 @app.get(
@@ -95,8 +255,16 @@ async def tree(root_uuid: Optional[UUID] = None) -> str:
     summary="Printout Department Identifiers with duplicates from SD",
     response_class=JSONResponse,
 )
-async def duplicates() -> Dict[str, int]:
-    return await department_identifier_list()
+async def duplicates(request: Request) -> Response:
+    """Printout Department Identifiers with duplicates from SD.
+
+    Served from a shared snapshot of SD, the Age header tells how old it is.
+    """
+    snapshot = await get_organisation_snapshot(get_settings())
+    headers = snapshot_headers(snapshot)
+    if is_not_modified(request, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(department_identifier_list(snapshot), headers=headers)
 
 
 @app.exception_handler(SDMoxError)
@@ -107,6 +275,14 @@ async def sdmox_exception_handler(request: Request, exc: SDMoxError):
     )
 
 
+@app.exception_handler(DeadlineExceeded)
+async def deadline_exception_handler(request: Request, exc: DeadlineExceeded):
+    return JSONResponse(
+        status_code=504,
+        content={"detail": f"{str(exc)}"},
+    )
+
+
 from pika.exceptions import ProbableAuthenticationError
 
 
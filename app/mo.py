@@ -0,0 +1,323 @@
+# SPDX-FileCopyrightText: Magenta ApS
+#
+# SPDX-License-Identifier: MPL-2.0
+
+import asyncio
+import copy
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import (
+    Any,
+    Callable,
+    Coroutine,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+from uuid import UUID
+
+import aiohttp
+from fastapi import Request, Response
+from fastapi.routing import APIRoute
+from ra_utils.headers import TokenSettings
+from structlog import get_logger
+
+from app import deadline
+from app.config import Settings
+
+_shared_reads: ContextVar[Optional[Dict[Tuple[str, str], "asyncio.Task[Any]"]]] = (
+    ContextVar("shared_reads", default=None)
+)
+
+
+@contextmanager
+def shared_reads() -> Iterator[None]:
+    """Read every MO object at most once within the block.
+
+    Reads of the same url on the same date share a single request, and each
+    caller gets its own copy of the result. Nested blocks share the reads of
+    the outermost block.
+    """
+    if _shared_reads.get() is not None:
+        yield
+        return
+    token = _shared_reads.set({})
+    try:
+        yield
+    finally:
+        _shared_reads.reset(token)
+
+
+class SharedReadsRoute(APIRoute):
+    """Route which shares MO reads between the dependencies and the handler."""
+
+    def get_route_handler(self) -> Callable[[Request], Coroutine[Any, Any, Response]]:
+        handler = super().get_route_handler()
+
+        async def shared_reads_handler(request: Request) -> Response:
+            with shared_reads():
+                return await handler(request)
+
+        return shared_reads_handler
+
+
+class AsyncMoraHelper:
+    """Asynchronous counterpart to the MoraHelper methods used by SDMox.
+
+    All lookups share a single keep-alive connection pool, and every call has
+    a timeout. Like MoraHelper, lookups failing with an HTTP or connection
+    error are tried up to attempts times with exponential backoff, as long as
+    the deadline of the current request allows it. Return values have the
+    same shape as the MoraHelper methods with the same names.
+    """
+
+    def __init__(
+        self,
+        hostname: str,
+        timeout: float = 10,
+        pool_size: int = 20,
+        attempts: int = 5,
+        retry_delay: float = 0.5,
+        max_retry_delay: float = 5,
+    ):
+        self.host = hostname + "/service/"
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.attempts = attempts
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._session_loop: Optional[asyncio.AbstractEventLoop] = None
+        self._token_settings: Optional[TokenSettings] = None
+        # The root organisation never changes, so it is read once
+        self._organisation: Optional[str] = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # Sessions are bound to the event loop they were created in
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._session_loop != loop:
+            connector = aiohttp.TCPConnector(limit=self.pool_size)
+            self._session = aiohttp.ClientSession(connector=connector)
+            self._session_loop = loop
+        return self._session
+
+    async def _get_headers(self) -> Dict[str, str]:
+        if self._token_settings is None:
+            self._token_settings = TokenSettings()  # type: ignore[call-arg]
+        # Fetching a new token is a blocking request, keep it off the loop
+        return await asyncio.to_thread(self._token_settings.get_headers)
+
+    async def _mo_lookup(
+        self,
+        uuid: Union[UUID, str, None],
+        url: str,
+        at: Any = None,
+        timeout: Optional[float] = None,
+    ) -> Any:
+        params = {}
+        if at:
+            params["at"] = str(at)
+
+        full_url = self.host + url.format(uuid)
+        reads = _shared_reads.get()
+        if reads is None:
+            return await self._request(full_url, params, timeout)
+
+        key = (full_url, params.get("at", ""))
+        task = reads.get(key)
+        if task is None:
+            task = reads[key] = asyncio.ensure_future(
+                self._request(full_url, params, timeout)
+            )
+        # Callers modify what they read, do not let them share it
+        return copy.deepcopy(await asyncio.shield(task))
+
+    async def _request(
+        self, full_url: str, params: Dict[str, str], timeout: Optional[float]
+    ) -> Any:
+        """Request full_url, retrying HTTP and connection errors with backoff."""
+        delay = self.retry_delay
+        attempt = 1
+        while True:
+            try:
+                return await self._request_once(full_url, params, timeout)
+            except asyncio.TimeoutError:
+                # The timeout is spent already, do not spend it again
+                raise
+            except (aiohttp.ClientResponseError, aiohttp.ClientConnectionError) as e:
+                left = deadline.remaining()
+                if attempt >= self.attempts or (left is not None and left <= delay):
+                    raise
+                get_logger().warning(
+                    "MO lookup failed", url=full_url, error=str(e), retry_in=delay
+                )
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_retry_delay)
+                attempt += 1
+
+    async def _request_once(
+        self, full_url: str, params: Dict[str, str], timeout: Optional[float]
+    ) -> Any:
+        headers = await self._get_headers()
+        # Never wait past the deadline of the current request
+        client_timeout = aiohttp.ClientTimeout(
+            total=deadline.bounded(timeout or self.timeout, operation="MO lookup")
+        )
+
+        session = self._get_session()
+        try:
+            async with session.get(
+                full_url, headers=headers, params=params, timeout=client_timeout
+            ) as response:
+                return await self._read_response(response, headers)
+        except asyncio.TimeoutError:
+            deadline.check("MO lookup")
+            raise
+
+    async def _read_response(
+        self, response: aiohttp.ClientResponse, headers: Dict[str, str]
+    ) -> Any:
+        logger = get_logger()
+
+        if response.status == 401:
+            msg = "Missing Authorization"
+            if headers:
+                msg = "Authorization not accepted"
+            logger.error(msg)
+            response.raise_for_status()
+
+        if response.status == 500 and "has been deleted" not in (await response.text()):
+            response.raise_for_status()
+
+        return await response.json()
+
+    async def read_ou(
+        self, uuid: Union[UUID, str], at: Any = None, timeout: Optional[float] = None
+    ) -> Dict:
+        """Return a dict with the data available about an OU.
+
+        :param uuid: The UUID of the OU
+        :return: Dict with the information about the OU
+        """
+        return await self._mo_lookup(uuid, "ou/{}/", at, timeout=timeout)
+
+    async def read_ou_address(
+        self,
+        uuid: Union[UUID, str],
+        at: Any = None,
+        scope: Optional[str] = "DAR",
+        return_all: bool = False,
+        reformat: bool = True,
+        timeout: Optional[float] = None,
+    ) -> Any:
+        """Return a dict with the data available about an OU.
+
+        :param uuid: The UUID of the OU
+        :param return_all: If True the response will be a list of dicts
+        rather than a dict, and all adresses will be returned.
+        :return: Dict (or list) with the information about the OU
+        """
+
+        def reformat_address(address: Dict) -> Dict:
+            return {
+                "type": address["address_type"]["uuid"],
+                "visibility": address.get("visibility"),
+                # Deprecated spelling mistake....
+                "visibibility": address.get("visibility"),
+                "Adresse": address["name"],
+                "value": address["value"],
+                "uuid": address["uuid"],
+            }
+
+        addresses = await self._mo_lookup(
+            uuid, "ou/{}/details/address", at, timeout=timeout
+        )
+        if scope is not None:
+            addresses = [
+                address
+                for address in addresses
+                if address["address_type"]["scope"] == scope
+            ]
+        if reformat:
+            addresses = list(map(reformat_address, addresses))
+
+        if return_all:
+            return addresses
+        if addresses:
+            return addresses[0]
+        return {}
+
+    async def read_ou_children(
+        self, uuid: Union[UUID, str], at: Any = None, timeout: Optional[float] = None
+    ) -> List[Dict]:
+        """Return the OUs directly below an OU, each with a child_count.
+
+        :param uuid: The UUID of the OU
+        :return: List of dicts with the information about the children
+        """
+        return await self._mo_lookup(uuid, "ou/{}/children", at, timeout=timeout)
+
+    async def read_organisation(self, timeout: Optional[float] = None) -> str:
+        """Read the main Organisation, all OU's will have this as root
+
+        :return: UUID of root organisation
+        """
+        if self._organisation is None:
+            org_id = await self._mo_lookup(None, "o/", timeout=timeout)
+            self._organisation = org_id[0]["uuid"]
+        return self._organisation
+
+    async def read_classes_in_facet(
+        self, facet: str, timeout: Optional[float] = None
+    ) -> Tuple[List[Dict], str]:
+        """Return all classes belong to a given facet.
+
+        :param facet: The facet to be returned.
+        :return: List of classes in the facet and the uuid of the facet.
+        """
+        org_uuid = await self.read_organisation(timeout=timeout)
+        url = "o/" + org_uuid + "/f/{}/"
+        class_list = await self._mo_lookup(facet, url, timeout=timeout)
+        classes = class_list["data"]["items"]
+        facet_uuid = class_list["uuid"]
+        return (classes, facet_uuid)
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+
+_helpers: Dict[Tuple[str, float, int], AsyncMoraHelper] = {}
+
+
+def _helper_key(settings: Settings) -> Tuple[str, float, int]:
+    return (settings.mora_url, settings.mora_timeout, settings.mora_pool_size)
+
+
+def get_async_mora_helper(settings: Settings) -> AsyncMoraHelper:
+    """Return the process-wide MO client for the MO configured in settings."""
+    key = _helper_key(settings)
+    if key not in _helpers:
+        _helpers[key] = AsyncMoraHelper(
+            hostname=settings.mora_url,
+            timeout=settings.mora_timeout,
+            pool_size=settings.mora_pool_size,
+        )
+    return _helpers[key]
+
+
+async def close_async_mora_helpers(keep: Optional[Settings] = None) -> None:
+    """Close all MO clients, used on application shutdown.
+
+    With keep, the client for the settings keep is left open.
+    """
+    kept = _helper_key(keep) if keep is not None else None
+    helpers = [helper for key, helper in _helpers.items() if key != kept]
+    for key in [key for key in _helpers if key != kept]:
+        del _helpers[key]
+    for helper in helpers:
+        await helper.close()
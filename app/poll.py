@@ -0,0 +1,71 @@
+# SPDX-FileCopyrightText: Magenta ApS
+#
+# SPDX-License-Identifier: MPL-2.0
+
+import random
+from collections import deque
+from typing import Callable, Deque, Iterator, Optional
+
+
+class PollSchedule:
+    """Delays between attempts at verifying a change in SD.
+
+    The first delay is short, every following delay is factor times longer
+    up to max_delay. Each delay is spread by +/- jitter (a fraction of the
+    delay), so concurrent verifications do not probe SD in lockstep.
+
+    The schedule itself is infinite, callers stop at their own deadline.
+    """
+
+    def __init__(
+        self,
+        first_delay: float,
+        factor: float = 2,
+        max_delay: float = 5,
+        jitter: float = 0.1,
+        rng: Callable[[], float] = random.random,
+    ):
+        self.first_delay = first_delay
+        self.factor = factor
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.rng = rng
+
+    def delays(self, first_delay: Optional[float] = None) -> Iterator[float]:
+        """Yield delays, starting with first_delay if given."""
+        delay = first_delay if first_delay is not None else self.first_delay
+        while True:
+            spread = 1 + self.jitter * (2 * self.rng() - 1)
+            yield max(0.0, delay * spread)
+            delay = min(delay * self.factor, self.max_delay)
+
+
+class ApplyLatency:
+    """Estimated time from publishing a change until SD has applied it.
+
+    Keeps the most recent samples and suggests a first probe delay at the
+    given quantile of them, clamped to [minimum, maximum].
+    """
+
+    def __init__(
+        self,
+        minimum: float,
+        maximum: float,
+        quantile: float = 0.5,
+        window: int = 50,
+    ):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.quantile = quantile
+        self.samples: Deque[float] = deque(maxlen=window)
+
+    def record(self, latency: float) -> None:
+        self.samples.append(latency)
+
+    def first_delay(self) -> Optional[float]:
+        """Return the suggested first probe delay, or None without samples."""
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        index = min(int(self.quantile * len(ordered)), len(ordered) - 1)
+        return min(max(ordered[index], self.minimum), self.maximum)
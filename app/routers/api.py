@@ -6,7 +6,6 @@ from typing import Optional
 from uuid import UUID
 
 from fastapi import APIRouter, Depends, FastAPI, Path, Query
-from os2mo_helpers.mora_helpers import MoraHelper
 
 from app.dependencies import (
     _ou_edit_name,
@@ -15,17 +14,18 @@ from app.dependencies import (
     _verify_ou_ok_responses,
     get_date,
 )
+from app.mo import AsyncMoraHelper, SharedReadsRoute
 from app.util import first_of_month, get_mora_helper_default
 
-router = APIRouter()
+router = APIRouter(route_class=SharedReadsRoute)
 
 
-def verify_ou_ok(
+async def verify_ou_ok(
     uuid: UUID,
     at: date = Depends(get_date),
-    mora_helper: MoraHelper = Depends(get_mora_helper_default),
+    mora_helper: AsyncMoraHelper = Depends(get_mora_helper_default),
 ):
-    _verify_ou_ok(uuid, at, mora_helper)
+    await _verify_ou_ok(uuid, at, mora_helper)
 
 
 @router.patch(
@@ -2,7 +2,7 @@
 #
 # SPDX-License-Identifier: MPL-2.0
 from datetime import date, datetime
-from typing import List, Optional
+from typing import Any, Callable, Coroutine, List, Optional
 from uuid import UUID
 
 from fastapi import (
@@ -13,16 +13,22 @@ from fastapi import (
     Path,
     Query,
     Request,
+    Response,
     status,
 )
-from os2mo_helpers.mora_helpers import MoraHelper
+from fastapi.responses import JSONResponse
 
+from app.config import get_settings
+from app.deadline import DeadlineRoute
 from app.dependencies import (
+    OUT_OF_SCOPE,
     _ou_edit_name,
+    _ou_edit_name_and_parent,
     _ou_edit_parent,
     _verify_ou_ok,
     _verify_ou_ok_responses,
 )
+from app.mo import AsyncMoraHelper, SharedReadsRoute
 from app.models import (
     EventType,
     MOTriggerPayload,
@@ -33,21 +39,93 @@ from app.models import (
     MOTriggerRegister,
     RequestType,
 )
-from app.sd_mox import SDMox, SDMoxInterface
+from app.scope import get_scope_index
+from app.sd_mox import SDMoxInterface, get_sdmox
 from app.util import get_mora_helper_default
 
-router = APIRouter()
+Prefilter = Callable[[Any], Optional[Response]]
 
 
-def verify_ou_ok_trigger(
+def prefilter(check: Prefilter) -> Callable[[Callable], Callable]:
+    """Answer requests to the decorated endpoint from the raw body if possible.
+
+    check is given the JSON body before it is validated, and returns either a
+    response, or None to leave the request to the endpoint. See TriggerRoute.
+    """
+
+    def decorator(endpoint: Callable) -> Callable:
+        endpoint.prefilter = check  # type: ignore[attr-defined]
+        return endpoint
+
+    return decorator
+
+
+class TriggerRoute(DeadlineRoute, SharedReadsRoute):
+    """Route for MO triggers.
+
+    Every request must be answered before MO stops waiting for it, and reads
+    each object from MO at most once. Endpoints decorated with prefilter can
+    answer requests before the payload is validated.
+    """
+
+    def get_route_handler(self) -> Callable[[Request], Coroutine[Any, Any, Response]]:
+        handler = super().get_route_handler()
+        check: Optional[Prefilter] = getattr(self.endpoint, "prefilter", None)
+        if check is None:
+            return handler
+
+        async def prefilter_handler(request: Request) -> Response:
+            try:
+                # The parsed body is kept on the request for the endpoint
+                body = await request.json()
+            except ValueError:
+                return await handler(request)
+            response = check(body)
+            if response is not None:
+                return response
+            return await handler(request)
+
+        return prefilter_handler
+
+
+router = APIRouter(route_class=TriggerRoute)
+
+
+def address_prefilter(body: Any) -> Optional[Response]:
+    """Answer address triggers for employees, and for units known out of scope."""
+    request = body.get("request") if isinstance(body, dict) else None
+    org_unit = request.get("org_unit") if isinstance(request, dict) else None
+    if request is None or not (org_unit is None or isinstance(org_unit, dict)):
+        return None
+
+    unit_uuid = (org_unit or {}).get("uuid")
+    if not unit_uuid:  # Probably an employee address
+        return JSONResponse({"status": "NOOP"})
+    try:
+        validity = (request.get("data") or request)["validity"]
+        at = datetime.strptime(validity["from"], "%Y-%m-%d").date()
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None  # Leave it to the endpoint
+    if get_scope_index(get_settings()).in_scope(unit_uuid, at) is False:
+        return JSONResponse({"detail": OUT_OF_SCOPE})
+    return None
+
+
+async def verify_ou_ok_trigger(
     payload: MOTriggerPayload,
-    mora_helper: MoraHelper = Depends(get_mora_helper_default),
+    mora_helper: AsyncMoraHelper = Depends(get_mora_helper_default),
 ):
     uuid = payload.uuid
     data = payload.request["data"]
 
-    at = data["validity"]["from"]
-    _verify_ou_ok(uuid, at, mora_helper)
+    at = datetime.strptime(data["validity"]["from"], "%Y-%m-%d").date()
+    try:
+        await _verify_ou_ok(uuid, at, mora_helper)
+    except HTTPException as e:
+        # MO goes ahead with changes outside the allow list, follow moves
+        if e.status_code == status.HTTP_200_OK and "parent" in data:
+            get_scope_index(get_settings()).add(uuid, data["parent"]["uuid"], at)
+        raise
 
 
 @router.get(
@@ -73,7 +151,7 @@ def triggers(request: Request) -> List[MOTriggerRegister]:
             request_type=request_type,
             role_type=role_type,
             url="/triggers/" + str(role_type) + "/" + str(request_type.value),
-            timeout=60,
+            timeout=get_settings().trigger_timeout,
         )
         for request_type, role_type in triggers
     ]
@@ -95,7 +173,7 @@ async def triggers_ou_create(
     # Thus we cannot accept requests with no parent set, or the parent set to the
     # root organization.
     parent_uuid = (payload.request.get("parent") or {}).get("uuid")
-    o_uuid = mora_helper.read_organisation()
+    o_uuid = await mora_helper.read_organisation()
     if not parent_uuid or parent_uuid == o_uuid:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
@@ -104,14 +182,16 @@ async def triggers_ou_create(
 
     # We will never create an organization under a non-triggered uuid.
     at = datetime.strptime(payload.request["validity"]["from"], "%Y-%m-%d").date()
-    _verify_ou_ok(parent_uuid, at, mora_helper)
+    await _verify_ou_ok(parent_uuid, at, mora_helper)
 
     # Preconditions have been checked, time to try to create the organizational unit
     uuid = payload.uuid
     unit_data = payload.request
-    parent_data = mora_helper.read_ou(parent_uuid, at=at)
-    mox: SDMoxInterface = SDMox(from_date=at)
-    await mox.create_unit(uuid, unit_data, parent_data, dry_run=dry_run)
+    parent_data = await mora_helper.read_ou(parent_uuid, at=at)
+    mox: SDMoxInterface = get_sdmox()
+    await mox.create_unit(uuid, unit_data, parent_data, at, dry_run=dry_run)
+    if not dry_run:
+        get_scope_index(get_settings()).add(uuid, parent_uuid, at)
 
     return {"status": "OK"}
 
@@ -134,14 +214,22 @@ async def triggers_ou_edit(
 
     at = datetime.strptime(data["validity"]["from"], "%Y-%m-%d").date()
 
-    if "name" in data:
+    if "name" in data and "parent" in data:
+        # Publish and verify both changes together
+        new_name = data["name"]
+        new_parent_uuid = data["parent"]["uuid"]
+        await _ou_edit_name_and_parent(
+            uuid, new_name, new_parent_uuid, at, dry_run=dry_run
+        )
+    elif "name" in data:
         new_name = data["name"]
         await _ou_edit_name(uuid, new_name, at, dry_run=dry_run)
-
-    if "parent" in data:
+    elif "parent" in data:
         new_parent_obj = data["parent"]
         new_parent_uuid = new_parent_obj["uuid"]
         await _ou_edit_parent(uuid, new_parent_uuid, at, dry_run=dry_run)
+    if "parent" in data and not dry_run:
+        get_scope_index(get_settings()).add(uuid, data["parent"]["uuid"], at)
     return {"status": "OK"}
 
 
@@ -149,6 +237,7 @@ async def triggers_ou_edit(
     "/address/" + str(RequestType.CREATE.value),
     summary="Create an addresses.",
 )
+@prefilter(address_prefilter)
 async def triggers_address_create(
     payload: MOTriggerPayloadAddressCreate,
     dry_run: Optional[bool] = Query(False, description="Dry run the operation."),
@@ -163,11 +252,11 @@ async def triggers_address_create(
     # We will never create an addresses for units outside non-triggered uuid.
     # TODO: Consider whether we should block inserts in these cases, probably not
     at = datetime.strptime(payload.request["validity"]["from"], "%Y-%m-%d").date()
-    _verify_ou_ok(unit_uuid, at, mora_helper)
+    await _verify_ou_ok(unit_uuid, at, mora_helper)
 
     # Preconditions have been checked, time to try to create the organizational unit
     address_data = payload.request
-    mox: SDMoxInterface = SDMox(from_date=at)
+    mox: SDMoxInterface = get_sdmox()
     await mox.create_address(unit_uuid, address_data, at, dry_run=dry_run)
 
     return {"status": "OK"}
@@ -177,6 +266,7 @@ async def triggers_address_create(
     "/address/" + str(RequestType.EDIT.value),
     summary="Edit an address.",
 )
+@prefilter(address_prefilter)
 async def triggers_address_edit(
     payload: MOTriggerPayloadAddressEdit,
     dry_run: Optional[bool] = Query(False, description="Dry run the operation."),
@@ -193,11 +283,11 @@ async def triggers_address_edit(
     at = datetime.strptime(
         payload.request["data"]["validity"]["from"], "%Y-%m-%d"
     ).date()
-    _verify_ou_ok(unit_uuid, at, mora_helper)
+    await _verify_ou_ok(unit_uuid, at, mora_helper)
 
     # Preconditions have been checked, time to try to create the organizational unit
     address_data = payload.request["data"]
-    mox: SDMoxInterface = SDMox(from_date=at)
+    mox: SDMoxInterface = get_sdmox()
     await mox.edit_address(unit_uuid, address_data, at, dry_run=dry_run)
 
     return {"status": "OK"}
@@ -0,0 +1,274 @@
+# SPDX-FileCopyrightText: Magenta ApS
+#
+# SPDX-License-Identifier: MPL-2.0
+
+import asyncio
+import time
+from collections import defaultdict
+from datetime import date
+from typing import (
+    Callable,
+    DefaultDict,
+    Dict,
+    FrozenSet,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+from uuid import UUID
+
+from structlog import get_logger
+
+from app.config import Settings
+from app.mo import AsyncMoraHelper
+
+
+class ScopeIndex:
+    """Which units are within the subtrees of triggered_uuids, as known so far.
+
+    The index holds units with their parents, and every unit in it has its
+    whole chain of parents in it too. Units are learned from the triggered
+    subtrees loaded from MO (see load), from OUs read from MO (see learn)
+    and from the create and move triggers (see add). in_scope answers None
+    for units not in the index, in which case MO must be asked.
+
+    Every unit is recorded with the date it holds from: the effective date
+    of a trigger, or the date it was read from MO. in_scope answers None at
+    dates before that of the unit or a unit above it, so a future-dated move
+    only changes the scope from its date, and dates in the past are checked
+    in MO. Units out of scope are only trusted for negative_ttl seconds after
+    they were recorded, as moves into scope may be missed.
+    """
+
+    def __init__(
+        self,
+        triggered_uuids: FrozenSet[UUID],
+        negative_ttl: float = 300,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.triggered = {str(uuid) for uuid in triggered_uuids}
+        self.negative_ttl = negative_ttl
+        self.clock = clock
+        self._parent: Dict[str, Optional[str]] = {}
+        self._children: DefaultDict[str, Set[str]] = defaultdict(set)
+        self._in_scope: Set[str] = set()
+        self._recorded: Dict[str, float] = {}
+        self._since: Dict[str, date] = {}
+        self._loading: Optional["asyncio.Task[None]"] = None
+        # Units added or forgotten while load runs, which it must not undo
+        self._changed: Optional[Set[str]] = None
+
+    def __len__(self) -> int:
+        return len(self._parent)
+
+    def in_scope(
+        self, unit_uuid: Union[UUID, str], at: Optional[date] = None
+    ) -> Optional[bool]:
+        """Return whether unit_uuid is in scope at the date at, default today.
+
+        None is returned if it is unknown at that date.
+        """
+        unit_uuid = str(unit_uuid)
+        if unit_uuid not in self._parent:
+            return None
+        if not self._holds_at(unit_uuid, at or date.today()):
+            return None
+        if unit_uuid in self._in_scope:
+            return True
+        if self.clock() - self._recorded[unit_uuid] > self.negative_ttl:
+            if not self._children.get(unit_uuid):
+                self._forget(unit_uuid)
+            return None
+        return False
+
+    def _holds_at(self, unit_uuid: str, at: date) -> bool:
+        """Return whether unit_uuid and its chain of parents hold at at."""
+        uuid: Optional[str] = unit_uuid
+        while uuid is not None:
+            since = self._since.get(uuid)
+            if since is not None and since > at:
+                return False
+            uuid = self._parent[uuid]
+        return True
+
+    def add(
+        self,
+        unit_uuid: Union[UUID, str],
+        parent_uuid: Union[UUID, str, None],
+        at: Optional[date] = None,
+    ) -> None:
+        """Record unit_uuid as created or moved under parent_uuid from at."""
+        unit_uuid = str(unit_uuid)
+        if self._changed is not None:
+            self._changed.add(unit_uuid)
+        self._add(unit_uuid, parent_uuid, at)
+
+    def _add(
+        self,
+        unit_uuid: str,
+        parent_uuid: Union[UUID, str, None],
+        at: Optional[date] = None,
+    ) -> None:
+        parent = str(parent_uuid) if parent_uuid is not None else None
+        if parent is not None and parent not in self._parent:
+            # The new parent is unknown, and so is the scope of the unit now
+            self._forget(unit_uuid)
+            return
+
+        if unit_uuid in self._parent:
+            previous = self._parent[unit_uuid]
+            if previous is not None:
+                self._children[previous].discard(unit_uuid)
+        self._parent[unit_uuid] = parent
+        self._recorded[unit_uuid] = self.clock()
+        self._since[unit_uuid] = at or date.today()
+        if parent is not None:
+            self._children[parent].add(unit_uuid)
+
+        # Update the scope of the unit and everything below it
+        pending = [(unit_uuid, parent is not None and parent in self._in_scope)]
+        while pending:
+            uuid, parent_in_scope = pending.pop()
+            in_scope = parent_in_scope or uuid in self.triggered
+            if in_scope:
+                self._in_scope.add(uuid)
+            else:
+                self._in_scope.discard(uuid)
+            pending.extend((child, in_scope) for child in self._children[uuid])
+
+    def forget(self, unit_uuid: Union[UUID, str]) -> None:
+        """Remove unit_uuid and everything below it from the index."""
+        unit_uuid = str(unit_uuid)
+        if self._changed is not None:
+            self._changed.add(unit_uuid)
+        self._forget(unit_uuid)
+
+    def _forget(self, unit_uuid: str) -> None:
+        if unit_uuid not in self._parent:
+            return
+        parent = self._parent[unit_uuid]
+        if parent is not None:
+            self._children[parent].discard(unit_uuid)
+        pending = [unit_uuid]
+        while pending:
+            uuid = pending.pop()
+            pending.extend(self._children.pop(uuid, ()))
+            del self._parent[uuid]
+            del self._recorded[uuid]
+            self._since.pop(uuid, None)
+            self._in_scope.discard(uuid)
+
+    def learn(self, mo_ou: Optional[dict], at: Optional[date] = None) -> None:
+        """Add an OU read from MO at at, with its nested chain of parents."""
+        for unit_uuid, parent in _chain(mo_ou):
+            if self._changed is not None:
+                self._changed.add(unit_uuid)
+            self._learn(unit_uuid, parent, at)
+
+    def _learn(self, unit_uuid: str, parent: Optional[str], at: Optional[date]) -> None:
+        """Add a unit read from MO at at, unless a later change is known."""
+        at = at or date.today()
+        if at < date.today():
+            # The unit may have changed since then
+            return
+        since = self._since.get(unit_uuid)
+        if since is not None and since > at:
+            return
+        if unit_uuid in self._parent and self._parent[unit_uuid] == parent:
+            # Nothing new, but the unit was seen again
+            self._recorded[unit_uuid] = self.clock()
+            return
+        self._add(unit_uuid, parent, at)
+
+    def _load(self, unit_uuid: str, parent: Optional[str]) -> None:
+        """Add a unit read by load, unless it changed since load began."""
+        if self._changed is None or unit_uuid not in self._changed:
+            self._learn(unit_uuid, parent, None)
+
+    async def load(self, mora_helper: AsyncMoraHelper) -> None:
+        """Load the triggered subtrees from MO.
+
+        Units added or forgotten while loading are newer than what load read
+        from MO, and are left as they are.
+        """
+        self._changed = set()
+        try:
+            await self._load_subtrees(mora_helper)
+        finally:
+            self._changed = None
+        get_logger().info("Scope index loaded", units=len(self))
+
+    async def _load_subtrees(self, mora_helper: AsyncMoraHelper) -> None:
+        roots = await asyncio.gather(
+            *(mora_helper.read_ou(uuid) for uuid in self.triggered)
+        )
+        for root in roots:
+            if "error_key" not in root:
+                for unit_uuid, parent in _chain(root):
+                    self._load(unit_uuid, parent)
+
+        level = [root["uuid"] for root in roots if "error_key" not in root]
+        while level:
+            children = await asyncio.gather(
+                *(mora_helper.read_ou_children(uuid) for uuid in level)
+            )
+            parents, level = level, []
+            for parent, units in zip(parents, children):
+                for unit in units:
+                    self._load(unit["uuid"], parent)
+                    if unit.get("child_count", 1):
+                        level.append(unit["uuid"])
+
+    def start(self, mora_helper: AsyncMoraHelper) -> None:
+        """Load the triggered subtrees in the background."""
+
+        def log_failure(task: "asyncio.Task[None]") -> None:
+            if not task.cancelled() and task.exception() is not None:
+                get_logger().warning(
+                    "Loading scope index failed", error=str(task.exception())
+                )
+
+        if self._loading is None:
+            self._loading = asyncio.ensure_future(self.load(mora_helper))
+            self._loading.add_done_callback(log_failure)
+
+    async def close(self) -> None:
+        if self._loading is not None:
+            self._loading.cancel()
+            await asyncio.gather(self._loading, return_exceptions=True)
+
+
+def _chain(mo_ou: Optional[dict]) -> Iterator[Tuple[str, Optional[str]]]:
+    """Yield the units of an OU read from MO with their parents, top first."""
+    chain: List[dict] = []
+    while mo_ou and mo_ou.get("uuid"):
+        chain.append(mo_ou)
+        mo_ou = mo_ou.get("parent")
+    parent = None
+    for ou in reversed(chain):
+        yield ou["uuid"], parent
+        parent = ou["uuid"]
+
+
+_indexes: Dict[Tuple, ScopeIndex] = {}
+
+
+def get_scope_index(settings: Settings) -> ScopeIndex:
+    """Return the process-wide scope index for the triggered_uuids in settings."""
+    key = (settings.triggered_uuids, settings.scope_negative_ttl)
+    if key not in _indexes:
+        _indexes[key] = ScopeIndex(
+            settings.triggered_uuids, negative_ttl=settings.scope_negative_ttl
+        )
+    return _indexes[key]
+
+
+async def close_scope_indexes() -> None:
+    """Stop loading scope indexes, used on application shutdown."""
+    indexes = list(_indexes.values())
+    _indexes.clear()
+    for index in indexes:
+        await index.close()
@@ -0,0 +1,326 @@
+# SPDX-FileCopyrightText: Magenta ApS
+#
+# SPDX-License-Identifier: MPL-2.0
+
+import asyncio
+import time
+from collections import OrderedDict, defaultdict
+from datetime import date
+from functools import partial
+from typing import Any, Awaitable, Callable, DefaultDict, Dict, List, Optional
+from typing import OrderedDict as OrderedDictType
+from typing import Set, Tuple, TypeVar
+
+from sd_connector import SDConnector
+from structlog import get_logger
+
+
+def _as_list(value: Any) -> List[dict]:
+    """SD returns a dict instead of a list when there is a single element."""
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return value
+    return [value]
+
+
+T = TypeVar("T")
+
+
+class SDSnapshot:
+    """Departments and parent relations in SD on a single date, with indexes."""
+
+    def __init__(self, departments: List[dict], organization: List[dict]):
+        self.by_uuid: Dict[str, dict] = {}
+        self.by_identifier: DefaultDict[str, List[dict]] = defaultdict(list)
+        self.by_level: DefaultDict[str, List[dict]] = defaultdict(list)
+        for department in departments:
+            self.by_uuid[department["DepartmentUUIDIdentifier"]] = department
+            self.by_identifier[department["DepartmentIdentifier"]].append(department)
+            self.by_level[department["DepartmentLevelIdentifier"]].append(department)
+
+        self.parent_by_uuid: Dict[str, Optional[str]] = {}
+        for reference in organization:
+            self._add_parents(reference)
+
+        # Units being changed in SD, which the snapshot cannot answer for
+        self.stale_uuids: Set[str] = set()
+        self.stale_codes: Set[str] = set()
+
+    def _add_parents(self, reference: Optional[dict]) -> None:
+        # References nest from a department towards the top of the organisation
+        while reference is not None:
+            uuid = reference["DepartmentUUIDIdentifier"]
+            if uuid in self.parent_by_uuid:
+                return
+            parent = reference.get("DepartmentReference")
+            self.parent_by_uuid[uuid] = (
+                parent["DepartmentUUIDIdentifier"] if parent else None
+            )
+            reference = parent
+
+    def find(
+        self,
+        unit_code: Optional[str] = None,
+        unit_uuid: Optional[str] = None,
+        unit_level: Optional[str] = None,
+    ) -> List[dict]:
+        """Return departments matching like getDepartment would."""
+        if unit_uuid is not None:
+            department = self.by_uuid.get(str(unit_uuid))
+            candidates = [department] if department is not None else []
+        elif unit_code is not None:
+            candidates = self.by_identifier.get(unit_code, [])
+        elif unit_level is not None:
+            return list(self.by_level.get(unit_level, []))
+        else:
+            candidates = list(self.by_uuid.values())
+        if unit_level is not None:
+            candidates = [
+                department
+                for department in candidates
+                if department["DepartmentLevelIdentifier"] == unit_level
+            ]
+        return list(candidates)
+
+    def parent(self, unit_uuid: str) -> Optional[str]:
+        """Return the uuid of the parent of unit_uuid, or None."""
+        return self.parent_by_uuid.get(str(unit_uuid))
+
+    def knows(
+        self, unit_code: Optional[str] = None, unit_uuid: Optional[str] = None
+    ) -> bool:
+        """Return whether find answers for the unit, as it is not being changed.
+
+        Lookups by level alone are only answered with no unit being changed.
+        """
+        if unit_uuid is not None:
+            return str(unit_uuid) not in self.stale_uuids
+        if unit_code is not None:
+            return unit_code not in self.stale_codes
+        return not (self.stale_uuids or self.stale_codes)
+
+    def mark_stale(
+        self, unit_uuid: Optional[str] = None, unit_code: Optional[str] = None
+    ) -> None:
+        """Stop answering for a unit being changed, until it is patched."""
+        if unit_uuid is not None:
+            self.stale_uuids.add(str(unit_uuid))
+            department = self.by_uuid.get(str(unit_uuid))
+            if department is not None:
+                # Its current code no longer answers for it either
+                self.stale_codes.add(department["DepartmentIdentifier"])
+        if unit_code is not None:
+            self.stale_codes.add(unit_code)
+
+    def patch(self, department: dict, parent: Optional[str] = None) -> None:
+        """Replace a unit with department as read from SD, and answer for it again.
+
+        With parent, the unit is also moved below the unit with that uuid.
+        """
+        uuid = department["DepartmentUUIDIdentifier"]
+        old = self.by_uuid.get(uuid)
+        if old is not None:
+            old_code = old["DepartmentIdentifier"]
+            self.by_identifier[old_code].remove(old)
+            self.by_level[old["DepartmentLevelIdentifier"]].remove(old)
+            self.stale_codes.discard(old_code)
+        self.by_uuid[uuid] = department
+        self.by_identifier[department["DepartmentIdentifier"]].append(department)
+        self.by_level[department["DepartmentLevelIdentifier"]].append(department)
+        if parent is not None:
+            self.parent_by_uuid[uuid] = str(parent)
+        self.stale_uuids.discard(uuid)
+        self.stale_codes.discard(department["DepartmentIdentifier"])
+
+
+class SDMirror:
+    """In-process mirror of the departments in SD.
+
+    Snapshots are taken per effective date, from a single getDepartment and
+    getOrganization call, as sd_tree_org does. A snapshot older than max_age
+    is not served; instead a refresh is started in the background and the
+    caller is expected to fall back to reading SD directly.
+
+    Whenever a change is published to SD, invalidate marks the unit stale in
+    the snapshots of its effective date and later, and the snapshots stop
+    answering for it. Once SD has applied the change, settle patches the
+    unit into the snapshot of that date from the department verified in SD,
+    instead of reading the whole organisation again. The periodic refresh
+    replaces the snapshots, including units left stale. Reads of SD share
+    the limit on concurrent reads with SDMox.
+
+    Only the max_dates most recently used dates are kept, and refreshed
+    periodically. The snapshot of a date falling out is dropped.
+    """
+
+    def __init__(
+        self,
+        sd_connector: SDConnector,
+        max_age: float,
+        clock: Callable[[], float] = time.monotonic,
+        max_dates: int = 4,
+        limit: Optional[asyncio.Semaphore] = None,
+    ):
+        self.sd_connector = sd_connector
+        self.max_age = max_age
+        self.clock = clock
+        self.max_dates = max_dates
+        self.limit = limit
+
+        self._snapshots: Dict[date, Tuple[float, SDSnapshot]] = {}
+        self._refreshing: Dict[date, Tuple[int, "asyncio.Task[SDSnapshot]"]] = {}
+        # Dates in order of use, the most recently used last
+        self._dates: OrderedDictType[date, None] = OrderedDict()
+        self._generation = 0
+        # Units published but not yet settled, with their effective dates and
+        # when they were published. Units never settled expire after max_age.
+        self._unsettled: Dict[
+            Tuple[Optional[str], Optional[str]], Tuple[date, float]
+        ] = {}
+        self._periodic: Optional["asyncio.Task[None]"] = None
+
+    def snapshot(self, at: date) -> Optional[SDSnapshot]:
+        """Return a fresh snapshot for at, or None if there is none yet."""
+        self._use(at)
+        entry = self._snapshots.get(at)
+        if entry is not None:
+            loaded_at, snapshot = entry
+            if self.clock() - loaded_at < self.max_age:
+                return snapshot
+        self.refresh_soon(at)
+        return None
+
+    def _use(self, at: date) -> None:
+        """Mark at as the most recently used date, forgetting the oldest."""
+        self._dates[at] = None
+        self._dates.move_to_end(at)
+        while len(self._dates) > self.max_dates:
+            evicted, _ = self._dates.popitem(last=False)
+            self._snapshots.pop(evicted, None)
+            running = self._refreshing.pop(evicted, None)
+            if running is not None:
+                running[1].cancel()
+
+    async def refresh(self, at: date) -> SDSnapshot:
+        """Read SD on the date at, and store the snapshot."""
+        if at not in self._dates:
+            self._use(at)
+        generation = self._generation
+        department_response, organization_response = await asyncio.gather(
+            self._limited(
+                partial(self.sd_connector.getDepartment, start_date=at, end_date=at)
+            ),
+            self._limited(
+                partial(self.sd_connector.getOrganization, start_date=at, end_date=at)
+            ),
+        )
+        organization = organization_response.get("Organization") or {}
+        snapshot = SDSnapshot(
+            _as_list(department_response.get("Department")),
+            _as_list(organization.get("DepartmentReference")),
+        )
+        for key, (changed_at, published) in list(self._unsettled.items()):
+            if self.clock() - published > self.max_age:
+                del self._unsettled[key]
+            elif changed_at <= at:
+                snapshot.mark_stale(*key)
+        # Do not store a snapshot taken before a change was published, or
+        # for a date no longer in use
+        if generation == self._generation and at in self._dates:
+            self._snapshots[at] = (self.clock(), snapshot)
+        get_logger().debug(
+            "SD mirror refreshed", at=at, departments=len(snapshot.by_uuid)
+        )
+        return snapshot
+
+    def refresh_soon(self, at: Optional[date] = None) -> None:
+        """Refresh the snapshot for at, or all known dates, in the background."""
+        if at is not None:
+            self._use(at)
+        for refresh_date in [at] if at is not None else list(self._dates):
+            running = self._refreshing.get(refresh_date)
+            if running is not None and running[0] == self._generation:
+                continue
+            task = asyncio.ensure_future(self.refresh(refresh_date))
+            self._refreshing[refresh_date] = (self._generation, task)
+            task.add_done_callback(partial(self._refreshed, refresh_date))
+
+    def _refreshed(self, at: date, task: "asyncio.Task[SDSnapshot]") -> None:
+        running = self._refreshing.get(at)
+        if running is not None and running[1] is task:
+            del self._refreshing[at]
+        if not task.cancelled() and task.exception() is not None:
+            get_logger().warning(
+                "SD mirror refresh failed", at=at, error=str(task.exception())
+            )
+
+    async def _limited(self, read: Callable[[], Awaitable[T]]) -> T:
+        if self.limit is None:
+            return await read()
+        async with self.limit:
+            return await read()
+
+    def invalidate(
+        self,
+        at: Optional[date] = None,
+        unit_uuid: Optional[str] = None,
+        unit_code: Optional[str] = None,
+    ) -> None:
+        """Mark a unit changed from at as stale, and discard refreshes in flight.
+
+        Without a unit or a date all snapshots are dropped.
+        """
+        self._generation += 1
+        if at is None or (unit_uuid is None and unit_code is None):
+            self._snapshots.clear()
+            return
+        unit_uuid = str(unit_uuid) if unit_uuid is not None else None
+        key = (unit_uuid, unit_code)
+        earlier, _ = self._unsettled.get(key, (at, 0.0))
+        self._unsettled[key] = (min(at, earlier), self.clock())
+        for snapshot_date, (_, snapshot) in self._snapshots.items():
+            if snapshot_date >= at:
+                snapshot.mark_stale(unit_uuid, unit_code)
+
+    def settle(
+        self,
+        at: date,
+        unit_uuid: Optional[str] = None,
+        unit_code: Optional[str] = None,
+        department: Optional[dict] = None,
+        parent: Optional[str] = None,
+    ) -> None:
+        """Record that a change published for a unit is done with.
+
+        With department, as verified in SD on the date at, it is patched into
+        the snapshot of that date. Snapshots of later dates, and those of a
+        change that failed, leave the unit stale until they are refreshed.
+        """
+        unit_uuid = str(unit_uuid) if unit_uuid is not None else None
+        self._unsettled.pop((unit_uuid, unit_code), None)
+        entry = self._snapshots.get(at)
+        if department is not None and entry is not None:
+            entry[1].patch(department, parent)
+
+    def start(self, interval: float) -> None:
+        """Refresh all known dates every interval seconds."""
+
+        async def refresh_periodically() -> None:
+            while True:
+                await asyncio.sleep(interval)
+                self.refresh_soon()
+
+        if self._periodic is None:
+            self._periodic = asyncio.ensure_future(refresh_periodically())
+
+    async def close(self) -> None:
+        tasks: List["asyncio.Future[Any]"] = [
+            task for _, task in self._refreshing.values()
+        ]
+        if self._periodic is not None:
+            tasks.append(self._periodic)
+            self._periodic = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -8,21 +8,26 @@ from abc import ABC, abstractmethod
 from collections import OrderedDict
 from datetime import date, datetime, time
 from operator import itemgetter
-from typing import Any, Callable, Dict, List, Optional
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
 from typing import OrderedDict as OrderedDictType
 from typing import Tuple, cast
 from uuid import UUID
+from weakref import WeakValueDictionary
 
-import pika
-import requests
 import xmltodict
-from os2mo_helpers.mora_helpers import MoraHelper
 from sd_connector import SDConnector
 from structlog import get_logger
 
 import app.sd_mox_payloads as smp
+from app import deadline
+from app.amqp import AMQPPublisher, get_amqp_publisher
+from app.cache import AsyncTTLCache
 from app.config import Settings, get_settings
-from app.util import get_mora_helper
+from app.dar import BaseDARResolver, DARLookupError, DARRecord, get_dar_resolver
+from app.mo import AsyncMoraHelper, get_async_mora_helper
+from app.poll import ApplyLatency, PollSchedule
+from app.sd_mirror import SDMirror
+from app.util import first_of_month
 
 
 class SDMoxError(Exception):
@@ -32,6 +37,37 @@ class SDMoxError(Exception):
         Exception.__init__(self, "SD-Mox: " + str(message))
 
 
+async def _wait_for(awaitable, timeout, operation):
+    """Await a call to SD or AMQP under the deadline, for at most timeout.
+
+    A call outliving its own timeout is an SDMoxError naming the call, while
+    running out of the request deadline stays a DeadlineExceeded.
+    """
+    try:
+        return await deadline.wait_for(awaitable, timeout, operation=operation)
+    except asyncio.TimeoutError:
+        raise SDMoxError(f"Intet svar inden for {timeout} sekunder under {operation}")
+
+
+class UnitProjection(NamedTuple):
+    """What SD is told about a unit in a ret message, as read from MO.
+
+    The first address of a scope or address type decides the value sent to
+    SD, see SDMox._project_unit. dar_id is the id of the postal address,
+    and adresse the address it resolved to.
+    """
+
+    unit_name: str
+    unit_code: str
+    unit_uuid: str
+    phone: Optional[str] = None
+    pnummer: Optional[str] = None
+    dar_id: Optional[str] = None
+    adresse: Optional[DARRecord] = None
+    formaalskode: Optional[str] = None
+    skolekode: Optional[str] = None
+
+
 class SDMoxInterface(ABC):
     @abstractmethod
     async def rename_unit(
@@ -45,9 +81,25 @@ class SDMoxInterface(ABC):
     ):
         raise NotImplementedError()
 
+    @abstractmethod
+    async def rename_and_move_unit(
+        self,
+        unit_uuid: UUID,
+        new_unit_name: str,
+        new_parent_uuid: UUID,
+        at: date,
+        dry_run: bool = False,
+    ):
+        raise NotImplementedError()
+
     @abstractmethod
     async def create_unit(
-        self, unit_uuid: UUID, unit_data: dict, parent_data: dict, dry_run: bool = False
+        self,
+        unit_uuid: UUID,
+        unit_data: dict,
+        parent_data: dict,
+        at: date,
+        dry_run: bool = False,
     ):
         raise NotImplementedError()
 
@@ -65,10 +117,15 @@ class SDMoxInterface(ABC):
 
 
 class SDMox(SDMoxInterface):
+    """Make changes in SD on behalf of MO.
+
+    An instance holds no per-request state, the effective date of a change is
+    given to every operation. A single instance can therefore be shared by all
+    concurrent requests, see get_sdmox.
+    """
+
     def __init__(
         self,
-        from_date: Optional[date] = None,
-        to_date: Optional[date] = None,
         overrides: Optional[Dict] = None,
         settings: Optional[Settings] = None,
     ):
@@ -83,47 +140,124 @@ class SDMox(SDMoxInterface):
             self.settings.sd_base_url,
         )
 
-        # Fetch levels from MO
-        self.sd_levels: OrderedDictType[str, str] = self._read_ou_levelkeys()
-        self.level_by_uuid: Dict[str, str] = {v: k for k, v in self.sd_levels.items()}
+        # Bounds the number of concurrent reads from SD
+        self.sd_limit = asyncio.Semaphore(self.settings.sd_max_concurrency)
+
+        # Optional mirror of SD for pre-flight checks, see start_mirror
+        self.sd_mirror: Optional[SDMirror] = None
+        if self.settings.sd_mirror:
+            self.sd_mirror = SDMirror(
+                self.sd_connector,
+                max_age=self.settings.sd_mirror_max_age,
+                max_dates=self.settings.sd_mirror_max_dates,
+                limit=self.sd_limit,
+            )
 
-        # AMQP exchange
-        self.exchange_name: str = "org-struktur-changes-topic"
+        # Departments read from SD for pre-flight checks, keyed by
+        # (at, unit_code, unit_uuid, unit_level). Not found is cached as None.
+        self.department_cache: AsyncTTLCache[Tuple, Optional[Dict]] = AsyncTTLCache(
+            self._load_department,
+            ttl=self.settings.sd_cache_ttl,
+            max_size=self.settings.sd_cache_size,
+        )
 
-        if from_date:
-            self._update_virkning(from_date)
+        # Addresses written to SD which MO may not have stored yet, keyed by
+        # (unit_uuid, at), with the loop time they were written at. Address
+        # triggers for a unit run one at a time, under its lock.
+        self._pending_addresses: Dict[Tuple[str, date], List[Tuple[float, dict]]] = {}
+        self._address_locks: "WeakValueDictionary[str, asyncio.Lock]" = (
+            WeakValueDictionary()
+        )
 
-    def _get_mora_helper(self) -> MoraHelper:
-        return get_mora_helper(self.settings.mora_url)
+        # Class maps fetched from MO, refreshed in the background when stale
+        self.class_maps: AsyncTTLCache[str, Dict[str, str]] = AsyncTTLCache(
+            self._fetch_class_map,
+            ttl=self.settings.class_map_ttl,
+            stale_ttl=self.settings.class_map_stale_ttl,
+        )
+
+        # Levels from MO, populated by load_levels
+        self.sd_levels: OrderedDictType[str, str] = OrderedDict()
+        self.level_by_uuid: Dict[str, str] = {}
+
+        # Verification of changes, see _check_unit
+        self.poll_schedule = PollSchedule(
+            first_delay=self.settings.amqp_check_first_delay,
+            factor=self.settings.amqp_check_backoff,
+            max_delay=self.settings.amqp_check_max_delay,
+            jitter=self.settings.amqp_check_jitter,
+        )
+        self.apply_latency = ApplyLatency(
+            minimum=self.settings.amqp_check_first_delay / 4,
+            maximum=self.settings.amqp_check_max_delay,
+        )
 
-    def _fetch_class_map(self, facet_bvn: str) -> Dict[str, str]:
-        mora_helpers: MoraHelper = self._get_mora_helper()
+        # DAR address lookups, shared with every other SDMox
+        self.dar_resolver: BaseDARResolver = get_dar_resolver(self.settings)
+
+        # AMQP publisher, shared with every other SDMox using the same broker
+        self.publisher: AMQPPublisher = get_amqp_publisher(self.settings)
+
+    def start_mirror(self) -> None:
+        """Load the SD mirror, if enabled, and keep it up to date."""
+        if self.sd_mirror:
+            self.sd_mirror.refresh_soon(first_of_month())
+            self.sd_mirror.start(self.settings.sd_mirror_refresh_interval)
+
+    async def close(self) -> None:
+        if self.sd_mirror:
+            await self.sd_mirror.close()
+
+    def _get_mora_helper(self) -> AsyncMoraHelper:
+        return get_async_mora_helper(self.settings)
+
+    async def _fetch_class_map(self, facet_bvn: str) -> Dict[str, str]:
+        mora_helpers = self._get_mora_helper()
 
         dict_lookup: Callable[[Any], Tuple[Any, ...]] = itemgetter("user_key", "uuid")
         classes: List[dict]
-        classes, _ = mora_helpers.read_classes_in_facet(facet_bvn)
+        classes, _ = await mora_helpers.read_classes_in_facet(facet_bvn)
         return dict(map(cast(Callable[[dict], Tuple[str, str]], dict_lookup), classes))
 
-    def _read_ou_levelkeys(self) -> OrderedDictType[str, str]:
-        classes: Dict[str, str] = self._fetch_class_map("org_unit_level")
+    async def _read_ou_levelkeys(self) -> OrderedDictType[str, str]:
+        classes: Dict[str, str] = await self.class_maps.get("org_unit_level")
+        missing = [key for key in self.settings.ou_levelkeys if key not in classes]
+        if missing:
+            raise SDMoxError(
+                "Klasse-uuider for conf af Ny-Niveauer mangler: " + ", ".join(missing)
+            )
         return OrderedDict(
             map(lambda key: (key, classes[key]), self.settings.ou_levelkeys)
         )
 
-    def _update_virkning(self, from_date: date, to_date: Optional[date] = None):
+    async def load_levels(self):
+        """Load the NY-levels from the (cached) org_unit_level facet.
+
+        Called on startup to fail fast on missing levels, and before every
+        operation that needs the levels.
+        """
+        self.sd_levels = await self._read_ou_levelkeys()
+        self.level_by_uuid = {v: k for k, v in self.sd_levels.items()}
+
+    @staticmethod
+    def _validate_from_date(from_date: date):
+        if not from_date.day == 1:
+            raise SDMoxError("Startdato skal altid være den første i en måned")
+
+    def _virkning(self, from_date: date, to_date: Optional[date] = None) -> Dict:
         # TODO: This code smells, type analysis found that the types are not right
         #       I decided to go with midnight, but who knows what would be right.
-        # TODO: We really should eliminate the self.virkning and self._times global
-        #       state from this class, and rather provide it as needed.
-        self.virkning = smp.sd_virkning(
+        self._validate_from_date(from_date)
+        return smp.sd_virkning(
             datetime.combine(from_date, time.min),
             datetime.combine(to_date, time.min) if to_date else None,
         )
+
+    def _times(self, from_date: date, to_date: Optional[date] = None) -> Dict:
+        self._validate_from_date(from_date)
         if to_date is None:
             to_date = date(9999, 12, 31)
-        if not from_date.day == 1:
-            raise SDMoxError("Startdato skal altid være den første i en måned")
-        self._times = {
+        return {
             "virk_from": from_date.strftime("%Y-%m-%dT00:00:00.00"),
             "virk_to": to_date.strftime("%Y-%m-%dT00:00:00.00"),
         }
@@ -134,55 +268,47 @@ class SDMox(SDMoxInterface):
     # AMQP setup methods below #
     # ------------------------ #
 
-    def _amqp_connect(self):
-        """Establish a connection to the AMQP broker."""
-        credentials = pika.PlainCredentials(
-            self.settings.amqp_username, self.settings.amqp_password
-        )
-        parameters = pika.ConnectionParameters(
-            host=self.settings.amqp_host,
-            port=self.settings.amqp_port,
-            virtual_host=self.settings.amqp_virtual_host,
-            credentials=credentials,
-        )
-        connection = pika.BlockingConnection(parameters)
-        self.channel = connection.channel()
-        result = self.channel.queue_declare("", exclusive=True)
-        self.callback_queue = result.method.queue
-        self.channel.basic_consume(
-            queue=self.callback_queue,
-            on_message_callback=self._on_response,
-        )
-
-    def _on_response(self, ch, method, props, body):
-        # We never expect a result from SD!
-        logger = get_logger()
-        logger.error(body)
-        raise SDMoxError("Uventet svar fra SD AMQP")
-
-    def _call(self, xml):
-        """Create a connection to SD AMQP and publish a payload.
+    async def _call(self, xml, at=None, unit_uuid=None, unit_code=None):
+        """Publish a payload to SD AMQP.
 
-        Note: This method makes an AMQP connection on demand.
+        Note: The connection to the broker is shared by the whole process, see
+              app.amqp.AMQPPublisher.
 
         Args:
             xml: The XML payload to be published.
+            at: Effective date of the change.
+            unit_uuid: UUID of the unit being changed, to invalidate cached reads.
+            unit_code: Unit code of the unit being changed, likewise.
 
         Returns:
             True
         """
         logger = get_logger()
-        logger.info("Establishing connection to SD-Mox AMQP")
-        self._amqp_connect()
-
         logger.info("Calling SD-Mox AMQP")
-        self.channel.basic_publish(
-            exchange=self.exchange_name,
-            routing_key="#",
-            properties=pika.BasicProperties(reply_to=self.callback_queue),
-            body=xml,
+        # Do not start a change in SD that nobody is waiting for anymore
+        deadline.check("AMQP publish")
+        # The mirror no longer reflects the unit, until the change is verified
+        if self.sd_mirror:
+            self.sd_mirror.invalidate(at, unit_uuid, unit_code)
+        self._forget_unit(unit_uuid, unit_code)
+        await _wait_for(
+            self.publisher.publish(xml),
+            self.settings.amqp_publish_timeout,
+            "AMQP publish",
         )
 
+    def _forget_unit(self, unit_uuid=None, unit_code=None):
+        """Invalidate cached reads of a unit that is being changed."""
+        unit_uuid = str(unit_uuid) if unit_uuid is not None else None
+
+        def affected(key):
+            _, key_code, key_uuid, _ = key
+            return (unit_uuid is not None and key_uuid == unit_uuid) or (
+                unit_code is not None and key_code == unit_code
+            )
+
+        self.department_cache.invalidate_where(affected)
+
     # ------------------------ #
     # AMQP setup methods above #
     # ------------------------ #
@@ -192,74 +318,162 @@ class SDMox(SDMoxInterface):
     async def rename_unit(
         self, unit_uuid: UUID, new_unit_name: str, at: date, dry_run: bool = False
     ):
+        self._validate_from_date(at)
         unit_uuid_str = str(unit_uuid)
 
         mora_helpers = self._get_mora_helper()
 
-        # Fetch old ou data
-        unit_data = mora_helpers.read_ou(unit_uuid_str, at=at)
+        # Fetch old ou data and addresses
+        unit_data, addresses = await asyncio.gather(
+            mora_helpers.read_ou(unit_uuid_str, at=at),
+            mora_helpers.read_ou_address(
+                unit_uuid_str, at=at, scope=None, return_all=True, reformat=False
+            ),
+        )
         # Change to add our new data
         unit_data["name"] = new_unit_name
 
         # doing a read department here will give the non-unique error
         # here - where we still have access to the mo-error reporting
         code_errors = await self._validate_unit_code(
-            unit_data["user_key"], can_exist=True
+            unit_data["user_key"], at, can_exist=True
         )
         if code_errors:
             raise SDMoxError(", ".join(code_errors))
 
-        addresses = mora_helpers.read_ou_address(
-            unit_uuid_str, at=at, scope=None, return_all=True, reformat=False
-        )
         return await self._update_ou(
-            unit_uuid_str, unit_data, addresses, dry_run=dry_run
+            unit_uuid_str, unit_data, addresses, at, dry_run=dry_run
         )
 
     async def move_unit(
         self, unit_uuid: UUID, new_parent_uuid: UUID, at: date, dry_run: bool = False
     ):
+        self._validate_from_date(at)
         unit_uuid_str = str(unit_uuid)
         new_parent_uuid_str = str(new_parent_uuid)
 
         mora_helpers = self._get_mora_helper()
 
-        # Fetch old ou data
-        unit_data = mora_helpers.read_ou(unit_uuid_str, at=at)
+        # Fetch old ou data and the new parent
+        unit_data, new_parent_unit = await asyncio.gather(
+            mora_helpers.read_ou(unit_uuid_str, at=at),
+            mora_helpers.read_ou(new_parent_uuid_str),
+        )
 
         # doing a read department here will give the non-unique error
         # here - where we still have access to the mo-error reporting
         code_errors = await self._validate_unit_code(
-            unit_data["user_key"], can_exist=True
+            unit_data["user_key"], at, can_exist=True
         )
         if code_errors:
             raise SDMoxError(", ".join(code_errors))
 
-        # Fetch the new parent
-        new_parent_unit = mora_helpers.read_ou(new_parent_uuid_str)
-
+        await self.load_levels()
         payload = self._payload_create(unit_uuid_str, unit_data, new_parent_unit)
-        await self._move_unit(test_run=dry_run, **payload)
+        await self._move_unit(at, test_run=dry_run, **payload)
 
         # when moving, do not check against name
         payload["unit_name"] = None
-        return await self._check_unit(operation="flyt", **payload)
+        return await self._check_unit(at, operation="flyt", **payload)
+
+    async def rename_and_move_unit(
+        self,
+        unit_uuid: UUID,
+        new_unit_name: str,
+        new_parent_uuid: UUID,
+        at: date,
+        dry_run: bool = False,
+    ):
+        """Rename and move a unit, verifying both changes in a single pass.
+
+        Equivalent to rename_unit followed by move_unit, but MO is read and the
+        unit code is validated only once, both messages are published back to
+        back, and SD is polled once for the name and the parent together.
+        """
+        self._validate_from_date(at)
+        unit_uuid_str = str(unit_uuid)
+        new_parent_uuid_str = str(new_parent_uuid)
+
+        mora_helpers = self._get_mora_helper()
+
+        # Fetch old ou data, addresses and the new parent
+        unit_data, addresses, new_parent_unit = await asyncio.gather(
+            mora_helpers.read_ou(unit_uuid_str, at=at),
+            mora_helpers.read_ou_address(
+                unit_uuid_str, at=at, scope=None, return_all=True, reformat=False
+            ),
+            mora_helpers.read_ou(new_parent_uuid_str),
+        )
+        # Change to add our new data
+        unit_data["name"] = new_unit_name
+
+        # doing a read department here will give the non-unique error
+        # here - where we still have access to the mo-error reporting
+        code_errors = await self._validate_unit_code(
+            unit_data["user_key"], at, can_exist=True
+        )
+        if code_errors:
+            raise SDMoxError(", ".join(code_errors))
+
+        await self.load_levels()
+        edit_payload = await self._payload_edit(unit_uuid_str, unit_data, addresses)
+        move_payload = self._payload_create(unit_uuid_str, unit_data, new_parent_unit)
+
+        # Nothing may reach SD before both changes are known to be valid
+        edit_xml = self._create_xml_ret(at, **edit_payload)
+        move_xml = await self._create_xml_move(at, **move_payload)
+        if not dry_run:
+            for xml in (edit_xml, move_xml):
+                await self._call(
+                    xml,
+                    at,
+                    unit_uuid=unit_uuid_str,
+                    unit_code=move_payload["unit_code"],
+                )
+
+        return await self._check_unit(
+            at,
+            operation="ret",
+            parent=move_payload["parent"],
+            unit_level=move_payload["unit_level"],
+            **edit_payload,
+        )
 
     async def create_unit(
-        self, unit_uuid: UUID, unit_data: dict, parent_data: dict, dry_run: bool = False
+        self,
+        unit_uuid: UUID,
+        unit_data: dict,
+        parent_data: dict,
+        at: date,
+        dry_run: bool = False,
     ):
+        """Create a unit, and its addresses if unit_data has any details.
+
+        The import message and, with addresses, the ret message are published
+        in order, after which a single _check_unit pass verifies the created
+        department with its name, level, parent and addresses.
+        """
+        self._validate_from_date(at)
         unit_uuid_str = str(unit_uuid)
 
+        await self.load_levels()
         payload = self._payload_create(unit_uuid_str, unit_data, parent_data)
-        await self._create_unit(test_run=dry_run, **payload)
 
+        # Build the address payload before publishing anything, so invalid
+        # addresses do not leave a half-created unit behind
         details = unit_data.get("details", [])
+        edit_payload = None
         if details:
-            addresses = details
+            edit_payload = await self._payload_edit(unit_uuid_str, unit_data, details)
+
+        await self._create_unit(at, test_run=dry_run, **payload)
+        if edit_payload is not None:
             # Create adresses on the new organizational unit
-            await self._update_ou(unit_uuid_str, unit_data, addresses, dry_run=dry_run)
-        # check unit here
-        return await self._check_unit(operation="import", **payload)
+            await self._edit_unit(at, test_run=dry_run, **edit_payload)
+
+        return await self._check_unit(
+            at, operation="import", **{**(edit_payload or {}), **payload}
+        )
 
     async def create_address(
         self, unit_uuid: UUID, address_data: dict, at: date, dry_run: bool = False
@@ -276,23 +490,26 @@ class SDMox(SDMoxInterface):
             unit: The SD Organizational unit if changes went well,
                   SDMoxError with description of the issue otherwise.
         """
+        self._validate_from_date(at)
         unit_uuid_str = str(unit_uuid)
-
-        mora_helpers = self._get_mora_helper()
-
-        unit_data = mora_helpers.read_ou(unit_uuid_str, at=at)
-
-        previous_addresses = mora_helpers.read_ou_address(
-            unit_uuid_str, at=at, scope=None, return_all=True, reformat=False
-        )
-        # the new address is prepended to addresses and
-        # thereby given higher priority in sd_mox.py
-        # see 'grouped_addresses'
-        addresses = [address_data] + previous_addresses
-
-        return await self._update_ou(
-            unit_uuid_str, unit_data, addresses, dry_run=dry_run
-        )
+        key = (unit_uuid_str, at)
+
+        # A lock is kept for as long as a trigger for the unit holds it
+        lock = self._address_locks.setdefault(unit_uuid_str, asyncio.Lock())
+        async with lock:
+            # The new address takes priority over those already there
+            projection = await self._fresh_projection(key)
+            projection = await self._project_address(projection, address_data)
+
+            payload = self._payload_from_projection(projection)
+            await self._edit_unit(at, test_run=dry_run, **payload)
+            unit = await self._check_unit(at, operation="ret", **payload)
+            if not dry_run:
+                written = asyncio.get_running_loop().time()
+                self._pending_addresses.setdefault(key, []).append(
+                    (written, address_data)
+                )
+        return unit
 
     async def edit_address(
         self, unit_uuid: UUID, address_data: dict, at: date, dry_run: bool = False
@@ -318,47 +535,68 @@ class SDMox(SDMoxInterface):
     #  Helper methods below   #
     # ----------------------- #
 
-    async def _update_ou(self, unit_uuid, unit_data, addresses, dry_run=False):
+    async def _update_ou(self, unit_uuid, unit_data, addresses, at, dry_run=False):
         """Update an organizational unit with new unit-data and/or addresses.
 
         Args:
             unit_uuid: UUID of the unit to be updated.
             unit_data: MO data of the unit to be updated (can be modified).
             addresses: List of addresses to be updated (can be modified).
+            at: date of when to apply the change.
             dry_run: Whether to dry-run the changes or to actually apply them.
 
         Returns:
             unit: The SD Organizational unit if changes went well,
                   SDMoxError with description of the issue otherwise.
         """
-        payload = self._payload_edit(unit_uuid, unit_data, addresses)
-        self._edit_unit(test_run=dry_run, **payload)
-        return await self._check_unit(operation="ret", **payload)
-
-    async def _read_parent(self, unit_uuid=None):
-        from_date = self.virkning["sd:FraTidspunkt"]["sd:TidsstempelDatoTid"][0:10]
-        from_date = datetime.strptime(from_date, "%Y-%m-%d").date()
-        parent = await self.sd_connector.getDepartmentParent(
-            department_uuid_identifier=unit_uuid,
-            effective_date=from_date,
-        )
+        payload = await self._payload_edit(unit_uuid, unit_data, addresses)
+        await self._edit_unit(at, test_run=dry_run, **payload)
+        return await self._check_unit(at, operation="ret", **payload)
+
+    async def _read_parent(self, at, unit_uuid=None):
+        async with self.sd_limit:
+            parent = await _wait_for(
+                self.sd_connector.getDepartmentParent(
+                    department_uuid_identifier=unit_uuid,
+                    effective_date=at,
+                ),
+                self.settings.sd_timeout,
+                "SD lookup",
+            )
         parent_info = parent.get("DepartmentParent", None)
         return parent_info
 
-    async def _read_department(self, unit_code=None, unit_uuid=None, unit_level=None):
+    async def _read_department(
+        self, at, unit_code=None, unit_uuid=None, unit_level=None
+    ):
         logger = get_logger()
-        from_date = self.virkning["sd:FraTidspunkt"]["sd:TidsstempelDatoTid"][0:10]
-        from_date = datetime.strptime(from_date, "%Y-%m-%d").date()
-        department = await self.sd_connector.getDepartment(
-            department_identifier=(unit_uuid or unit_code),
-            department_level_identifier=unit_level,
-            start_date=from_date,
-            end_date=from_date,
-        )
+        async with self.sd_limit:
+            department = await _wait_for(
+                self.sd_connector.getDepartment(
+                    department_identifier=(unit_uuid or unit_code),
+                    department_level_identifier=unit_level,
+                    start_date=at,
+                    end_date=at,
+                ),
+                self.settings.sd_timeout,
+                "SD lookup",
+            )
         department_info = department.get("Department", None)
         logger.debug("Read department", department_info=department_info)
+        return self._unique_department(
+            department_info, unit_code, unit_uuid, unit_level
+        )
 
+    async def _load_department(self, key):
+        at, unit_code, unit_uuid, unit_level = key
+        return await self._read_department(
+            at, unit_code=unit_code, unit_uuid=unit_uuid, unit_level=unit_level
+        )
+
+    @staticmethod
+    def _unique_department(department_info, unit_code, unit_uuid, unit_level):
         if isinstance(department_info, list):
+            logger = get_logger()
             msg = "Afdeling ikke unik. Code {}, uuid {}, level {}".format(
                 unit_code, unit_uuid, unit_level
             )
@@ -367,8 +605,29 @@ class SDMox(SDMoxInterface):
             raise SDMoxError(msg)
         return department_info
 
+    async def _lookup_department(
+        self, at, unit_code=None, unit_uuid=None, unit_level=None
+    ):
+        """Like _read_department, but answered by the SD mirror when it is fresh,
+        and otherwise by the department cache.
+
+        Only for pre-flight checks, verification must always read SD.
+        """
+        snapshot = self.sd_mirror.snapshot(at) if self.sd_mirror else None
+        if snapshot is None or not snapshot.knows(unit_code, unit_uuid):
+            key = (at, unit_code, str(unit_uuid) if unit_uuid else None, unit_level)
+            return await self.department_cache.get(key)
+        found = snapshot.find(
+            unit_code=unit_code, unit_uuid=unit_uuid, unit_level=unit_level
+        )
+        department_info = found if len(found) > 1 else next(iter(found), None)
+        return self._unique_department(
+            department_info, unit_code, unit_uuid, unit_level
+        )
+
     async def _check_department(
         self,
+        at,
         unit_name=None,
         unit_code=None,
         unit_uuid=None,
@@ -383,7 +642,8 @@ class SDMox(SDMoxInterface):
         """
         Verify that an SD department contains what we think it should contain.
         Besides the supplied parameters, the activation date is also checked
-        against the global from_date.
+        against the effective date.
+        :param at: Effective date of the change.
         :param unit_name: Expected name or None.
         :param unit_code: Expected unit code or None.
         :param unit_uuid: Expected unit uuid or None. Also used to look up dept.
@@ -408,13 +668,21 @@ class SDMox(SDMoxInterface):
                 )
                 errors.append(error)
 
-        department = await self._read_department(
-            unit_code=unit_code, unit_uuid=unit_uuid, unit_level=unit_level
+        async def read_parent():
+            if parent is None:
+                return None
+            return await self._read_parent(at, unit_uuid)
+
+        department, actual_parent = await asyncio.gather(
+            self._read_department(
+                at, unit_code=unit_code, unit_uuid=unit_uuid, unit_level=unit_level
+            ),
+            read_parent(),
         )
         if department is None:
             return None, ["Unit"]
 
-        from_date = self.virkning["sd:FraTidspunkt"]["sd:TidsstempelDatoTid"][0:10]
+        from_date = at.strftime("%Y-%m-%d")
         if operation in ("ret", "import"):
             compare(department.get("ActivationDate"), from_date, "Activation Date")
         compare(
@@ -454,9 +722,12 @@ class SDMox(SDMoxInterface):
             )
         if parent is not None:
             parent_uuid = parent["uuid"]
-            actual = await self._read_parent(unit_uuid)
-            if actual is not None:
-                compare(actual.get("DepartmentUUIDIdentifier"), parent_uuid, "Parent")
+            if actual_parent is not None:
+                compare(
+                    actual_parent.get("DepartmentUUIDIdentifier"),
+                    parent_uuid,
+                    "Parent",
+                )
             else:
                 errors.append("Parent")
         if not errors:
@@ -468,6 +739,7 @@ class SDMox(SDMoxInterface):
 
     def _create_xml_ret(
         self,
+        at,
         unit_uuid,
         unit_code=None,
         unit_name=None,
@@ -476,22 +748,21 @@ class SDMox(SDMoxInterface):
         adresse=None,
         integration_values=None,
     ):
+        virkning = self._virkning(at)
         value_dict = {
             "RelationListe": smp.relations_ret(
-                self.virkning,
+                virkning,
                 pnummer=pnummer,
                 phone=phone,
                 adresse=adresse,
             ),
             "AttributListe": smp.attributes_ret(
-                self.virkning,
+                virkning,
                 funktionskode=integration_values["formaalskode"],
                 skolekode=integration_values["skolekode"],
                 unit_name=unit_name,
             ),
-            "Registrering": smp.create_registrering(
-                self.virkning, registry_type="Rettet"
-            ),
+            "Registrering": smp.create_registrering(virkning, registry_type="Rettet"),
             "ObjektID": smp.create_objekt_id(unit_uuid),
         }
         edit_dict = {"RegistreringBesked": value_dict}
@@ -499,19 +770,21 @@ class SDMox(SDMoxInterface):
         xml = xmltodict.unparse(edit_dict)
         return xml
 
-    def _create_xml_import(self, **payload):
-        payload.update(self._times)
+    def _create_xml_import(self, at, **payload):
+        payload.update(self._times(at))
         import_dict = smp.import_xml_dict(**payload)
         xml = xmltodict.unparse(import_dict)
         return xml
 
-    def _create_xml_flyt(self, **payload):
-        payload.update(self._times)
+    def _create_xml_flyt(self, at, **payload):
+        payload.update(self._times(at))
         flyt_dict = smp.flyt_xml_dict(**payload)
         xml = xmltodict.unparse(flyt_dict)
         return xml
 
-    async def _validate_unit_code(self, unit_code, unit_level=None, can_exist=False):
+    async def _validate_unit_code(
+        self, unit_code, at, unit_level=None, can_exist=False
+    ):
         logger = get_logger()
         logger.info("Validating unit code {}".format(unit_code))
         code_errors = []
@@ -531,29 +804,34 @@ class SDMox(SDMoxInterface):
             # TODO: Ignore duplicates as we lookup using UUID elsewhere
             #       Only check for duplicates on new creations
             # customers expect unique unit_codes globally
-            department = await self._read_department(unit_code=unit_code)
+            department = await self._lookup_department(at, unit_code=unit_code)
             if department is not None:
                 code_errors.append("Enhedsnummer er i brug")
         return code_errors
 
-    def _mo_to_sd_address(self, address):
+    def _mo_to_sd_address(self, address: Optional[DARRecord]):
         if address is None:
             return None
-        street, zip_code, city = address.rsplit(" ", maxsplit=2)
-        if street.endswith(","):
-            street = street[:-1]
         sd_address = {
-            "silkdata:AdresseNavn": street.strip(),
-            "silkdata:PostKodeIdentifikator": zip_code.strip(),
-            "silkdata:ByNavn": city.strip(),
+            "silkdata:AdresseNavn": address.street,
+            "silkdata:PostKodeIdentifikator": address.zip_code,
+            "silkdata:ByNavn": address.city,
         }
         return sd_address
 
     async def _create_unit(
-        self, unit_name, unit_code, parent, unit_level, unit_uuid=None, test_run=True
+        self,
+        at,
+        unit_name,
+        unit_code,
+        parent,
+        unit_level,
+        unit_uuid=None,
+        test_run=True,
     ):
         """
         Create a new unit in SD.
+        :param at: Effective date of the new unit.
         :param unit_name: Unit name.
         :param unit_code: Short (3-4 chars) unique name (enhedskode).
         :param parent: Unit code of parent unit.
@@ -567,14 +845,17 @@ class SDMox(SDMoxInterface):
         uuid is stored and given as parameter for the actual run.
         """
         logger = get_logger()
-        code_errors = await self._validate_unit_code(unit_code)
+        # Validate the unit code and look up the parent department together
+        code_errors, parent_department = await asyncio.gather(
+            self._validate_unit_code(unit_code, at),
+            self._lookup_department(
+                at, unit_code=parent["unit_code"], unit_level=parent["level"]
+            ),
+        )
         if code_errors:
             raise SDMoxError(", ".join(code_errors))
 
         # Verify the parent department actually exist
-        parent_department = await self._read_department(
-            unit_code=parent["unit_code"], unit_level=parent["level"]
-        )
         if not parent_department:
             raise SDMoxError("Forældrenheden findes ikke")
 
@@ -587,6 +868,7 @@ class SDMox(SDMoxInterface):
             raise SDMoxError("Enhedstypen passer ikke til forældreenheden")
 
         xml = self._create_xml_import(
+            at,
             unit_name=unit_name,
             unit_uuid=unit_uuid,
             unit_code=unit_code,
@@ -599,29 +881,53 @@ class SDMox(SDMoxInterface):
             logger.info(
                 "Create unit {}, {}, {}".format(unit_name, unit_code, unit_uuid)
             )
-            self._call(xml)
+            await self._call(xml, at, unit_uuid=unit_uuid, unit_code=unit_code)
         return unit_uuid
 
-    def _edit_unit(self, test_run=True, **payload):
+    async def _edit_unit(self, at, test_run=True, **payload):
         logger = get_logger()
-        xml = self._create_xml_ret(**payload)
+        xml = self._create_xml_ret(at, **payload)
         logger.debug("Edit unit xml: {}".format(xml))
         if not test_run:
             logger.info("Edit unit {!r}".format(payload))
-            self._call(xml)
+            await self._call(
+                xml,
+                at,
+                unit_uuid=payload["unit_uuid"],
+                unit_code=payload.get("unit_code"),
+            )
         return payload["unit_uuid"]
 
-    async def _move_unit(
-        self, unit_name, unit_code, parent, unit_level, unit_uuid=None, test_run=True
-    ):
+    async def _move_unit(self, at, test_run=True, **payload):
+        """
+        Move a unit in SD.
+
+        The unit code is not validated here, callers validate it when reading
+        the unit from MO.
+        """
         logger = get_logger()
-        code_errors = await self._validate_unit_code(unit_code, can_exist=True)
-        if code_errors:
-            raise SDMoxError(", ".join(code_errors))
+        xml = await self._create_xml_move(at, **payload)
+        logger.debug("Move unit operation", xml=xml)
+        if not test_run:
+            await self._call(
+                xml,
+                at,
+                unit_uuid=payload.get("unit_uuid"),
+                unit_code=payload["unit_code"],
+            )
+        return payload.get("unit_uuid")
 
+    async def _create_xml_move(
+        self, at, unit_name, unit_code, parent, unit_level, unit_uuid=None
+    ):
+        """Verify that the unit fits below parent in SD, and return the flyt XML.
+
+        Raise an SDMoxError if the parent does not exist in SD, or if its level
+        is not above unit_level.
+        """
         # Verify the parent department actually exist
-        parent_department = await self._read_department(
-            unit_code=parent["unit_code"], unit_level=parent["level"]
+        parent_department = await self._lookup_department(
+            at, unit_code=parent["unit_code"], unit_level=parent["level"]
         )
         if not parent_department:
             raise SDMoxError("Forældrenheden findes ikke")
@@ -634,6 +940,7 @@ class SDMox(SDMoxInterface):
             raise SDMoxError("Enhedstypen passer ikke til forældreenheden")
 
         xml = self._create_xml_flyt(
+            at,
             unit_name=unit_name,
             unit_uuid=unit_uuid,
             unit_code=unit_code,
@@ -641,26 +948,71 @@ class SDMox(SDMoxInterface):
             parent=parent["uuid"],
             parent_unit_uuid=parent["uuid"],
         )
-        logger.debug("Move unit operation", xml=xml)
-        if not test_run:
-            self._call(xml)
-        return unit_uuid
+        return xml
+
+    async def _check_unit(self, at, **payload):
+        """Poll SD until the unit has the values at hand, and return the unit.
 
-    async def _check_unit(self, **payload):
-        """Try to have the unit retrieved and compared to the
-        values at hand for as many times
-        as specified in self.amqp_check_retries and return the unit.
+        Probes follow self.poll_schedule until amqp_check_deadline seconds have
+        passed. Polling continues while the unit is missing or while its fields
+        still differ, as SD may not have applied the change yet. With
+        amqp_check_learn_delay the first probe waits for the typical observed
+        apply latency instead of amqp_check_first_delay. Polling never continues
+        past the deadline of the current request, see app.deadline.
 
         Raise an sdMoxError if the unit could not be found or did not have
         the expected attribute values. This error will be shown in the UI
         """
+        logger = get_logger()
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        poll_deadline = started + self.settings.amqp_check_deadline
+        request_left = deadline.remaining()
+        if request_left is not None:
+            poll_deadline = min(poll_deadline, loop.time() + request_left)
+
+        first_delay = None
+        if self.settings.amqp_check_learn_delay:
+            first_delay = self.apply_latency.first_delay()
+
         unit = None
         errors = None
-        for i in range(self.settings.amqp_check_retries):
-            await asyncio.sleep(self.settings.amqp_check_waittime)
-            unit, errors = await self._check_department(**payload)
-            if unit is not None:
+        # When the last probe finding the change not yet applied was sent
+        not_applied_at = 0.0
+        for attempt, delay in enumerate(self.poll_schedule.delays(first_delay), 1):
+            remaining = poll_deadline - loop.time()
+            if remaining <= 0:
                 break
+            await asyncio.sleep(min(delay, remaining))
+            probed_at = loop.time() - started
+            unit, errors = await self._check_department(at, **payload)
+            if unit is not None and not errors:
+                # SD applied the change between the two probes, recording the
+                # later one would only let the learned delay grow
+                self.apply_latency.record((not_applied_at + probed_at) / 2)
+                break
+            not_applied_at = probed_at
+            logger.debug(
+                "Change not yet applied in SD",
+                unit_uuid=payload.get("unit_uuid"),
+                attempt=attempt,
+                found=unit is not None,
+                errors=errors,
+            )
+        # Lookups made while the change was being applied may be out of date
+        self._forget_unit(payload.get("unit_uuid"), payload.get("unit_code"))
+        if self.sd_mirror:
+            verified = unit if unit is not None and not errors else None
+            self.sd_mirror.settle(
+                at,
+                payload.get("unit_uuid"),
+                payload.get("unit_code"),
+                department=verified,
+                parent=(payload.get("parent") or {}).get("uuid"),
+            )
+        if unit is None or errors:
+            # Running out of request time is not the same as SD rejecting
+            deadline.check("verification of change in SD")
         if unit is None:
             raise SDMoxError("Afdeling ikke fundet: %s" % payload["unit_uuid"])
         elif errors:
@@ -691,60 +1043,143 @@ class SDMox(SDMoxInterface):
             "unit_uuid": unit_uuid,
         }
 
-    def _get_dar_address(self, addrid):
-        for addrtype in (
-            "adresser",
-            "adgangsadresser",
-            "historik/adresser",
-            "historik/adgangsadresser",
-        ):
-            try:
-                r = requests.get(
-                    "https://dawa.aws.dk/" + addrtype,
-                    params=[
-                        ("id", addrid),
-                        ("noformat", "1"),
-                        ("struktur", "mini"),
-                    ],
-                )
-                addrobjs = r.json()
-                r.raise_for_status()
-                if addrobjs:
-                    # found, escape loop!
-                    break
-            except Exception as e:
-                raise SDMoxError("Fejlende opslag i DAR for " + addrid) from e
-        else:
-            raise SDMoxError("Addresse ikke fundet i DAR: {!r}".format(addrid))
+    async def _fresh_projection(self, key) -> UnitProjection:
+        """Read the unit and its addresses from MO.
+
+        They are read on every trigger, as MO has no version or ETag to check
+        a cached copy against, and checking it would take the same reads.
+        DAR addresses come from the DAR cache, so only new ones are looked up.
+
+        Our triggers run before MO stores the address, so addresses written
+        to SD by earlier triggers are laid on top, until MO has them or
+        trigger_timeout has passed.
+        """
+        projection = await self._load_unit_projection(key)
+        expired = asyncio.get_running_loop().time() - self.settings.trigger_timeout
+        for stale in [
+            other
+            for other, addresses in self._pending_addresses.items()
+            if addresses[-1][0] < expired
+        ]:
+            del self._pending_addresses[stale]
+        pending = []
+        for written, address in self._pending_addresses.pop(key, []):
+            if written < expired:
+                continue
+            overlaid = await self._project_address(projection, address)
+            if overlaid != projection:
+                pending.append((written, address))
+                projection = overlaid
+        if pending:
+            self._pending_addresses[key] = pending
+        return projection
+
+    async def _load_unit_projection(self, key):
+        unit_uuid, at = key
+        mora_helpers = self._get_mora_helper()
+        unit_data, addresses = await asyncio.gather(
+            mora_helpers.read_ou(unit_uuid, at=at),
+            mora_helpers.read_ou_address(
+                unit_uuid, at=at, scope=None, return_all=True, reformat=False
+            ),
+        )
+        return await self._project_unit(unit_uuid, unit_data, addresses)
 
-        return addrobjs.pop()["betegnelse"]
+    async def _get_dar_address(self, addrid):
+        try:
+            address = await self.dar_resolver.resolve(addrid)
+        except DARLookupError as e:
+            raise SDMoxError("Fejlende opslag i DAR for " + addrid) from e
+        if address is None:
+            raise SDMoxError("Addresse ikke fundet i DAR: {!r}".format(addrid))
+        return address
 
     def _grouped_addresses(self, details):
+        """Group address values by scope and by address type.
+
+        DAR addresses are kept as ids, only the one used is resolved, see
+        _payload_edit.
+        """
         keyed, scoped = {}, {}
         for d in details:
             scope, key = d["address_type"]["scope"], d["address_type"]["user_key"]
-            if scope == "DAR":
-                scoped.setdefault(scope, []).append(self._get_dar_address(d["value"]))
-            else:
-                scoped.setdefault(scope, []).append(d["value"])
+            scoped.setdefault(scope, []).append(d["value"])
             keyed.setdefault(key, []).append(d["value"])
         return scoped, keyed
 
-    def _payload_edit(self, unit_uuid, unit, addresses):
+    async def _project_unit(self, unit_uuid, unit, addresses) -> UnitProjection:
         scoped, keyed = self._grouped_addresses(addresses)
-        if "PNUMBER" in scoped and "DAR" not in scoped:
+        dar_id = scoped.get("DAR", [None])[0]
+        return UnitProjection(
+            unit_name=unit["name"],
+            unit_code=unit["user_key"],
+            unit_uuid=unit_uuid,
+            phone=scoped.get("PHONE", [None])[0],
+            pnummer=scoped.get("PNUMBER", [None])[0],
+            dar_id=dar_id,
+            adresse=await self._get_dar_address(dar_id) if dar_id else None,
+            formaalskode=keyed.get("Formålskode", [None])[0],
+            skolekode=keyed.get("Skolekode", [None])[0],
+        )
+
+    async def _project_address(
+        self, projection: UnitProjection, address: dict
+    ) -> UnitProjection:
+        """Return projection with address taking priority over the others.
+
+        Only a new DAR address is resolved.
+        """
+        scope = address["address_type"]["scope"]
+        key = address["address_type"]["user_key"]
+        value = address["value"]
+        if scope == "DAR":
+            if value != projection.dar_id:
+                adresse = await self._get_dar_address(value)
+                projection = projection._replace(dar_id=value, adresse=adresse)
+        elif scope == "PHONE":
+            projection = projection._replace(phone=value)
+        elif scope == "PNUMBER":
+            projection = projection._replace(pnummer=value)
+        if key == "Formålskode":
+            projection = projection._replace(formaalskode=value)
+        elif key == "Skolekode":
+            projection = projection._replace(skolekode=value)
+        return projection
+
+    def _payload_from_projection(self, projection: UnitProjection):
+        if projection.pnummer is not None and projection.dar_id is None:
             # it has proven difficult to deal with pnumber before postal address
             raise SDMoxError("Opret postaddresse før pnummer")
-
         return {
-            "unit_name": unit["name"],
-            "unit_code": unit["user_key"],
-            "unit_uuid": unit_uuid,
-            "phone": scoped.get("PHONE", [None])[0],
-            "pnummer": scoped.get("PNUMBER", [None])[0],
-            "adresse": self._mo_to_sd_address(scoped.get("DAR", [None])[0]),
+            "unit_name": projection.unit_name,
+            "unit_code": projection.unit_code,
+            "unit_uuid": projection.unit_uuid,
+            "phone": projection.phone,
+            "pnummer": projection.pnummer,
+            "adresse": self._mo_to_sd_address(projection.adresse),
             "integration_values": {
-                "formaalskode": keyed.get("Formålskode", [None])[0],
-                "skolekode": keyed.get("Skolekode", [None])[0],
+                "formaalskode": projection.formaalskode,
+                "skolekode": projection.skolekode,
             },
         }
+
+    async def _payload_edit(self, unit_uuid, unit, addresses):
+        projection = await self._project_unit(unit_uuid, unit, addresses)
+        return self._payload_from_projection(projection)
+
+
+_sdmox: Optional[SDMox] = None
+
+
+def get_sdmox() -> SDMox:
+    """Return the process-wide SDMox instance."""
+    global _sdmox
+    if _sdmox is None:
+        _sdmox = SDMox()
+    return _sdmox
+
+
+def set_sdmox(sdmox: SDMox) -> None:
+    """Replace the process-wide SDMox instance, used on settings reload."""
+    global _sdmox
+    _sdmox = sdmox
@@ -3,18 +3,29 @@
 # SPDX-License-Identifier: MPL-2.0
 
 import asyncio
+import hashlib
+import heapq
+import json
+import os
+import struct
+import sys
+import tempfile
+import time
+from array import array
+from bisect import bisect_left
 from collections import Counter
-from functools import partial
-from operator import itemgetter
+from enum import Enum
+from typing import Collection, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
 
-from anytree import Node, RenderTree
 from sd_connector import SDConnector
+from structlog import get_logger
 
+from app.cache import AsyncTTLCache
 from app.config import Settings, get_settings
 
 
-def create_sd_connector() -> SDConnector:
-    settings: Settings = get_settings()
+def create_sd_connector(settings: Optional[Settings] = None) -> SDConnector:
+    settings = settings or get_settings()
 
     sd_connector: SDConnector = SDConnector(
         settings.sd_institution,
@@ -25,59 +36,405 @@ def create_sd_connector() -> SDConnector:
     return sd_connector
 
 
-async def sd_tree_org(root_uuid=None):
-    """Tool to print out the entire SD organization tree."""
+class TreeFormat(str, Enum):
+    text = "text"
+    json = "json"
+    ndjson = "ndjson"
 
-    def build_parent_map(parent_map, department):
-        uuid = department["DepartmentUUIDIdentifier"]
-        if uuid in parent_map:
-            return parent_map
 
-        # Add ourselves to the parent map
-        parent_map[uuid] = {
-            "identifier": department["DepartmentIdentifier"],
-            "level": department["DepartmentLevelIdentifier"],
-            "parent": department.get("DepartmentReference", {}).get(
-                "DepartmentUUIDIdentifier"
-            ),
+class Department:
+    """A department of the SD organisation, see Organisation."""
+
+    __slots__ = ("uuid", "identifier", "name", "level")
+
+    def __init__(self, uuid: str, identifier: str, name: str, level: str):
+        self.uuid = uuid
+        self.identifier = identifier
+        self.name = name
+        # Few levels are shared by many departments
+        self.level = sys.intern(level)
+
+    @classmethod
+    def from_sd(cls, department: dict) -> "Department":
+        """Build a Department from a Department or DepartmentReference of SD."""
+        return cls(
+            department["DepartmentUUIDIdentifier"],
+            department["DepartmentIdentifier"],
+            department.get("DepartmentName", ""),
+            department["DepartmentLevelIdentifier"],
+        )
+
+    def label(self) -> str:
+        return f"{self.name} ({self.identifier}, {self.uuid})"
+
+
+NO_PARENT = -1
+
+
+class Organisation:
+    """The departments of an SD institution, and the tree they form.
+
+    Departments are referred to by their position in departments. The
+    position of the parent of each is in parents, NO_PARENT for departments
+    at the top of the tree and for departments not in the tree. roots holds
+    the departments at the top of the tree, and children(position) those
+    below a department, both sorted by uuid. at_levels finds departments
+    by level without walking the tree.
+    """
+
+    def __init__(
+        self,
+        departments: List[Department],
+        parents: Iterable[int],
+        roots: Iterable[int],
+    ):
+        self.departments = departments
+        self.positions = {
+            department.uuid: position for position, department in enumerate(departments)
         }
+        self.parents = array("l", parents)
+
+        # The children of department p are _children[_starts[p]:_starts[p + 1]]
+        count = len(departments)
+        by_uuid = sorted(range(count), key=lambda position: departments[position].uuid)
+        self._starts = array("l", [0]) * (count + 1)
+        for parent in self.parents:
+            if parent != NO_PARENT:
+                self._starts[parent + 1] += 1
+        for position in range(count):
+            self._starts[position + 1] += self._starts[position]
+        filled = array("l", self._starts)
+        self._children = array("l", [0]) * self._starts[count]
+        for position in by_uuid:
+            parent = self.parents[position]
+            if parent != NO_PARENT:
+                self._children[filled[parent]] = position
+                filled[parent] += 1
+        self.roots = array("l", sorted(roots, key=lambda root: departments[root].uuid))
 
-        # Call recursively (if required)
-        if "DepartmentReference" in department:
-            parent_map = build_parent_map(parent_map, department["DepartmentReference"])
-        return parent_map
+        # Built on first use by at_levels, see _index_levels
+        self._by_level: Optional[Dict[str, array]] = None
 
-    def find_children_uuids(tree, parent_uuid):
-        children_uuids = [
-            key for key, value in sorted(tree.items()) if value["parent"] == parent_uuid
+    @classmethod
+    def from_sd(
+        cls, departments: List[dict], organization: List[dict]
+    ) -> "Organisation":
+        """Build an Organisation from getDepartment and getOrganization of SD."""
+        records: List[Department] = []
+        positions: Dict[str, int] = {}
+
+        def add(department: dict, replace: bool = True) -> int:
+            uuid = department["DepartmentUUIDIdentifier"]
+            position = positions.get(uuid)
+            if position is None:
+                position = positions[uuid] = len(records)
+                records.append(Department.from_sd(department))
+            elif replace:
+                records[position] = Department.from_sd(department)
+            return position
+
+        for department in departments:
+            add(department)
+
+        # Each element of organization is a chain of nested
+        # DepartmentReferences, from a department towards the top
+        parents: Dict[int, int] = {}
+        for reference in organization:
+            position = add(reference, replace=False)
+            while position not in parents:
+                parent = reference.get("DepartmentReference")
+                if parent is None:
+                    parents[position] = NO_PARENT
+                else:
+                    parent_position = add(parent, replace=False)
+                    parents[position] = parent_position
+                    reference, position = parent, parent_position
+
+        roots = [
+            position for position, parent in parents.items() if parent == NO_PARENT
         ]
-        return children_uuids
-
-    def build_any_tree(parent_map, root_uuid):
-        def build_tree_node(uuid, parent=None):
-            node = Node(
-                department_name_map[uuid]
-                + " ("
-                + department_id_map[uuid]
-                + ", "
-                + uuid
-                + ")",
-                parent=parent,
+        return cls(
+            records,
+            (parents.get(position, NO_PARENT) for position in range(len(records))),
+            roots,
+        )
+
+    def __len__(self) -> int:
+        return len(self.departments)
+
+    def children(self, position: int) -> Sequence[int]:
+        return self._children[self._starts[position] : self._starts[position + 1]]
+
+    def _index_levels(self) -> Dict[str, array]:
+        """Number the departments in the tree depth first, and index by level.
+
+        The departments below the one numbered n are numbered n + 1 up to
+        _ends of it, so those below a department and at a level are a range
+        of the sorted numbers of that level.
+        """
+        count = len(self.departments)
+        self._numbers = array("l", [NO_PARENT]) * count
+        self._ends = array("l", [0]) * count
+        self._depths = array("l", [0]) * count
+        self._order = array("l")
+        pending = [(root, 0) for root in reversed(self.roots)]
+        while pending:
+            position, depth = pending.pop()
+            self._numbers[position] = len(self._order)
+            self._depths[position] = depth
+            self._order.append(position)
+            children = self.children(position)
+            pending.extend((child, depth + 1) for child in reversed(children))
+        # Departments below come later in _order than those above them
+        for position in reversed(self._order):
+            self._ends[position] = max(
+                self._ends[position], self._numbers[position] + 1
             )
-            return node
+            parent = self.parents[position]
+            if parent != NO_PARENT:
+                self._ends[parent] = max(self._ends[parent], self._ends[position])
+
+        by_level: Dict[str, array] = {}
+        for number, position in enumerate(self._order):
+            level = self.departments[position].level
+            by_level.setdefault(level, array("l")).append(number)
+        self._by_level = by_level
+        return by_level
 
-        def build_tree(parent_node, parent_uuid):
-            node_uuids = find_children_uuids(parent_map, parent_uuid)
-            for node_uuid in node_uuids:
-                node = build_tree_node(node_uuid, parent=parent_node)
-                build_tree(node, node_uuid)
+    def at_levels(
+        self, root: int, levels: Collection[str], max_depth: Optional[int] = None
+    ) -> Iterator[Tuple[int, int]]:
+        """Yield position and depth of departments at levels below root.
 
-        root = build_tree_node(root_uuid)
-        build_tree(root, root_uuid)
-        return root
+        Departments are yielded depth first, depth counting from root, which
+        is included. Departments at other levels are never visited.
+        """
+        by_level = self._by_level
+        if by_level is None:
+            by_level = self._index_levels()
+        start = self._numbers[root]
+        if start == NO_PARENT:
+            # Not in the tree, and so without departments below
+            if self.departments[root].level in levels:
+                yield root, 0
+            return
+        end, base = self._ends[root], self._depths[root]
+        ranges = []
+        for level in set(levels):
+            numbers = by_level.get(level)
+            if numbers is not None:
+                first = bisect_left(numbers, start)
+                ranges.append(numbers[first : bisect_left(numbers, end, first)])
+        for number in heapq.merge(*ranges):
+            position = self._order[number]
+            depth = self._depths[position] - base
+            if max_depth is None or depth <= max_depth:
+                yield position, depth
 
-    sd_connector = create_sd_connector()
+    def is_below(self, position: int, ancestor: int) -> bool:
+        """Return whether position is somewhere below ancestor in the tree."""
+        if self._by_level is None:
+            self._index_levels()
+        start = self._numbers[ancestor]
+        return (
+            start != NO_PARENT
+            and start < self._numbers[position] < self._ends[ancestor]
+        )
+
+    def node(self, position: int, depth: int) -> dict:
+        """Return a department as a record of the structured tree."""
+        department = self.departments[position]
+        parent = self.parents[position]
+        return {
+            "uuid": department.uuid,
+            "identifier": department.identifier,
+            "name": department.name,
+            "level": department.level,
+            "parent": self.departments[parent].uuid if parent != NO_PARENT else None,
+            "depth": depth,
+        }
 
+
+def render_tree(
+    organisation: Organisation,
+    root: int,
+    max_depth: Optional[int] = None,
+) -> Iterator[str]:
+    """Yield the lines of the tree below root, drawn as anytree does.
+
+    Departments more than max_depth levels below root are left out.
+    """
+    departments = organisation.departments
+    yield departments[root].label()
+    if max_depth == 0:
+        return
+    # Siblings, the position of the next one to draw, the prefix drawn for
+    # their ancestors and their depth
+    pending = [(organisation.children(root), 0, "", 1)]
+    while pending:
+        children, index, prefix, depth = pending.pop()
+        if index == len(children):
+            continue
+        pending.append((children, index + 1, prefix, depth))
+
+        position = children[index]
+        last = index == len(children) - 1
+        yield prefix + ("└── " if last else "├── ") + departments[position].label()
+        below = organisation.children(position)
+        if below and (max_depth is None or depth < max_depth):
+            prefix_below = prefix + ("    " if last else "│   ")
+            pending.append((below, 0, prefix_below, depth + 1))
+
+
+def _chunks(lines: Iterable[str], size: int = 65536) -> Iterator[str]:
+    """Join lines into chunks of about size characters, for streaming."""
+    chunk: List[str] = []
+    length = 0
+    for line in lines:
+        chunk.append(line)
+        length += len(line)
+        if length >= size:
+            yield "".join(chunk)
+            chunk, length = [], 0
+    if chunk:
+        yield "".join(chunk)
+
+
+class OrganisationSnapshot:
+    """The organisation read from SD at one point in time, age seconds ago.
+
+    etag identifies the content, and is the same for equal snapshots.
+    """
+
+    def __init__(self, organisation: Organisation, age: float = 0):
+        self.taken_at = time.monotonic() - age
+        self.organisation = organisation
+
+        # Hash what is served, rather than everything SD answered
+        digest = hashlib.sha256()
+        for department, parent in zip(
+            self.organisation.departments, self.organisation.parents
+        ):
+            fields = [department.uuid, department.identifier, department.name]
+            fields += [department.level, str(parent)]
+            digest.update("\x1f".join(fields).encode() + b"\x1e")
+        self.etag = digest.hexdigest()
+
+    def age(self) -> float:
+        """Return seconds since the snapshot was read from SD."""
+        return time.monotonic() - self.taken_at
+
+
+# Snapshot file layout:
+#   header:   MAGIC, version, number of departments, number of roots, time
+#             the snapshot was taken (seconds since the epoch), and the byte
+#             lengths of the source and of each string column
+#   source:   SD base url and institution the snapshot was read from
+#   parents:  per department, the position of its parent as a 32-bit integer
+#   roots:    the positions of the roots as 32-bit integers
+#   columns:  uuid, identifier, name and level of every department, UTF-8
+#             encoded and separated by FIELD_SEPARATOR
+SNAPSHOT_MAGIC = b"SDMOXORG"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct("<8sIIId5I")
+FIELD_SEPARATOR = "\x1f"
+COLUMNS = ("uuid", "identifier", "name", "level")
+
+
+def _integers(values: Iterable[int]) -> bytes:
+    integers = array("i", values)
+    if sys.byteorder != "little":
+        integers.byteswap()
+    return integers.tobytes()
+
+
+def _read_integers(data: memoryview) -> array:
+    integers = array("i")
+    integers.frombytes(data)
+    if sys.byteorder != "little":
+        integers.byteswap()
+    return integers
+
+
+def write_snapshot_file(snapshot: OrganisationSnapshot, source: str, path: str) -> None:
+    """Write snapshot, read from source, to a new snapshot file at path.
+
+    The file is written next to path and moved in place when complete, so
+    running processes never see a partial snapshot.
+    """
+    organisation = snapshot.organisation
+    columns = [
+        FIELD_SEPARATOR.join(
+            getattr(department, column) for department in organisation.departments
+        ).encode("utf-8")
+        for column in COLUMNS
+    ]
+    encoded_source = source.encode("utf-8")
+    header = SNAPSHOT_HEADER.pack(
+        SNAPSHOT_MAGIC,
+        SNAPSHOT_VERSION,
+        len(organisation),
+        len(organisation.roots),
+        time.time() - snapshot.age(),
+        len(encoded_source),
+        *map(len, columns),
+    )
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile(dir=directory, delete=False) as snapshot_file:
+        snapshot_file.write(header)
+        snapshot_file.write(encoded_source)
+        snapshot_file.write(_integers(organisation.parents))
+        snapshot_file.write(_integers(organisation.roots))
+        for column in columns:
+            snapshot_file.write(column)
+    os.replace(snapshot_file.name, path)
+
+
+def read_snapshot_file(path: str, source: str) -> OrganisationSnapshot:
+    """Read a snapshot written by write_snapshot_file.
+
+    Raise ValueError if path is not a snapshot of source in this version.
+    """
+    with open(path, "rb") as snapshot_file:
+        header = snapshot_file.read(SNAPSHOT_HEADER.size)
+        if len(header) < SNAPSHOT_HEADER.size:
+            raise ValueError(f"{path} is not an SD snapshot")
+        magic, version, count, root_count, taken_at, *lengths = SNAPSHOT_HEADER.unpack(
+            header
+        )
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError(f"{path} is not a version {SNAPSHOT_VERSION} snapshot")
+
+        sections = [lengths[0], 4 * count, 4 * root_count, *lengths[1:]]
+        size = sum(sections)
+        if SNAPSHOT_HEADER.size + size != os.fstat(snapshot_file.fileno()).st_size:
+            raise ValueError(f"{path} is truncated")
+        # Read the rest in one go, the sections are views of it
+        body = memoryview(bytearray(size))
+        if snapshot_file.readinto(body) != size:
+            raise ValueError(f"{path} is truncated")
+
+    data = []
+    offset = 0
+    for length in sections:
+        data.append(body[offset : offset + length])
+        offset += length
+    encoded_source, parents, roots, *columns = data
+    if str(encoded_source, "utf-8") != source:
+        raise ValueError(f"{path} is a snapshot of another SD institution")
+    values = [
+        str(column, "utf-8").split(FIELD_SEPARATOR) if count else []
+        for column in columns
+    ]
+    departments = [Department(*fields) for fields in zip(*values)]
+    organisation = Organisation(
+        departments, _read_integers(parents), _read_integers(roots)
+    )
+    return OrganisationSnapshot(organisation, age=max(0, time.time() - taken_at))
+
+
+async def read_organisation_snapshot(sd_connector: SDConnector) -> OrganisationSnapshot:
+    """Read all departments and the organisation from SD."""
     # Fire our requests
     responses = await asyncio.gather(
         sd_connector.getDepartment(), sd_connector.getOrganization()
@@ -86,42 +443,132 @@ async def sd_tree_org(root_uuid=None):
     # Pull out the data
     departments = department_response["Department"]
     organization = organization_response["Organization"]["DepartmentReference"]
+    return OrganisationSnapshot(Organisation.from_sd(departments, organization))
+
+
+_snapshots: Dict[Tuple, AsyncTTLCache[None, OrganisationSnapshot]] = {}
+
 
-    # Generate map from UUID to Name for Deparments
-    department_name_map = dict(
-        map(itemgetter("DepartmentUUIDIdentifier", "DepartmentName"), departments)
+def _snapshot_key(settings: Settings) -> Tuple:
+    return (
+        settings.sd_base_url,
+        settings.sd_institution,
+        settings.sd_username,
+        settings.sd_password,
+        settings.sd_snapshot_ttl,
+        settings.sd_snapshot_stale_ttl,
+        settings.sd_snapshot_path,
     )
-    department_id_map = dict(
-        map(itemgetter("DepartmentUUIDIdentifier", "DepartmentIdentifier"), departments)
+
+
+def _snapshot_cache(settings: Settings) -> AsyncTTLCache[None, OrganisationSnapshot]:
+    key = _snapshot_key(settings)
+    if key in _snapshots:
+        return _snapshots[key]
+
+    logger = get_logger()
+    sd_connector = create_sd_connector(settings)
+    source = f"{settings.sd_base_url} {settings.sd_institution}"
+    path = settings.sd_snapshot_path
+
+    async def load(_: None) -> OrganisationSnapshot:
+        snapshot = await read_organisation_snapshot(sd_connector)
+        if path is not None:
+            try:
+                await asyncio.to_thread(write_snapshot_file, snapshot, source, path)
+            except OSError as e:
+                logger.warning("Writing SD snapshot failed", path=path, error=str(e))
+        return snapshot
+
+    cache: AsyncTTLCache[None, OrganisationSnapshot] = AsyncTTLCache(
+        load,
+        ttl=settings.sd_snapshot_ttl,
+        stale_ttl=settings.sd_snapshot_stale_ttl,
     )
+    if path is not None:
+        try:
+            snapshot = read_snapshot_file(path, source)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.warning("Ignoring SD snapshot", path=path, error=str(e))
+        else:
+            logger.info(
+                "SD snapshot loaded",
+                path=path,
+                departments=len(snapshot.organisation),
+                age=int(snapshot.age()),
+            )
+            cache.put(None, snapshot, age=snapshot.age())
+    _snapshots[key] = cache
+    return cache
 
-    # Build parent map
-    parent_map = {}
-    for department in organization:
-        parent_map = build_parent_map(parent_map, department)
 
-    # Find roots of the parent_map
-    if root_uuid:
-        root_uuids = [str(root_uuid)]
+async def get_organisation_snapshot(settings: Settings) -> OrganisationSnapshot:
+    """Return the process-wide snapshot of the SD institution in settings.
+
+    The snapshot is read again when older than sd_snapshot_ttl, in the
+    background while it is younger than sd_snapshot_ttl + sd_snapshot_stale_ttl.
+    Concurrent requests share a single read from SD.
+
+    With sd_snapshot_path set, every snapshot read from SD is also written to
+    that file, and a new process starts out with the snapshot in it.
+    """
+    return await _snapshot_cache(settings).get(None)
+
+
+def forget_organisation_snapshots(keep: Optional[Settings] = None) -> None:
+    """Drop the snapshots of every settings but keep, used on settings reload."""
+    kept = _snapshot_key(keep) if keep is not None else None
+    for key in [key for key in _snapshots if key != kept]:
+        del _snapshots[key]
+
+
+def warm_organisation_snapshot(settings: Settings) -> None:
+    """Load the snapshot file in settings, and refresh it in the background.
+
+    Used on application startup. The snapshot is not refreshed while the
+    file is younger than sd_snapshot_ttl.
+    """
+    if settings.sd_snapshot_path is None:
+        return
+    cache = _snapshot_cache(settings)
+    snapshot = cache.peek(None)
+    if snapshot is None or snapshot.age() >= settings.sd_snapshot_ttl:
+        cache.refresh(None)
+
+
+def sd_tree_org(
+    snapshot: OrganisationSnapshot,
+    root_uuid=None,
+    max_depth: Optional[int] = None,
+) -> Iterator[str]:
+    """Tool to print out the entire SD organization tree.
+
+    root_uuid is a single root or a list of roots. The tree is rendered while
+    the returned iterator is consumed, in chunks of many lines.
+    """
+    organisation = snapshot.organisation
+    if isinstance(root_uuid, (list, tuple)):
+        roots: Sequence[int] = [organisation.positions[str(uuid)] for uuid in root_uuid]
+    elif root_uuid:
+        roots = [organisation.positions[str(root_uuid)]]
     else:
-        root_uuids = find_children_uuids(parent_map, None)
+        roots = organisation.roots
 
-    # For each root, build an any-tree and print it
-    output = ""
-    trees = map(partial(build_any_tree, parent_map), root_uuids)
-    for tree in trees:
-        for pre, fill, node in RenderTree(tree):
-            output += "%s%s" % (pre, node.name) + "\n"
-        output += "\n"
-    return output
+    # For each root, print the tree below it
+    def lines() -> Iterator[str]:
+        for root in roots:
+            for line in render_tree(organisation, root, max_depth):
+                yield line + "\n"
+            yield "\n"
 
+    return _chunks(lines())
 
-async def department_identifier_list():
-    sd_connector = create_sd_connector()
-    department_response = await sd_connector.getDepartment()
-    departments = department_response["Department"]
+
+def department_identifier_list(snapshot: OrganisationSnapshot) -> Dict[str, int]:
     department_identifiers = Counter(
-        map(itemgetter("DepartmentIdentifier"), departments)
+        department.identifier for department in snapshot.organisation.departments
     )
     elements = {}
     for element, count in department_identifiers.most_common():
@@ -129,3 +576,64 @@ async def department_identifier_list():
             break
         elements[element] = count
     return elements
+
+
+def tree_nodes(
+    snapshot: OrganisationSnapshot,
+    root_uuids: Optional[Sequence[str]] = None,
+    max_depth: Optional[int] = None,
+    levels: Optional[Collection[str]] = None,
+) -> Iterator[dict]:
+    """Yield the departments below root_uuids depth first, see Organisation.node.
+
+    depth counts from the nearest root, which is at depth 0. Departments
+    deeper than max_depth are not visited. Departments not at one of levels
+    are left out, but the departments below them are not.
+    """
+    organisation = snapshot.organisation
+    if root_uuids is None:
+        roots: Sequence[int] = organisation.roots
+    else:
+        roots = [organisation.positions[uuid] for uuid in root_uuids]
+    if levels is not None:
+        for root in roots:
+            for position, depth in organisation.at_levels(root, levels, max_depth):
+                yield organisation.node(position, depth)
+        return
+    pending = [(root, 0) for root in reversed(roots)]
+    while pending:
+        position, depth = pending.pop()
+        yield organisation.node(position, depth)
+        if max_depth is None or depth < max_depth:
+            children = organisation.children(position)
+            pending.extend((child, depth + 1) for child in reversed(children))
+
+
+def nest_tree_nodes(
+    snapshot: OrganisationSnapshot, nodes: Iterable[dict]
+) -> List[dict]:
+    """Nest nodes from tree_nodes of snapshot, with those below each in children.
+
+    Nodes left out by a level filter leave their children to the nearest
+    ancestor which was not left out, or to the top if there is none.
+    """
+    organisation = snapshot.organisation
+    roots: List[dict] = []
+    # The nodes kept above the current one, with their positions
+    ancestors: List[Tuple[int, dict]] = []
+    for node in nodes:
+        node = {**node, "children": []}
+        position = organisation.positions[node["uuid"]]
+        if node["depth"] == 0:
+            # Each root given to tree_nodes starts a tree of its own
+            ancestors.clear()
+        while ancestors and not organisation.is_below(position, ancestors[-1][0]):
+            ancestors.pop()
+        (ancestors[-1][1]["children"] if ancestors else roots).append(node)
+        ancestors.append((position, node))
+    return roots
+
+
+def ndjson_tree(nodes: Iterable[dict]) -> Iterator[str]:
+    """Stream nodes from tree_nodes as newline delimited JSON."""
+    return _chunks(json.dumps(node) + "\n" for node in nodes)
@@ -11,6 +11,7 @@ from uuid import UUID
 from os2mo_helpers.mora_helpers import MoraHelper
 
 from app.config import get_settings
+from app.mo import AsyncMoraHelper, get_async_mora_helper
 
 
 def today() -> date:
@@ -28,8 +29,8 @@ def get_mora_helper(mora_url=None) -> MoraHelper:
     return MoraHelper(hostname=mora_url, use_cache=False)
 
 
-def get_mora_helper_default() -> MoraHelper:
-    return get_mora_helper(None)
+def get_mora_helper_default() -> AsyncMoraHelper:
+    return get_async_mora_helper(get_settings())
 
 
 CallableReturnType = TypeVar("CallableReturnType")
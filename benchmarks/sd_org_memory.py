@@ -0,0 +1,90 @@
+# SPDX-FileCopyrightText: Magenta ApS
+#
+# SPDX-License-Identifier: MPL-2.0
+"""Benchmark of the memory held by the SD organisation model.
+
+The Organisation of app.sd_tree_org is compared with the dict based model it
+replaced: the departments as read from SD, maps from uuid to name, identifier
+and parent, and lists of children. Only memory still held once the SD
+responses are gone is counted.
+
+Run with:
+
+    python -m benchmarks.sd_org_memory --size 100000
+"""
+
+import gc
+import json
+import tracemalloc
+from collections import defaultdict
+from operator import itemgetter
+from typing import Any, Callable, Dict, List, Optional
+
+import click
+
+from app.sd_tree_org import Organisation
+from benchmarks.sd_tree_org import SyntheticSDConnector
+
+
+def dict_model(departments: List[dict], organization: List[dict]) -> Dict[str, Any]:
+    """The dict based model, as held before Organisation."""
+    parent_map = {}
+    for department in organization:
+        reference: Optional[dict] = department
+        while reference is not None:
+            uuid = reference["DepartmentUUIDIdentifier"]
+            if uuid in parent_map:
+                break
+            parent = reference.get("DepartmentReference")
+            parent_map[uuid] = parent["DepartmentUUIDIdentifier"] if parent else None
+            reference = parent
+    children_map = defaultdict(list)
+    for uuid, parent in sorted(parent_map.items()):
+        children_map[parent].append(uuid)
+    return {
+        "departments": departments,
+        "parent_map": parent_map,
+        "children_map": children_map,
+        "department_name_map": dict(
+            map(itemgetter("DepartmentUUIDIdentifier", "DepartmentName"), departments)
+        ),
+        "department_id_map": dict(
+            map(
+                itemgetter("DepartmentUUIDIdentifier", "DepartmentIdentifier"),
+                departments,
+            )
+        ),
+    }
+
+
+def held_memory(
+    build: Callable[[List[dict], List[dict]], Any], size: int, depth: int
+) -> int:
+    """Return the bytes held by the model built from a fresh SD response."""
+    connector = SyntheticSDConnector(size, depth)
+    # Parse the responses, as they arrive from SD
+    departments = json.dumps(connector.departments)
+    organization = json.dumps(connector.leaves)
+    del connector
+    gc.collect()
+
+    tracemalloc.start()
+    model = build(json.loads(departments), json.loads(organization))
+    gc.collect()
+    held, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del model
+    return held
+
+
+@click.command()
+@click.option("--size", default=100000, help="Number of departments.")
+@click.option("--depth", default=6, help="Number of levels.")
+def main(size: int, depth: int):
+    for name, build in [("dicts", dict_model), ("Organisation", Organisation.from_sd)]:
+        held = held_memory(build, size, depth)
+        click.echo(f"{name}, {size} departments: {held / 1e6:.1f} MB held")
+
+
+if __name__ == "__main__":
+    main()
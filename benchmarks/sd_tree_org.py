@@ -0,0 +1,100 @@
+# SPDX-FileCopyrightText: Magenta ApS
+#
+# SPDX-License-Identifier: MPL-2.0
+"""Benchmark of rendering /tree for a synthetic SD organisation.
+
+The organisation is a random tree, with the departments of every level
+spread over the departments of the level above.
+
+Run with:
+
+    python -m benchmarks.sd_tree_org --size 100000
+"""
+
+import asyncio
+import random
+import time
+import tracemalloc
+from typing import List, Optional
+from uuid import UUID
+
+import click
+
+from app.sd_tree_org import read_organisation_snapshot, sd_tree_org
+
+
+class SyntheticSDConnector:
+    def __init__(self, size: int, depth: int, seed: int = 0):
+        rng = random.Random(seed)
+        uuids = [str(UUID(int=rng.getrandbits(128))) for _ in range(size)]
+        self.departments = [
+            {
+                "DepartmentUUIDIdentifier": uuid,
+                "DepartmentIdentifier": f"D{number}",
+                "DepartmentLevelIdentifier": "NY1-niveau",
+                "DepartmentName": f"Department {number}",
+            }
+            for number, uuid in enumerate(uuids)
+        ]
+
+        # Level boundaries grow geometrically towards the leaves
+        boundaries = [max(1, size * 2**level // 2**depth) for level in range(depth)]
+        references: List[dict] = []
+        has_children = set()
+        for number, department in enumerate(self.departments):
+            level = sum(1 for boundary in boundaries if number >= boundary)
+            parent: Optional[dict] = None
+            if level > 0:
+                parent = references[rng.randrange(boundaries[level - 1])]
+                has_children.add(parent["DepartmentUUIDIdentifier"])
+            reference = {
+                key: department[key]
+                for key in [
+                    "DepartmentUUIDIdentifier",
+                    "DepartmentIdentifier",
+                    "DepartmentLevelIdentifier",
+                ]
+            }
+            if parent is not None:
+                reference["DepartmentReference"] = parent
+            references.append(reference)
+        # SD lists the departments without children, each with its parents
+        self.leaves = [
+            reference
+            for reference in references
+            if reference["DepartmentUUIDIdentifier"] not in has_children
+        ]
+
+    async def getDepartment(self):
+        return {"Department": self.departments}
+
+    async def getOrganization(self):
+        return {"Organization": {"DepartmentReference": self.leaves}}
+
+
+async def render(connector: SyntheticSDConnector) -> int:
+    snapshot = await read_organisation_snapshot(connector)
+    return sum(len(chunk) for chunk in sd_tree_org(snapshot))
+
+
+@click.command()
+@click.option("--size", default=100000, help="Number of departments.")
+@click.option("--depth", default=6, help="Number of levels.")
+def main(size: int, depth: int):
+    connector = SyntheticSDConnector(size, depth)
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    length = asyncio.run(render(connector))
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    click.echo(
+        f"/tree, {size} departments: {elapsed:.2f} s, "
+        f"{length / 1e6:.1f} MB rendered, {peak / 1e6:.1f} MB peak allocated"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+# SPDX-FileCopyrightText: Magenta ApS
+#
+# SPDX-License-Identifier: MPL-2.0
+"""Micro-benchmark of should_mox_run on a deeply nested unit.
+
+Run with:
+
+    python -m benchmarks.should_mox_run
+"""
+
+import os
+import timeit
+from uuid import uuid4
+
+import click
+
+from app.dependencies import should_mox_run
+
+required_environment = {
+    "OU_LEVELKEYS": '["NY1-niveau"]',
+    "AMQP_USERNAME": "amqp_username",
+    "AMQP_PASSWORD": "amqp_password",
+    "AMQP_VIRTUAL_HOST": "amqp_virtual_host",
+    "SD_USERNAME": "sd_username",
+    "SD_PASSWORD": "sd_password",
+    "SD_INSTITUTION": "sd_institution",
+}
+
+
+def nested_unit(depth: int) -> dict:
+    """Build a MO unit with depth ancestors, none of which are triggered."""
+    unit = None
+    for _ in range(depth + 1):
+        unit = {"uuid": str(uuid4()), "parent": unit}
+    assert unit is not None
+    return unit
+
+
+@click.command()
+@click.option("--depth", default=15, help="Number of ancestors of the unit.")
+@click.option("--triggered", default=100, help="Number of triggered uuids.")
+@click.option("--number", default=10000, help="Calls per repetition.")
+def main(depth: int, triggered: int, number: int):
+    for key, value in required_environment.items():
+        os.environ.setdefault(key, value)
+    triggered_uuids = ", ".join(f'"{uuid4()}"' for _ in range(triggered))
+    os.environ["TRIGGERED_UUIDS"] = f"[{triggered_uuids}]"
+
+    unit = nested_unit(depth)
+    assert should_mox_run(unit) is False
+
+    timings = timeit.repeat(lambda: should_mox_run(unit), number=number, repeat=5)
+    best = min(timings) / number
+    click.echo(f"should_mox_run, depth {depth}: {best * 1e6:.2f} µs per call")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+# SPDX-FileCopyrightText: Magenta ApS
+#
+# SPDX-License-Identifier: MPL-2.0
+"""Benchmark of the address create trigger on an employee address.
+
+Requests are sent straight to the ASGI application, with and without the
+prefilter of the trigger routes, so only the work done by SDMox is measured.
+
+Run with:
+
+    python -m benchmarks.trigger_prefilter
+"""
+
+import asyncio
+import json
+import os
+import time
+from uuid import uuid4
+
+import click
+from fastapi import APIRouter, FastAPI
+
+from app.deadline import DeadlineRoute
+from app.mo import SharedReadsRoute
+from app.routers import trigger_api
+from benchmarks.should_mox_run import required_environment
+
+
+class UnfilteredRoute(DeadlineRoute, SharedReadsRoute):
+    """TriggerRoute without the prefilter."""
+
+
+def employee_address() -> bytes:
+    """A create trigger for an employee address, as MO sends it."""
+    return json.dumps(
+        {
+            "event_type": "ON_BEFORE",
+            "request": {
+                "type": "address",
+                "address_type": {
+                    "example": "<UUID>",
+                    "name": "Email",
+                    "scope": "EMAIL",
+                    "user_key": "EmailEmployee",
+                    "uuid": str(uuid4()),
+                },
+                "engagement": None,
+                "org": {"name": "Kommune", "user_key": "Kommune", "uuid": str(uuid4())},
+                "org_unit": None,
+                "person": {"uuid": str(uuid4())},
+                "validity": {"from": "2021-03-01", "to": None},
+                "value": "someone@example.org",
+                "visibility": None,
+            },
+            "request_type": "CREATE",
+            "role_type": "address",
+            "uuid": str(uuid4()),
+        }
+    ).encode()
+
+
+def build_app(route_class: type) -> FastAPI:
+    router = APIRouter(route_class=route_class)
+    router.add_api_route(
+        "/triggers/address/CREATE",
+        trigger_api.triggers_address_create,
+        methods=["POST"],
+    )
+    app = FastAPI()
+    app.include_router(router)
+    return app
+
+
+async def post(app: FastAPI, body: bytes) -> None:
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": "/triggers/address/CREATE",
+        "raw_path": b"/triggers/address/CREATE",
+        "query_string": b"",
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+        ],
+        "client": ("127.0.0.1", 12345),
+        "server": ("127.0.0.1", 8000),
+    }
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+    status = []
+
+    async def receive():
+        return messages.pop() if messages else {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            status.append(message["status"])
+
+    await app(scope, receive, send)
+    assert status == [200], status
+
+
+async def requests_per_second(app: FastAPI, body: bytes, number: int) -> float:
+    for _ in range(100):
+        await post(app, body)
+    started = time.perf_counter()
+    for _ in range(number):
+        await post(app, body)
+    return number / (time.perf_counter() - started)
+
+
+@click.command()
+@click.option("--number", default=5000, help="Requests per measurement.")
+def main(number: int):
+    for key, value in required_environment.items():
+        os.environ.setdefault(key, value)
+    os.environ.setdefault("TRIGGERED_UUIDS", "[]")
+
+    body = employee_address()
+    for name, route_class in [
+        ("without prefilter", UnfilteredRoute),
+        ("with prefilter", trigger_api.TriggerRoute),
+    ]:
+        rate = asyncio.run(requests_per_second(build_app(route_class), body, number))
+        click.echo(f"Employee address, {name}: {rate:.0f} requests per second")
+
+
+if __name__ == "__main__":
+    main()
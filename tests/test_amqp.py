@@ -0,0 +1,284 @@
+# SPDX-FileCopyrightText: Magenta ApS
+#
+# SPDX-License-Identifier: MPL-2.0
+
+import asyncio
+import time
+from datetime import date
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from pika.exceptions import AMQPConnectionError, NackError, StreamLostError
+from pika.frame import Method
+from pika.spec import Basic, Confirm, Queue
+
+import tests.test_sd_mox as sd_mox_tests
+from app.amqp import (
+    AsyncioAMQPPublisher,
+    BlockingAMQPPublisher,
+    close_amqp_publishers,
+    get_amqp_publisher,
+)
+from app.config import get_settings
+from app.util import async_to_sync
+
+amqp_overrides = {
+    "triggered_uuids": [],
+    "ou_levelkeys": [],
+    "amqp_username": "guest",
+    "amqp_password": "guest",
+    "amqp_host": "example.org",
+    "amqp_virtual_host": "example.org",
+    "sd_username": "",
+    "sd_password": "",
+    "sd_institution": "",
+}
+
+
+def fake_connection():
+    connection = MagicMock()
+    connection.is_closed = False
+    connection.is_open = True
+    channel = connection.channel.return_value
+    channel.is_closed = False
+    channel.is_open = True
+    return connection
+
+
+class BlockingPublisherTests(TestCase):
+    def setUp(self):
+        self.publisher = BlockingAMQPPublisher(get_settings(**amqp_overrides))
+
+    def tearDown(self):
+        asyncio.run(self.publisher.close())
+
+    @patch("app.amqp.pika.BlockingConnection")
+    def test_connection_is_reused(self, blocking_connection):
+        connection = fake_connection()
+        blocking_connection.return_value = connection
+
+        for _ in range(5):
+            self.publisher.publish_blocking("<xml/>")
+
+        blocking_connection.assert_called_once()
+        connection.channel.assert_called_once()
+        channel = connection.channel.return_value
+        channel.queue_declare.assert_called_once()
+        self.assertEqual(channel.basic_publish.call_count, 5)
+        stats = self.publisher.stats.as_dict()
+        self.assertEqual(stats["publishes"], 5)
+        self.assertEqual(stats["reconnects"], 0)
+
+    @patch("app.amqp.pika.BlockingConnection")
+    def test_reconnect_on_lost_connection(self, blocking_connection):
+        broken, healthy = fake_connection(), fake_connection()
+        broken.process_data_events.side_effect = StreamLostError("gone")
+        blocking_connection.side_effect = [broken, healthy]
+
+        self.publisher.publish_blocking("<xml/>")
+
+        self.assertEqual(blocking_connection.call_count, 2)
+        healthy.channel.return_value.basic_publish.assert_called_once()
+        stats = self.publisher.stats.as_dict()
+        self.assertEqual(stats["publishes"], 1)
+        self.assertEqual(stats["reconnects"], 1)
+
+    @patch("app.amqp.pika.BlockingConnection")
+    def test_close(self, blocking_connection):
+        connection = fake_connection()
+        blocking_connection.return_value = connection
+
+        self.publisher.publish_blocking("<xml/>")
+        asyncio.run(self.publisher.close())
+
+        connection.close.assert_called_once()
+
+    @patch("app.amqp.pika.BlockingConnection")
+    def test_unexpected_error_counts_as_failure(self, blocking_connection):
+        connection = fake_connection()
+        channel = connection.channel.return_value
+        channel.basic_publish.side_effect = ValueError("bad body")
+        blocking_connection.return_value = connection
+
+        with self.assertRaises(ValueError):
+            self.publisher.publish_blocking("<xml/>")
+
+        stats = self.publisher.stats.as_dict()
+        self.assertEqual(stats["publish_failures"], 1)
+        self.assertEqual(stats["reconnects"], 0)
+
+    @patch("app.amqp.pika.BlockingConnection")
+    def test_heartbeats_serviced_while_idle(self, blocking_connection):
+        connection = fake_connection()
+        blocking_connection.return_value = connection
+        self.publisher.heartbeat_interval = 0.01
+
+        self.publisher.publish_blocking("<xml/>")
+        serviced = connection.process_data_events.call_count
+        time.sleep(0.2)
+
+        self.assertGreater(connection.process_data_events.call_count, serviced)
+
+    @patch("app.amqp.pika.BlockingConnection")
+    def test_connection_lost_while_idle(self, blocking_connection):
+        broken, healthy = fake_connection(), fake_connection()
+        blocking_connection.side_effect = [broken, healthy]
+
+        self.publisher.publish_blocking("<xml/>")
+        broken.process_data_events.side_effect = StreamLostError("gone")
+        self.publisher._service_heartbeats()
+        self.publisher.publish_blocking("<xml/>")
+
+        self.assertEqual(blocking_connection.call_count, 2)
+        healthy.channel.return_value.basic_publish.assert_called_once()
+        self.assertEqual(self.publisher.stats.as_dict()["reconnects"], 0)
+
+    @patch("app.amqp.pika.BlockingConnection")
+    @async_to_sync
+    async def test_connect_backoff_does_not_block_loop(self, blocking_connection):
+        self.publisher = BlockingAMQPPublisher(
+            get_settings(**amqp_overrides, amqp_reconnect_delay=0.1)
+        )
+        blocking_connection.side_effect = [
+            AMQPConnectionError("refused"),
+            AMQPConnectionError("refused"),
+            fake_connection(),
+        ]
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.01)
+
+        ticker = asyncio.create_task(tick())
+        await self.publisher.publish("<xml/>")
+        ticker.cancel()
+        await self.publisher.close()
+
+        self.assertEqual(blocking_connection.call_count, 3)
+        self.assertGreater(ticks, 10)
+
+
+class StandInChannel:
+    """Minimal stand-in for a pika channel on a broker confirming publishes."""
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.is_open = True
+        self.delivery_tag = 0
+        self.ack_nack_callback = None
+
+    def _reply(self, callback, method):
+        asyncio.get_running_loop().call_soon(callback, Method(1, method))
+
+    def add_on_close_callback(self, callback):
+        pass
+
+    def queue_declare(self, queue, exclusive=False, callback=None):
+        self._reply(callback, Queue.DeclareOk(queue="amq.gen-reply"))
+
+    def basic_consume(self, queue, on_message_callback):
+        pass
+
+    def confirm_delivery(self, ack_nack_callback, callback=None):
+        self.ack_nack_callback = ack_nack_callback
+        self._reply(callback, Confirm.SelectOk())
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        self.delivery_tag += 1
+        self.broker.published.append(body)
+        method = Basic.Nack if self.broker.nack else Basic.Ack
+        asyncio.get_running_loop().call_later(
+            self.broker.latency,
+            self.ack_nack_callback,
+            Method(1, method(delivery_tag=self.delivery_tag)),
+        )
+
+
+class StandInBroker:
+    """Local broker stand-in, confirming every publish after a fixed latency."""
+
+    def __init__(self, latency, nack=False):
+        self.latency = latency
+        self.nack = nack
+        self.published = []
+        self.connections = 0
+
+    def __call__(
+        self,
+        parameters,
+        on_open_callback,
+        on_open_error_callback,
+        on_close_callback,
+        custom_ioloop,
+    ):
+        self.connections += 1
+        broker = self
+
+        class Connection:
+            is_open = True
+
+            def channel(self, on_open_callback):
+                channel = StandInChannel(broker)
+                custom_ioloop.call_soon(on_open_callback, channel)
+
+            def close(self):
+                self.is_open = False
+
+        connection = Connection()
+        custom_ioloop.call_soon(on_open_callback, connection)
+        return connection
+
+
+class AsyncioPublisherTests(TestCase):
+    def setUp(self):
+        self.settings = get_settings(**amqp_overrides, amqp_publisher="asyncio")
+
+    @async_to_sync
+    async def test_concurrent_triggers_are_not_serialised(self):
+        broker = StandInBroker(latency=0.2)
+        at = date(2019, 7, 1)
+        mox = sd_mox_tests.TestableSDMox(settings=self.settings)
+        mox.publisher = AsyncioAMQPPublisher(self.settings, connection_factory=broker)
+
+        async def edit(number):
+            unit = {"name": f"Unit {number}", "user_key": f"U{number}"}
+            payload = await mox._payload_edit(f"unit-uuid-{number}", unit, [])
+            await mox._edit_unit(at, test_run=False, **payload)
+
+        start = time.monotonic()
+        await asyncio.gather(*(edit(i) for i in range(50)))
+        elapsed = time.monotonic() - start
+
+        self.assertEqual(len(broker.published), 50)
+        self.assertEqual(broker.connections, 1)
+        # Serialised publishes would take 50 * 0.2 = 10 seconds
+        self.assertLess(elapsed, 5 * broker.latency)
+        self.assertEqual(mox.publisher.stats.as_dict()["publishes"], 50)
+
+    @async_to_sync
+    async def test_nack_is_raised(self):
+        broker = StandInBroker(latency=0.01, nack=True)
+        publisher = AsyncioAMQPPublisher(self.settings, connection_factory=broker)
+
+        with self.assertRaises(NackError):
+            await publisher.publish("<xml/>")
+        self.assertEqual(publisher.stats.as_dict()["publish_failures"], 1)
+
+
+class PublisherRegistryTests(TestCase):
+    @async_to_sync
+    async def test_changed_settings_get_a_new_publisher(self):
+        settings = get_settings(**amqp_overrides)
+        with patch("app.amqp._publishers", {}) as publishers:
+            publisher = get_amqp_publisher(settings)
+            self.assertIs(get_amqp_publisher(get_settings(**amqp_overrides)), publisher)
+
+            for changed in [{"amqp_password": "new"}, {"amqp_publish_timeout": 1}]:
+                reloaded = get_settings(**{**amqp_overrides, **changed})
+                self.assertIsNot(get_amqp_publisher(reloaded), publisher)
+
+            await close_amqp_publishers(keep=reloaded)
+            self.assertEqual(list(publishers.values()), [get_amqp_publisher(reloaded)])
@@ -0,0 +1,148 @@
+# SPDX-FileCopyrightText: Magenta ApS
+#
+# SPDX-License-Identifier: MPL-2.0
+
+import asyncio
+from unittest import TestCase
+
+from app import deadline
+from app.cache import AsyncTTLCache
+from app.util import async_to_sync
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class CountingLoader:
+    def __init__(self, delay=0.0):
+        self.calls = 0
+        self.delay = delay
+
+    async def __call__(self, key):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        return f"{key}-{self.calls}"
+
+
+class AsyncTTLCacheTests(TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.loader = CountingLoader()
+        self.cache = AsyncTTLCache(self.loader, ttl=10, stale_ttl=100, clock=self.clock)
+
+    @async_to_sync
+    async def test_fresh_entries_are_cached(self):
+        self.assertEqual(await self.cache.get("a"), "a-1")
+        self.clock.now = 9
+        self.assertEqual(await self.cache.get("a"), "a-1")
+        self.assertEqual(self.loader.calls, 1)
+
+    @async_to_sync
+    async def test_stale_entries_are_served_while_refreshing(self):
+        await self.cache.get("a")
+        self.clock.now = 50
+        self.assertEqual(await self.cache.get("a"), "a-1")
+        # Let the background refresh finish
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        self.assertEqual(self.loader.calls, 2)
+        self.assertEqual(await self.cache.get("a"), "a-2")
+
+    @async_to_sync
+    async def test_expired_entries_are_reloaded(self):
+        await self.cache.get("a")
+        self.clock.now = 111
+        self.assertEqual(await self.cache.get("a"), "a-2")
+
+    @async_to_sync
+    async def test_concurrent_loads_are_collapsed(self):
+        self.loader.delay = 0.01
+        values = await asyncio.gather(*(self.cache.get("a") for _ in range(10)))
+        self.assertEqual(set(values), {"a-1"})
+        self.assertEqual(self.loader.calls, 1)
+
+    @async_to_sync
+    async def test_shared_load_is_not_bound_by_a_deadline(self):
+        deadlines = []
+
+        async def loader(key):
+            deadlines.append(deadline.remaining())
+            await asyncio.sleep(0.2)
+            return key
+
+        cache = AsyncTTLCache(loader, ttl=10)
+
+        async def get(seconds):
+            with deadline.deadline(seconds):
+                return await cache.get("a")
+
+        hurried, patient = await asyncio.gather(
+            get(0.05), get(5), return_exceptions=True
+        )
+        self.assertIsInstance(hurried, deadline.DeadlineExceeded)
+        self.assertEqual(patient, "a")
+        self.assertEqual(deadlines, [None])
+
+    @async_to_sync
+    async def test_invalidate(self):
+        await self.cache.get("a")
+        await self.cache.get("b")
+        self.cache.invalidate("a")
+        self.assertEqual(await self.cache.get("a"), "a-3")
+        self.assertEqual(await self.cache.get("b"), "b-2")
+        self.cache.invalidate()
+        self.assertEqual(await self.cache.get("b"), "b-4")
+
+    @async_to_sync
+    async def test_invalidate_while_loading(self):
+        self.loader.delay = 0.01
+        loading = asyncio.ensure_future(self.cache.get("a"))
+        await asyncio.sleep(0)
+        self.cache.invalidate("a")
+        self.assertEqual(await loading, "a-1")
+        self.assertIsNone(self.cache.peek("a"))
+
+    @async_to_sync
+    async def test_least_recently_used_are_evicted(self):
+        cache = AsyncTTLCache(self.loader, ttl=10, clock=self.clock, max_size=2)
+        await cache.get("a")
+        await cache.get("b")
+        await cache.get("a")
+        await cache.get("c")
+        self.assertIsNone(cache.peek("b"))
+        self.assertEqual(cache.peek("a"), "a-1")
+        self.assertEqual(cache.peek("c"), "c-3")
+
+    @async_to_sync
+    async def test_invalidate_where(self):
+        await self.cache.get("a1")
+        await self.cache.get("b1")
+        self.cache.invalidate_where(lambda key: key.startswith("a"))
+        self.assertIsNone(self.cache.peek("a1"))
+        self.assertEqual(self.cache.peek("b1"), "b1-2")
+
+    @async_to_sync
+    async def test_put_supersedes_load_in_flight(self):
+        self.loader.delay = 0.01
+        loading = asyncio.ensure_future(self.cache.get("a"))
+        await asyncio.sleep(0)
+        self.cache.put("a", "put")
+        await loading
+        self.assertEqual(await self.cache.get("a"), "put")
+        self.assertEqual(self.loader.calls, 1)
+
+    @async_to_sync
+    async def test_put_with_age(self):
+        self.clock.now = 100
+        self.cache.put("a", "put", age=50)
+        self.assertEqual(await self.cache.get("a"), "put")
+        # The entry is stale, and is refreshed in the background
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        self.assertEqual(self.loader.calls, 1)
+        self.assertEqual(await self.cache.get("a"), "a-1")
@@ -0,0 +1,73 @@
+# SPDX-FileCopyrightText: Magenta ApS
+#
+# SPDX-License-Identifier: MPL-2.0
+
+import os
+from unittest import TestCase
+from unittest.mock import patch
+from uuid import UUID
+
+from pydantic import ValidationError
+
+import app.config
+from app.config import get_settings, reload_settings
+
+unit_uuid = "25abf6f4-fa38-5bd8-b217-7130ce3552cd"
+
+environment = {
+    "TRIGGERED_UUIDS": f'["{unit_uuid}"]',
+    "OU_LEVELKEYS": '["NY1-niveau"]',
+    "AMQP_USERNAME": "amqp_username",
+    "AMQP_PASSWORD": "amqp_password",
+    "AMQP_VIRTUAL_HOST": "amqp_virtual_host",
+    "SD_USERNAME": "sd_username",
+    "SD_PASSWORD": "sd_password",
+    "SD_INSTITUTION": "sd_institution",
+}
+
+
+@patch.dict(os.environ, environment)
+class SettingsTests(TestCase):
+    def setUp(self):
+        app.config._settings = None
+
+    def tearDown(self):
+        app.config._settings = None
+
+    def test_settings_are_memoized(self):
+        settings = get_settings()
+        self.assertIs(get_settings(), settings)
+        self.assertEqual(settings.triggered_uuids, frozenset([UUID(unit_uuid)]))
+
+    def test_overrides_bypass_memo(self):
+        settings = get_settings()
+        overridden = get_settings(sd_institution="other")
+        self.assertEqual(overridden.sd_institution, "other")
+        self.assertIs(get_settings(), settings)
+
+    def test_reload(self):
+        settings = get_settings()
+        with patch.dict(os.environ, {"SD_INSTITUTION": "reloaded"}):
+            self.assertIs(get_settings(), settings)
+            reload_settings()
+            self.assertEqual(get_settings().sd_institution, "reloaded")
+
+    def test_deprecated_check_settings(self):
+        deprecated = {"AMQP_CHECK_RETRIES": "4", "AMQP_CHECK_WAITTIME": "2"}
+        with patch.dict(os.environ, deprecated):
+            settings = reload_settings()
+            self.assertEqual(settings.amqp_check_deadline, 8)
+            self.assertEqual(settings.amqp_check_max_delay, 2)
+
+            # Settings given explicitly win
+            with patch.dict(os.environ, {"AMQP_CHECK_DEADLINE": "30"}):
+                self.assertEqual(reload_settings().amqp_check_deadline, 30)
+
+        self.assertEqual(reload_settings().amqp_check_deadline, 18)
+
+    def test_invalid_reload_keeps_settings(self):
+        settings = get_settings()
+        with patch.dict(os.environ, {"MORA_TIMEOUT": "-1"}):
+            with self.assertRaises(ValidationError):
+                reload_settings()
+        self.assertIs(get_settings(), settings)
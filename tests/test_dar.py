@@ -0,0 +1,137 @@
+# SPDX-FileCopyrightText: Magenta ApS
+#
+# SPDX-License-Identifier: MPL-2.0
+
+import asyncio
+from unittest import TestCase
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from app import deadline
+from app.dar import DARLookupError, DARRecord, DARResolver
+from app.util import async_to_sync
+
+current = "0a3f507b-7750-32b8-e044-0003ba298018"
+access = "0a3f507b-6331-32b8-e044-0003ba298018"
+historic = "0a3f507b-0000-32b8-e044-0003ba298018"
+
+endpoints = {
+    "adresser": [
+        {
+            "id": current,
+            "betegnelse": "Toftebjerghaven 4, 2750 Ballerup",
+            "postnr": "2750",
+            "postnrnavn": "Ballerup",
+        }
+    ],
+    "adgangsadresser": [
+        {"id": access, "betegnelse": "Banegårdspladsen 1, 2750 Ballerup"},
+        {"id": current, "betegnelse": "Lower priority"},
+    ],
+    "historik/adresser": [
+        {"id": historic, "betegnelse": "Old name 1, 2750 Ballerup"},
+        {"id": historic, "betegnelse": "Gammel Vej 1, 2750 Ballerup"},
+    ],
+    "historik/adgangsadresser": [],
+}
+
+
+def dar_stand_in(requests, failing=(), delay=0):
+    def endpoint(name):
+        async def handler(request):
+            requests.append((name, request.query["id"]))
+            await asyncio.sleep(delay)
+            if name in failing:
+                return web.Response(status=500)
+            ids = request.query["id"].split("|")
+            return web.json_response(
+                [address for address in endpoints[name] if address["id"] in ids]
+            )
+
+        return handler
+
+    app = web.Application()
+    for name in endpoints:
+        app.router.add_get("/" + name, endpoint(name))
+    return app
+
+
+class DARResolverTests(TestCase):
+    @async_to_sync
+    async def test_first_endpoint_by_priority(self):
+        async with TestServer(dar_stand_in([])) as server:
+            resolver = DARResolver(str(server.make_url("/")))
+            addresses = await resolver.resolve_many([current, access, historic])
+            await resolver.close()
+
+        self.assertEqual(
+            addresses,
+            {
+                current: DARRecord(
+                    "Toftebjerghaven 4, 2750 Ballerup",
+                    "Toftebjerghaven 4",
+                    "2750",
+                    "Ballerup",
+                ),
+                access: DARRecord(
+                    "Banegårdspladsen 1, 2750 Ballerup",
+                    "Banegårdspladsen 1",
+                    "2750",
+                    "Ballerup",
+                ),
+                historic: DARRecord(
+                    "Gammel Vej 1, 2750 Ballerup", "Gammel Vej 1", "2750", "Ballerup"
+                ),
+            },
+        )
+
+    @async_to_sync
+    async def test_ids_are_batched_and_cached(self):
+        requests = []
+        async with TestServer(dar_stand_in(requests)) as server:
+            resolver = DARResolver(str(server.make_url("/")))
+            await resolver.resolve_many([current, access, "unknown"])
+            self.assertEqual(len(requests), 4)
+            self.assertEqual(
+                set(requests[0][1].split("|")), {current, access, "unknown"}
+            )
+
+            self.assertIsNone(await resolver.resolve("unknown"))
+            await resolver.resolve(current)
+            await resolver.close()
+
+        self.assertEqual(len(requests), 4)
+
+    @async_to_sync
+    async def test_failing_endpoint(self):
+        failing = ["adgangsadresser"]
+        async with TestServer(dar_stand_in([], failing=failing)) as server:
+            resolver = DARResolver(str(server.make_url("/")))
+            # Found on an endpoint of higher priority than the failing one
+            self.assertEqual(
+                (await resolver.resolve(current)).street, "Toftebjerghaven 4"
+            )
+            with self.assertRaises(DARLookupError):
+                await resolver.resolve(access)
+            await resolver.close()
+
+    @async_to_sync
+    async def test_batch_is_not_bound_by_a_deadline(self):
+        requests = []
+        async with TestServer(dar_stand_in(requests, delay=0.2)) as server:
+            resolver = DARResolver(str(server.make_url("/")))
+
+            async def resolve(address_id, seconds):
+                with deadline.deadline(seconds):
+                    return await resolver.resolve(address_id)
+
+            hurried, patient = await asyncio.gather(
+                resolve(current, 0.05), resolve(access, 5), return_exceptions=True
+            )
+            await resolver.close()
+
+        # Both ids are looked up in one batch
+        self.assertEqual(set(requests[0][1].split("|")), {current, access})
+        self.assertIsInstance(hurried, deadline.DeadlineExceeded)
+        self.assertEqual(patient.street, "Banegårdspladsen 1")
@@ -0,0 +1,214 @@
+# SPDX-FileCopyrightText: Magenta ApS
+#
+# SPDX-License-Identifier: MPL-2.0
+
+import io
+import json
+import os
+import tempfile
+import time
+from unittest import TestCase
+from unittest.mock import patch
+from uuid import uuid4
+
+from click.testing import CliRunner
+
+from app.cli import sd_mox_cli
+from app.dar import IndexedDARResolver
+from app.dar_index import (
+    DARIndex,
+    DARRecord,
+    ReloadingDARIndex,
+    build_index,
+    dar_record,
+    read_export,
+)
+from app.util import async_to_sync
+from tests.test_sd_mox import StandInDARResolver
+
+current = "0a3f507b-7750-32b8-e044-0003ba298018"
+other = "0a3f507b-6331-32b8-e044-0003ba298018"
+
+csv_export = """id,vejnavn,husnr,postnr,postnrnavn,betegnelse
+{},Toftebjerghaven,4,2750,Ballerup,"Toftebjerghaven 4, 2750 Ballerup"
+{},Banegårdspladsen,1,2750,Ballerup,"Banegårdspladsen 1, 1. tv, 2750 Ballerup"
+""".format(current, other)
+
+ndjson_export = "\n".join(
+    json.dumps(row)
+    for row in [
+        {
+            "id": current,
+            "postnr": "2750",
+            "postnrnavn": "Ballerup",
+            "betegnelse": "Toftebjerghaven 4, 2750 Ballerup",
+        },
+    ]
+)
+
+
+class DARRecordTests(TestCase):
+    def test_city_with_spaces(self):
+        address = {
+            "betegnelse": "Lyngby Hovedgade 1, 2800 Kongens Lyngby",
+            "postnr": "2800",
+            "postnrnavn": "Kongens Lyngby",
+        }
+        self.assertEqual(
+            dar_record(address),
+            DARRecord(
+                address["betegnelse"], "Lyngby Hovedgade 1", "2800", "Kongens Lyngby"
+            ),
+        )
+
+    def test_parts_from_betegnelse(self):
+        address = {"betegnelse": "Vestergade 2, st. th, Torup, 3390 Hundested"}
+        self.assertEqual(
+            dar_record(address),
+            DARRecord(
+                address["betegnelse"],
+                "Vestergade 2, st. th, Torup",
+                "3390",
+                "Hundested",
+            ),
+        )
+
+
+class DARIndexTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "dar.index")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_csv_export(self):
+        count = build_index(read_export(io.StringIO(csv_export)), self.path)
+        self.assertEqual(count, 2)
+
+        index = DARIndex(self.path)
+        self.assertEqual(
+            index.lookup(current),
+            DARRecord(
+                "Toftebjerghaven 4, 2750 Ballerup",
+                "Toftebjerghaven 4",
+                "2750",
+                "Ballerup",
+            ),
+        )
+        self.assertEqual(index.lookup(other).street, "Banegårdspladsen 1, 1. tv")
+        self.assertIsNone(index.lookup(str(uuid4())))
+        self.assertIsNone(index.lookup("not-an-id"))
+        index.close()
+
+    def test_ndjson_export(self):
+        build_index(read_export(io.StringIO(ndjson_export)), self.path)
+        index = DARIndex(self.path)
+        self.assertEqual(index.lookup(current).city, "Ballerup")
+        index.close()
+
+    def test_lookups_are_fast(self):
+        records = [
+            (
+                str(uuid4()),
+                DARRecord(f"Vej {n}, 2750 Ballerup", f"Vej {n}", "2750", "B"),
+            )
+            for n in range(10000)
+        ]
+        build_index(records, self.path)
+        index = DARIndex(self.path)
+        started = time.perf_counter()
+        for address_id, record in records[:1000]:
+            self.assertEqual(index.lookup(address_id), record)
+        per_lookup = (time.perf_counter() - started) / 1000
+        index.close()
+        self.assertLess(per_lookup, 0.001)
+
+    def test_last_record_wins(self):
+        def record(street):
+            return DARRecord(f"{street}, 2750 Ballerup", street, "2750", "Ballerup")
+
+        records = iter(
+            [
+                (current, record("Gammel vej 1")),
+                (other, record("Anden vej 2")),
+                (current, record("Ny vej 1")),
+            ]
+        )
+        self.assertEqual(build_index(records, self.path), 2)
+        index = DARIndex(self.path)
+        self.assertEqual(index.lookup(current), record("Ny vej 1"))
+        self.assertEqual(index.lookup(other), record("Anden vej 2"))
+        index.close()
+
+    def test_failed_build_leaves_no_files(self):
+        build_index(read_export(io.StringIO(ndjson_export)), self.path)
+
+        def broken_export():
+            yield from read_export(io.StringIO(csv_export))
+            raise ValueError("broken export")
+
+        with self.assertRaises(ValueError):
+            build_index(broken_export(), self.path)
+        with patch("app.dar_index.os.replace", side_effect=OSError("disk full")):
+            with self.assertRaises(OSError):
+                build_index(read_export(io.StringIO(csv_export)), self.path)
+
+        self.assertEqual(os.listdir(self.directory.name), ["dar.index"])
+        index = DARIndex(self.path)
+        self.assertIsNone(index.lookup(other))
+        index.close()
+
+    def test_rebuilt_index_is_reloaded(self):
+        build_index(read_export(io.StringIO(ndjson_export)), self.path)
+        index = ReloadingDARIndex(self.path, check_interval=0)
+        self.assertIsNone(index.lookup(other))
+
+        build_index(read_export(io.StringIO(csv_export)), self.path)
+        self.assertIsNotNone(index.lookup(other))
+        index.close()
+
+    def test_broken_index_is_not_reloaded(self):
+        build_index(read_export(io.StringIO(ndjson_export)), self.path)
+        index = ReloadingDARIndex(self.path, check_interval=0)
+
+        # A partly copied rebuild
+        rebuilt = os.path.join(self.directory.name, "rebuilt.index")
+        build_index(read_export(io.StringIO(csv_export)), rebuilt)
+        with open(rebuilt, "rb") as rebuilt_file:
+            content = rebuilt_file.read()
+        with open(rebuilt, "wb") as rebuilt_file:
+            rebuilt_file.write(content[:-10])
+        os.replace(rebuilt, self.path)
+        with self.assertRaises(ValueError):
+            DARIndex(self.path)
+
+        self.assertEqual(index.lookup(current).city, "Ballerup")
+        self.assertIsNone(index.lookup(other))
+        index.close()
+
+    @async_to_sync
+    async def test_fallback_on_miss(self):
+        build_index(read_export(io.StringIO(ndjson_export)), self.path)
+        online_address = DARRecord(
+            "Online 1, 2750 Ballerup", "Online 1", "2750", "Ballerup"
+        )
+        online = StandInDARResolver({other: online_address})
+        resolver = IndexedDARResolver(ReloadingDARIndex(self.path), fallback=online)
+
+        self.assertEqual((await resolver.resolve(current)).street, "Toftebjerghaven 4")
+        self.assertEqual(await resolver.resolve(other), online_address)
+        self.assertEqual(online.resolved, [other])
+        await resolver.close()
+
+    def test_cli(self):
+        export = os.path.join(self.directory.name, "export.csv")
+        with open(export, "w", encoding="utf-8") as export_file:
+            export_file.write(csv_export)
+
+        result = CliRunner().invoke(
+            sd_mox_cli, ["build-dar-index", "--export", export, "--index", self.path]
+        )
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("Indexed 2 addresses", result.output)
+        self.assertEqual(len(DARIndex(self.path)), 2)
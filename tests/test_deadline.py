@@ -0,0 +1,140 @@
+# SPDX-FileCopyrightText: Magenta ApS
+#
+# SPDX-License-Identifier: MPL-2.0
+
+import asyncio
+from types import SimpleNamespace
+from unittest import TestCase
+from unittest.mock import patch
+
+from fastapi import APIRouter, FastAPI
+from fastapi.responses import JSONResponse
+from fastapi.testclient import TestClient
+
+from app import deadline
+from app.deadline import DeadlineExceeded, DeadlineRoute
+from app.sd_mox import SDMoxError
+from app.util import async_to_sync
+from tests.test_sd_mox import EventuallyAppliedSDMox, at, check_overrides
+
+
+class DeadlineTests(TestCase):
+    def test_no_deadline(self):
+        self.assertIsNone(deadline.remaining())
+        self.assertEqual(deadline.bounded(5), 5)
+        self.assertIsNone(deadline.bounded(None))
+
+    def test_bounded(self):
+        with deadline.deadline(1):
+            self.assertLessEqual(deadline.bounded(5), 1)
+            self.assertLessEqual(deadline.bounded(None), 1)
+            self.assertEqual(deadline.bounded(0.5), 0.5)
+        self.assertIsNone(deadline.remaining())
+
+    def test_nested_deadlines_do_not_extend(self):
+        with deadline.deadline(1):
+            with deadline.deadline(10):
+                self.assertLessEqual(deadline.remaining(), 1)
+            with deadline.deadline(0.5):
+                self.assertLessEqual(deadline.remaining(), 0.5)
+
+    def test_expired(self):
+        with deadline.deadline(0):
+            with self.assertRaises(DeadlineExceeded):
+                deadline.check()
+            with self.assertRaises(DeadlineExceeded):
+                deadline.bounded(5)
+
+    @async_to_sync
+    async def test_wait_for(self):
+        with deadline.deadline(0.05):
+            with self.assertRaises(DeadlineExceeded):
+                await deadline.wait_for(asyncio.sleep(1), 5)
+        # The operation timeout still applies without running out of deadline
+        with deadline.deadline(5):
+            with self.assertRaises(asyncio.TimeoutError):
+                await deadline.wait_for(asyncio.sleep(1), 0.05)
+
+    @async_to_sync
+    async def test_verification_stops_at_deadline(self):
+        mox = EventuallyAppliedSDMox(
+            overrides={**check_overrides, "amqp_check_deadline": 10},
+            probes_until_applied=10**6,
+        )
+        with deadline.deadline(0.05):
+            with self.assertRaises(DeadlineExceeded):
+                await mox._check_unit(at, unit_uuid="uuid", unit_name="new name")
+
+    @async_to_sync
+    async def test_slow_sd_lookup(self):
+        mox = EventuallyAppliedSDMox(
+            overrides={**check_overrides, "sd_timeout": 0.05},
+            probes_until_applied=1,
+        )
+
+        async def slow(**kwargs):
+            await asyncio.sleep(1)
+
+        mox.sd_connector = SimpleNamespace(getDepartment=slow)
+        with deadline.deadline(5):
+            with self.assertRaisesRegex(SDMoxError, "SD lookup"):
+                await mox._read_department(at, unit_uuid="uuid")
+
+    @async_to_sync
+    async def test_slow_publish(self):
+        mox = EventuallyAppliedSDMox(
+            overrides={**check_overrides, "amqp_publish_timeout": 0.05},
+            probes_until_applied=1,
+        )
+
+        async def slow(body):
+            await asyncio.sleep(1)
+
+        mox.publisher = SimpleNamespace(publish=slow)
+        with deadline.deadline(5):
+            with self.assertRaisesRegex(SDMoxError, "AMQP publish"):
+                await mox._call("<xml/>")
+
+
+def route_settings(trigger_timeout, trigger_deadline_margin):
+    return patch(
+        "app.deadline.get_settings",
+        return_value=SimpleNamespace(
+            trigger_timeout=trigger_timeout,
+            trigger_deadline_margin=trigger_deadline_margin,
+        ),
+    )
+
+
+class DeadlineRouteTests(TestCase):
+    def setUp(self):
+        router = APIRouter(route_class=DeadlineRoute)
+
+        @router.get("/remaining")
+        async def remaining():
+            return {"remaining": deadline.remaining()}
+
+        @router.get("/slow")
+        async def slow():
+            await deadline.wait_for(asyncio.sleep(1))
+
+        app = FastAPI()
+        app.include_router(router)
+
+        @app.exception_handler(DeadlineExceeded)
+        async def deadline_exception_handler(request, exc):
+            return JSONResponse(status_code=504, content={"detail": str(exc)})
+
+        self.client = TestClient(app)
+
+    def test_requests_have_deadline(self):
+        with route_settings(60, 5):
+            response = self.client.get("/remaining")
+        remaining = response.json()["remaining"]
+        self.assertLessEqual(remaining, 55)
+        self.assertGreater(remaining, 50)
+
+    def test_exceeded_deadline(self):
+        with route_settings(1, 0.95):
+            response = self.client.get("/slow")
+        self.assertEqual(response.status_code, 504)
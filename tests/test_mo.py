@@ -0,0 +1,202 @@
+# SPDX-FileCopyrightText: Magenta ApS
+#
+# SPDX-License-Identifier: MPL-2.0
+
+import asyncio
+from unittest import TestCase
+from unittest.mock import patch
+
+from aiohttp import ClientResponseError, web
+from aiohttp.test_utils import TestServer
+
+from app import deadline
+from app.config import get_settings
+from app.mo import (
+    AsyncMoraHelper,
+    close_async_mora_helpers,
+    get_async_mora_helper,
+    shared_reads,
+)
+from app.util import async_to_sync
+from tests.test_sd_mox import mox_overrides
+
+unit_uuid = "25abf6f4-fa38-5bd8-b217-7130ce3552cd"
+
+addresses = [
+    {
+        "address_type": {"scope": "DAR", "uuid": "dar-type"},
+        "name": "Toftebjerghaven 4, 2750 Ballerup",
+        "value": "0a3f507b-7750-32b8-e044-0003ba298018",
+        "uuid": "address-1",
+    },
+    {
+        "address_type": {"scope": "PHONE", "uuid": "phone-type"},
+        "name": "12345678",
+        "value": "12345678",
+        "uuid": "address-2",
+    },
+]
+
+
+def mo_stand_in(requests):
+    async def read_ou(request):
+        request["peername"] = request.transport.get_extra_info("peername")
+        requests.append(request)
+        return web.json_response({"uuid": request.match_info["uuid"]})
+
+    async def read_ou_address(request):
+        requests.append(request)
+        return web.json_response(addresses)
+
+    async def slow(request):
+        await asyncio.sleep(1)
+        return web.json_response({})
+
+    async def flaky(request):
+        requests.append(request)
+        if len(requests) < 3:
+            raise web.HTTPServiceUnavailable()
+        return web.json_response({})
+
+    async def read_organisation(request):
+        requests.append(request)
+        return web.json_response([{"uuid": "root-uuid"}])
+
+    app = web.Application()
+    app.router.add_get("/service/o/", read_organisation)
+    app.router.add_get("/service/ou/{uuid}/", read_ou)
+    app.router.add_get("/service/ou/{uuid}/details/address", read_ou_address)
+    app.router.add_get("/service/slow/", slow)
+    app.router.add_get("/service/flaky/", flaky)
+    return app
+
+
+class AsyncMoraHelperTests(TestCase):
+    @async_to_sync
+    async def test_read_ou(self):
+        requests = []
+        async with TestServer(mo_stand_in(requests)) as server:
+            helper = AsyncMoraHelper(str(server.make_url("")).rstrip("/"))
+            ou = await helper.read_ou(unit_uuid, at="2021-01-01")
+            await helper.close()
+
+        self.assertEqual(ou, {"uuid": unit_uuid})
+        self.assertEqual(requests[0].query["at"], "2021-01-01")
+
+    @async_to_sync
+    async def test_read_ou_address(self):
+        async with TestServer(mo_stand_in([])) as server:
+            helper = AsyncMoraHelper(str(server.make_url("")).rstrip("/"))
+            first_dar = await helper.read_ou_address(unit_uuid)
+            everything = await helper.read_ou_address(
+                unit_uuid, scope=None, return_all=True, reformat=False
+            )
+            await helper.close()
+
+        self.assertEqual(
+            first_dar,
+            {
+                "type": "dar-type",
+                "visibility": None,
+                "visibibility": None,
+                "Adresse": "Toftebjerghaven 4, 2750 Ballerup",
+                "value": "0a3f507b-7750-32b8-e044-0003ba298018",
+                "uuid": "address-1",
+            },
+        )
+        self.assertEqual(everything, addresses)
+
+    @async_to_sync
+    async def test_connections_are_reused(self):
+        requests = []
+        async with TestServer(mo_stand_in(requests)) as server:
+            helper = AsyncMoraHelper(str(server.make_url("")).rstrip("/"))
+            for _ in range(5):
+                await helper.read_ou(unit_uuid)
+            await helper.close()
+
+        peers = {request["peername"] for request in requests}
+        self.assertEqual(len(peers), 1)
+
+    @async_to_sync
+    async def test_timeout(self):
+        async with TestServer(mo_stand_in([])) as server:
+            helper = AsyncMoraHelper(str(server.make_url("")).rstrip("/"))
+            with self.assertRaises(asyncio.TimeoutError):
+                await helper._mo_lookup(None, "slow/", timeout=0.1)
+            await helper.close()
+
+    @async_to_sync
+    async def test_retry(self):
+        requests = []
+        async with TestServer(mo_stand_in(requests)) as server:
+            helper = AsyncMoraHelper(
+                str(server.make_url("")).rstrip("/"), retry_delay=0.01
+            )
+            self.assertEqual(await helper._mo_lookup(None, "flaky/"), {})
+            await helper.close()
+
+        self.assertEqual(len(requests), 3)
+
+    @async_to_sync
+    async def test_retries_stay_within_the_deadline(self):
+        requests = []
+        async with TestServer(mo_stand_in(requests)) as server:
+            helper = AsyncMoraHelper(
+                str(server.make_url("")).rstrip("/"), retry_delay=0.2
+            )
+            with deadline.deadline(0.3):
+                with self.assertRaises(ClientResponseError):
+                    await helper._mo_lookup(None, "flaky/")
+            await helper.close()
+
+        # The second retry would end after the deadline
+        self.assertEqual(len(requests), 2)
+
+    @async_to_sync
+    async def test_shared_reads(self):
+        requests = []
+        async with TestServer(mo_stand_in(requests)) as server:
+            helper = AsyncMoraHelper(str(server.make_url("")).rstrip("/"))
+            with shared_reads():
+                first, second = await asyncio.gather(
+                    helper.read_ou(unit_uuid, at="2021-01-01"),
+                    helper.read_ou(unit_uuid, at="2021-01-01"),
+                )
+                first["name"] = "changed"
+                third = await helper.read_ou(unit_uuid, at="2021-01-01")
+                await helper.read_ou(unit_uuid, at="2021-02-01")
+            # Outside the block every read is a request
+            await helper.read_ou(unit_uuid, at="2021-01-01")
+            await helper.close()
+
+        self.assertEqual(second, {"uuid": unit_uuid})
+        self.assertEqual(third, {"uuid": unit_uuid})
+        self.assertEqual(len(requests), 3)
+
+    @async_to_sync
+    async def test_organisation_is_read_once(self):
+        requests = []
+        async with TestServer(mo_stand_in(requests)) as server:
+            helper = AsyncMoraHelper(str(server.make_url("")).rstrip("/"))
+            self.assertEqual(await helper.read_organisation(), "root-uuid")
+            self.assertEqual(await helper.read_organisation(), "root-uuid")
+            await helper.close()
+
+        self.assertEqual(len(requests), 1)
+
+
+class MoraHelperRegistryTests(TestCase):
+    @async_to_sync
+    async def test_changed_settings_get_a_new_helper(self):
+        settings = get_settings(**mox_overrides)
+        reloaded = get_settings(**mox_overrides, mora_timeout=1)
+        with patch("app.mo._helpers", {}) as helpers:
+            helper = get_async_mora_helper(settings)
+            self.assertIs(get_async_mora_helper(get_settings(**mox_overrides)), helper)
+            new_helper = get_async_mora_helper(reloaded)
+            self.assertIsNot(new_helper, helper)
+            self.assertEqual(new_helper.timeout, 1)
+
+            await close_async_mora_helpers(keep=reloaded)
+            self.assertEqual(list(helpers.values()), [new_helper])
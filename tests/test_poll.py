@@ -0,0 +1,45 @@
+# SPDX-FileCopyrightText: Magenta ApS
+#
+# SPDX-License-Identifier: MPL-2.0
+
+from itertools import islice
+from unittest import TestCase
+
+from app.poll import ApplyLatency, PollSchedule
+
+
+class PollScheduleTests(TestCase):
+    def test_exponential_backoff(self):
+        schedule = PollSchedule(0.5, factor=2, max_delay=3, jitter=0)
+        delays = list(islice(schedule.delays(), 6))
+        self.assertEqual(delays, [0.5, 1, 2, 3, 3, 3])
+
+    def test_first_delay_override(self):
+        schedule = PollSchedule(0.5, factor=2, max_delay=3, jitter=0)
+        delays = list(islice(schedule.delays(first_delay=1.5), 3))
+        self.assertEqual(delays, [1.5, 3, 3])
+
+    def test_jitter(self):
+        low = PollSchedule(1, factor=1, jitter=0.2, rng=lambda: 0.0)
+        high = PollSchedule(1, factor=1, jitter=0.2, rng=lambda: 1.0)
+        self.assertAlmostEqual(next(low.delays()), 0.8)
+        self.assertAlmostEqual(next(high.delays()), 1.2)
+
+
+class ApplyLatencyTests(TestCase):
+    def test_no_samples(self):
+        self.assertIsNone(ApplyLatency(0.1, 3).first_delay())
+
+    def test_quantile_of_recent_samples(self):
+        latency = ApplyLatency(0.1, 3, quantile=0.5, window=5)
+        for sample in [9, 9, 9, 1.0, 1.2, 0.8, 1.1, 0.9]:
+            latency.record(sample)
+        self.assertEqual(latency.first_delay(), 1.0)
+
+    def test_clamped(self):
+        latency = ApplyLatency(0.1, 3)
+        latency.record(10)
+        self.assertEqual(latency.first_delay(), 3)
+        latency = ApplyLatency(0.1, 3)
+        latency.record(0.01)
+        self.assertEqual(latency.first_delay(), 0.1)
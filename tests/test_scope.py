@@ -0,0 +1,162 @@
+# SPDX-FileCopyrightText: Magenta ApS
+#
+# SPDX-License-Identifier: MPL-2.0
+
+import asyncio
+from datetime import date, timedelta
+from unittest import TestCase
+from uuid import UUID
+
+from app.scope import ScopeIndex
+from app.util import async_to_sync
+
+top = "11111111-0000-0000-0000-000000000000"
+triggered = "22222222-0000-0000-0000-000000000000"
+child = "33333333-0000-0000-0000-000000000000"
+grandchild = "44444444-0000-0000-0000-000000000000"
+other = "55555555-0000-0000-0000-000000000000"
+
+
+class StandInMO:
+    """Tree of units: top > triggered > child > grandchild, and other."""
+
+    def __init__(self):
+        self.children = {
+            triggered: [{"uuid": child, "child_count": 1}],
+            child: [{"uuid": grandchild, "child_count": 0}],
+        }
+        self.reads = []
+
+    async def read_ou(self, uuid, at=None):
+        self.reads.append(uuid)
+        return {"uuid": uuid, "parent": {"uuid": top, "parent": None}}
+
+    async def read_ou_children(self, uuid, at=None):
+        self.reads.append(uuid)
+        return self.children.get(uuid, [])
+
+
+class PausedMO(StandInMO):
+    """MO which pauses reading the children of the triggered unit."""
+
+    def __init__(self):
+        super().__init__()
+        self.reading = asyncio.Event()
+        self.resume = asyncio.Event()
+
+    async def read_ou_children(self, uuid, at=None):
+        if uuid == triggered:
+            self.reading.set()
+            await self.resume.wait()
+        return await super().read_ou_children(uuid, at)
+
+
+class ScopeIndexTests(TestCase):
+    def setUp(self):
+        self.index = ScopeIndex(frozenset([UUID(triggered)]))
+
+    @async_to_sync
+    async def test_load(self):
+        mo = StandInMO()
+        await self.index.load(mo)
+
+        self.assertFalse(self.index.in_scope(top))
+        self.assertTrue(self.index.in_scope(triggered))
+        self.assertTrue(self.index.in_scope(UUID(grandchild)))
+        self.assertIsNone(self.index.in_scope(other))
+        # The leaf is not asked for children
+        self.assertNotIn(grandchild, mo.reads)
+
+    def test_learn(self):
+        self.index.learn(
+            {"uuid": child, "parent": {"uuid": triggered, "parent": {"uuid": top}}}
+        )
+        self.assertTrue(self.index.in_scope(child))
+        self.assertFalse(self.index.in_scope(top))
+        self.assertEqual(len(self.index), 3)
+
+    @async_to_sync
+    async def test_moves_update_the_subtree(self):
+        await self.index.load(StandInMO())
+        self.index.add(other, top)
+        self.assertFalse(self.index.in_scope(other))
+
+        self.index.add(child, other)
+        self.assertFalse(self.index.in_scope(child))
+        self.assertFalse(self.index.in_scope(grandchild))
+
+        self.index.add(other, triggered)
+        self.assertTrue(self.index.in_scope(grandchild))
+
+    @async_to_sync
+    async def test_move_under_unknown_parent(self):
+        await self.index.load(StandInMO())
+        self.index.add(child, other)
+        self.assertIsNone(self.index.in_scope(child))
+        self.assertIsNone(self.index.in_scope(grandchild))
+        self.assertTrue(self.index.in_scope(triggered))
+
+    @async_to_sync
+    async def test_future_dated_move(self):
+        await self.index.load(StandInMO())
+        self.index.add(other, top)
+        today = date.today()
+        later = today + timedelta(days=30)
+        self.index.add(child, other, later)
+
+        # The move does not hold yet, so the scope today must be read
+        self.assertIsNone(self.index.in_scope(child))
+        self.assertIsNone(self.index.in_scope(grandchild, today))
+        self.assertFalse(self.index.in_scope(grandchild, later))
+        self.assertTrue(self.index.in_scope(triggered, today))
+
+        # MO read today does not undo the move
+        self.index.learn({"uuid": child, "parent": {"uuid": triggered}}, today)
+        self.assertIsNone(self.index.in_scope(child, today))
+        self.assertFalse(self.index.in_scope(child, later))
+
+    def test_past_is_not_known(self):
+        self.index.learn({"uuid": child, "parent": {"uuid": triggered}})
+        past = date.today() - timedelta(days=1)
+        self.assertTrue(self.index.in_scope(child))
+        self.assertIsNone(self.index.in_scope(child, past))
+
+        # Nor is it learned from MO
+        self.index.learn({"uuid": other, "parent": {"uuid": triggered}}, past)
+        self.assertIsNone(self.index.in_scope(other))
+
+    @async_to_sync
+    async def test_load_keeps_newer_changes(self):
+        mo = PausedMO()
+        loading = asyncio.ensure_future(self.index.load(mo))
+        await mo.reading.wait()
+
+        # Moved out of scope while the load reads MO
+        self.index.add(other, top)
+        self.index.add(child, other)
+        mo.resume.set()
+        await loading
+
+        self.assertFalse(self.index.in_scope(child))
+        self.assertFalse(self.index.in_scope(grandchild))
+        self.assertTrue(self.index.in_scope(triggered))
+
+    @async_to_sync
+    async def test_out_of_scope_expires(self):
+        now = [0.0]
+        index = ScopeIndex(
+            frozenset([UUID(triggered)]), negative_ttl=10, clock=lambda: now[0]
+        )
+        await index.load(StandInMO())
+        index.add(other, top)
+        self.assertFalse(index.in_scope(other))
+
+        now[0] = 11
+        self.assertIsNone(index.in_scope(other))
+        self.assertIsNone(index.in_scope(top))
+        # Units in scope are kept, as is the chain of parents above them
+        self.assertTrue(index.in_scope(grandchild))
+        self.assertEqual(len(index), 4)
+
+        index.add(other, top)
+        self.assertFalse(index.in_scope(other))
@@ -0,0 +1,271 @@
+# SPDX-FileCopyrightText: Magenta ApS
+#
+# SPDX-License-Identifier: MPL-2.0
+
+import asyncio
+import datetime
+from unittest import TestCase
+
+from app.sd_mirror import SDMirror, SDSnapshot
+from app.sd_mox import SDMoxError
+from app.util import async_to_sync
+from tests import test_sd_mox as sd_mox_tests
+from tests.test_cache import FakeClock
+
+at = datetime.date(2019, 7, 1)
+
+departments = [
+    {
+        "DepartmentIdentifier": "TOP",
+        "DepartmentUUIDIdentifier": "uuid-top",
+        "DepartmentLevelIdentifier": "NY1-niveau",
+    },
+    {
+        "DepartmentIdentifier": "AB12",
+        "DepartmentUUIDIdentifier": "uuid-ab12",
+        "DepartmentLevelIdentifier": "Afdelings-niveau",
+    },
+    {
+        "DepartmentIdentifier": "DUP",
+        "DepartmentUUIDIdentifier": "uuid-dup-1",
+        "DepartmentLevelIdentifier": "Afdelings-niveau",
+    },
+    {
+        "DepartmentIdentifier": "DUP",
+        "DepartmentUUIDIdentifier": "uuid-dup-2",
+        "DepartmentLevelIdentifier": "Afdelings-niveau",
+    },
+]
+
+organization = {
+    "Organization": {
+        "DepartmentReference": [
+            {
+                "DepartmentUUIDIdentifier": "uuid-ab12",
+                "DepartmentReference": {"DepartmentUUIDIdentifier": "uuid-top"},
+            },
+        ]
+    }
+}
+
+
+class StandInSDConnector:
+    def __init__(self, departments=departments):
+        self.departments = departments
+        self.calls = 0
+
+    async def getDepartment(self, **kwargs):
+        self.calls += 1
+        if "department_identifier" in kwargs:
+            raise AssertionError("Pre-flight check read SD")
+        return {"Department": self.departments}
+
+    async def getOrganization(self, **kwargs):
+        self.calls += 1
+        return organization
+
+
+class SDSnapshotTests(TestCase):
+    def setUp(self):
+        self.snapshot = SDSnapshot(
+            departments, organization["Organization"]["DepartmentReference"]
+        )
+
+    def test_find(self):
+        self.assertEqual(self.snapshot.find(unit_uuid="uuid-ab12"), [departments[1]])
+        self.assertEqual(self.snapshot.find(unit_code="TOP"), [departments[0]])
+        self.assertEqual(len(self.snapshot.find(unit_code="DUP")), 2)
+        self.assertEqual(self.snapshot.find(unit_code="TOP", unit_level="NY2"), [])
+        self.assertEqual(len(self.snapshot.find(unit_level="Afdelings-niveau")), 3)
+        self.assertEqual(self.snapshot.find(unit_code="NEW"), [])
+
+    def test_parent(self):
+        self.assertEqual(self.snapshot.parent("uuid-ab12"), "uuid-top")
+        self.assertIsNone(self.snapshot.parent("uuid-top"))
+
+    def test_patch_stale_unit(self):
+        self.snapshot.mark_stale("uuid-ab12", "CD34")
+        self.assertFalse(self.snapshot.knows(unit_uuid="uuid-ab12"))
+        self.assertFalse(self.snapshot.knows(unit_code="AB12"))
+        self.assertFalse(self.snapshot.knows(unit_code="CD34"))
+        self.assertFalse(self.snapshot.knows())
+        self.assertTrue(self.snapshot.knows(unit_code="TOP"))
+
+        changed = {**departments[1], "DepartmentIdentifier": "CD34"}
+        self.snapshot.patch(changed, parent="uuid-dup-1")
+        self.assertTrue(self.snapshot.knows())
+        self.assertEqual(self.snapshot.find(unit_code="CD34"), [changed])
+        self.assertEqual(self.snapshot.find(unit_code="AB12"), [])
+        self.assertEqual(len(self.snapshot.find(unit_level="Afdelings-niveau")), 3)
+        self.assertEqual(self.snapshot.parent("uuid-ab12"), "uuid-dup-1")
+
+
+class SDMirrorTests(TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.connector = StandInSDConnector()
+        self.mirror = SDMirror(self.connector, max_age=10, clock=self.clock)
+
+    @async_to_sync
+    async def test_stale_snapshots_are_not_served(self):
+        self.assertIsNone(self.mirror.snapshot(at))
+        _, refresh = self.mirror._refreshing[at]
+        await refresh
+        self.assertIsNotNone(self.mirror.snapshot(at))
+        self.clock.now = 11
+        self.assertIsNone(self.mirror.snapshot(at))
+
+    @async_to_sync
+    async def test_invalidate_discards_refresh_in_flight(self):
+        refresh = asyncio.ensure_future(self.mirror.refresh(at))
+        await asyncio.sleep(0)
+        self.mirror.invalidate()
+        await refresh
+        self.assertIsNone(self.mirror.snapshot(at))
+
+    @async_to_sync
+    async def test_least_recently_used_dates_are_dropped(self):
+        mirror = SDMirror(self.connector, max_age=10, clock=self.clock, max_dates=2)
+        dates = [at.replace(month=month) for month in (1, 2, 3)]
+        for day in dates[:2]:
+            await mirror.refresh(day)
+        mirror.snapshot(dates[0])
+
+        # The second date is now the least recently used
+        mirror.snapshot(dates[2])
+        self.assertEqual(list(mirror._dates), [dates[0], dates[2]])
+        self.assertNotIn(dates[1], mirror._snapshots)
+        await mirror.close()
+
+        calls = self.connector.calls
+        mirror.refresh_soon()
+        await asyncio.gather(*(task for _, task in mirror._refreshing.values()))
+        self.assertEqual(self.connector.calls, calls + 4)
+        self.assertEqual(set(mirror._snapshots), {dates[0], dates[2]})
+
+    @async_to_sync
+    async def test_invalidate_marks_only_the_unit(self):
+        later = at.replace(month=8)
+        await self.mirror.refresh(at)
+        await self.mirror.refresh(later)
+        self.mirror.invalidate(later, "uuid-ab12", "AB12")
+
+        self.assertTrue(self.mirror.snapshot(at).knows(unit_uuid="uuid-ab12"))
+        snapshot = self.mirror.snapshot(later)
+        self.assertFalse(snapshot.knows(unit_uuid="uuid-ab12"))
+        self.assertTrue(snapshot.knows(unit_code="TOP"))
+
+        # Refreshes made before the change is settled do not answer for it
+        await self.mirror.refresh(later)
+        self.assertFalse(self.mirror.snapshot(later).knows(unit_code="AB12"))
+
+        calls = self.connector.calls
+        renamed = {**departments[1], "DepartmentName": "renamed"}
+        self.mirror.settle(later, "uuid-ab12", "AB12", department=renamed)
+        self.assertEqual(self.mirror.snapshot(later).find(unit_code="AB12"), [renamed])
+        self.assertEqual(self.connector.calls, calls)
+        self.assertEqual(self.mirror._refreshing, {})
+
+    @async_to_sync
+    async def test_unsettled_changes_expire(self):
+        self.mirror.invalidate(at, "uuid-ab12", "AB12")
+        self.clock.now = 11
+        await self.mirror.refresh(at)
+        self.assertTrue(self.mirror.snapshot(at).knows(unit_code="AB12"))
+
+    @async_to_sync
+    async def test_refresh_is_limited(self):
+        limit = asyncio.Semaphore(1)
+        mirror = SDMirror(self.connector, max_age=10, clock=self.clock, limit=limit)
+        async with limit:
+            refresh = asyncio.ensure_future(mirror.refresh(at))
+            await asyncio.sleep(0.01)
+            self.assertEqual(self.connector.calls, 0)
+        await refresh
+        self.assertEqual(self.connector.calls, 2)
+
+    @async_to_sync
+    async def test_periodic_refresh(self):
+        self.mirror.snapshot(at)
+        self.mirror.start(0.01)
+        await asyncio.sleep(0.05)
+        await self.mirror.close()
+        self.assertGreater(self.connector.calls, 2)
+
+
+class MirroredSDMoxTests(TestCase):
+    def setUp(self):
+        overrides = {**sd_mox_tests.mox_overrides, "sd_mirror": True}
+        self.mox = sd_mox_tests.TestableSDMox(overrides=overrides)
+        self.mox.sd_connector = self.mox.sd_mirror.sd_connector = StandInSDConnector()
+
+    @async_to_sync
+    async def test_preflight_checks_use_mirror(self):
+        await self.mox.sd_mirror.refresh(at)
+        self.assertEqual(await self.mox._validate_unit_code("NEW", at), [])
+        self.assertEqual(
+            await self.mox._validate_unit_code("AB12", at), ["Enhedsnummer er i brug"]
+        )
+        parent = await self.mox._lookup_department(
+            at, unit_code="TOP", unit_level="NY1-niveau"
+        )
+        self.assertEqual(parent, departments[0])
+        with self.assertRaises(SDMoxError):
+            await self.mox._lookup_department(at, unit_code="DUP")
+
+    @async_to_sync
+    async def test_publish_invalidates_mirror(self):
+        await self.mox.sd_mirror.refresh(at)
+        self.mox.publisher = sd_mox_tests.RecordingPublisher()
+        await self.mox._call("<xml/>")
+        self.assertIsNone(self.mox.sd_mirror._snapshots.get(at))
+
+    @async_to_sync
+    async def test_publish_invalidates_the_unit(self):
+        await self.mox.sd_mirror.refresh(at)
+        self.mox.publisher = sd_mox_tests.RecordingPublisher()
+        await self.mox._call("<xml/>", at, unit_uuid="uuid-ab12", unit_code="AB12")
+        self.assertEqual(
+            self.mox.sd_mirror._snapshots[at][1].find(unit_code="TOP"), [departments[0]]
+        )
+
+        # Only the unit being changed is read from SD
+        self.assertEqual(
+            await self.mox._lookup_department(at, unit_code="TOP"), departments[0]
+        )
+        with self.assertRaisesRegex(AssertionError, "read SD"):
+            await self.mox._lookup_department(at, unit_code="AB12")
+
+    @async_to_sync
+    async def test_verified_change_is_patched_into_mirror(self):
+        unit, parent = sd_mox_tests.moved_unit, sd_mox_tests.new_parent
+        mox = sd_mox_tests.StandInSDMox(
+            overrides={**sd_mox_tests.check_overrides, "sd_mirror": True},
+            units={unit["uuid"]: unit, parent["uuid"]: parent},
+        )
+        connector = mox.sd_mirror.sd_connector = StandInSDConnector(
+            [
+                {
+                    "DepartmentIdentifier": parent["user_key"],
+                    "DepartmentUUIDIdentifier": parent["uuid"],
+                    "DepartmentLevelIdentifier": "NY1-niveau",
+                },
+                {
+                    "DepartmentIdentifier": unit["user_key"],
+                    "DepartmentUUIDIdentifier": unit["uuid"],
+                    "DepartmentLevelIdentifier": "Afdelings-niveau",
+                    "DepartmentName": unit["name"],
+                },
+            ]
+        )
+        await mox.sd_mirror.refresh(at)
+        mox.applied = {"DepartmentName": "new name"}
+        await mox.rename_and_move_unit(unit["uuid"], "new name", parent["uuid"], at=at)
+
+        # The organisation is not read again
+        self.assertEqual(connector.calls, 2)
+        snapshot = mox.sd_mirror.snapshot(at)
+        self.assertTrue(snapshot.knows(unit_uuid=unit["uuid"]))
+        (department,) = snapshot.find(unit_uuid=unit["uuid"])
+        self.assertEqual(department["DepartmentName"], "new name")
+        self.assertEqual(snapshot.parent(unit["uuid"]), parent["uuid"])
@@ -2,7 +2,10 @@
 #
 # SPDX-License-Identifier: MPL-2.0
 
+import asyncio
 import datetime
+import sys
+import time
 from collections import OrderedDict
 from functools import partial
 from os import path
@@ -12,10 +15,10 @@ from unittest import TestCase
 from freezegun import freeze_time
 from xmltodict import parse
 
-import sys
-
 sys.path.insert(0, "app")
-from app.sd_mox import SDMox
+from app.dar import BaseDARResolver, DARRecord
+from app.sd_mox import SDMox, SDMoxError
+from app.util import async_to_sync
 
 xmlparse = partial(parse, dict_constructor=dict)
 
@@ -57,15 +60,493 @@ mox_overrides = {
 
 
 class TestableSDMox(SDMox):
-    def _read_ou_levelkeys(self) -> OrderedDictType[str, str]:
+    async def _read_ou_levelkeys(self) -> OrderedDictType[str, str]:
         return OrderedDict()
 
 
+class ClassMapSDMox(SDMox):
+    async def _fetch_class_map(self, facet_bvn):
+        return {"Afdelings-niveau": "uuid-b", "NY1-niveau": "uuid-c"}
+
+
+class LevelTests(TestCase):
+    @async_to_sync
+    async def test_load_levels(self):
+        overrides = {
+            **mox_overrides,
+            "ou_levelkeys": ["NY1-niveau", "Afdelings-niveau"],
+        }
+        mox = ClassMapSDMox(overrides=overrides)
+        await mox.load_levels()
+        self.assertEqual(
+            mox.sd_levels,
+            OrderedDict([("NY1-niveau", "uuid-c"), ("Afdelings-niveau", "uuid-b")]),
+        )
+        self.assertEqual(mox.level_by_uuid["uuid-c"], "NY1-niveau")
+
+    @async_to_sync
+    async def test_missing_level_fails_fast(self):
+        overrides = {**mox_overrides, "ou_levelkeys": ["NY2-niveau"]}
+        mox = ClassMapSDMox(overrides=overrides)
+        with self.assertRaises(SDMoxError):
+            await mox.load_levels()
+
+
+class EventuallyAppliedSDMox(TestableSDMox):
+    """SD stand-in which applies the change after a number of probes."""
+
+    def __init__(self, *args, probes_until_applied, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.probes = 0
+        self.probes_until_applied = probes_until_applied
+
+    async def _check_department(self, at, **payload):
+        self.probes += 1
+        if self.probes < self.probes_until_applied:
+            return {"DepartmentName": "old name"}, ["Name"]
+        return {"DepartmentName": payload["unit_name"]}, []
+
+
+check_overrides = {
+    **mox_overrides,
+    "amqp_check_first_delay": 0.001,
+    "amqp_check_max_delay": 0.005,
+    "amqp_check_deadline": 0.2,
+}
+at = datetime.date(2019, 7, 1)
+
+
+class CheckUnitTests(TestCase):
+    @async_to_sync
+    async def test_polls_until_fields_match(self):
+        mox = EventuallyAppliedSDMox(overrides=check_overrides, probes_until_applied=4)
+        unit = await mox._check_unit(at, unit_uuid="uuid", unit_name="new name")
+        self.assertEqual(unit, {"DepartmentName": "new name"})
+        self.assertEqual(mox.probes, 4)
+        self.assertEqual(len(mox.apply_latency.samples), 1)
+
+    @async_to_sync
+    async def test_gives_up_at_deadline(self):
+        overrides = {**check_overrides, "amqp_check_deadline": 0.05}
+        mox = EventuallyAppliedSDMox(overrides=overrides, probes_until_applied=10**6)
+        with self.assertRaisesRegex(SDMoxError, "Name"):
+            await mox._check_unit(at, unit_uuid="uuid", unit_name="new name")
+        self.assertGreater(mox.probes, 1)
+        self.assertEqual(len(mox.apply_latency.samples), 0)
+
+    @async_to_sync
+    async def test_learned_delay_does_not_grow(self):
+        overrides = {
+            **check_overrides,
+            "amqp_check_first_delay": 0.02,
+            "amqp_check_max_delay": 0.2,
+            "amqp_check_learn_delay": True,
+        }
+        # SD applies every change at once
+        mox = EventuallyAppliedSDMox(overrides=overrides, probes_until_applied=1)
+        learned = []
+        for _ in range(8):
+            await mox._check_unit(at, unit_uuid="uuid", unit_name="new name")
+            learned.append(mox.apply_latency.first_delay())
+        self.assertLessEqual(max(learned), 0.02)
+        self.assertEqual(learned[-1], mox.apply_latency.minimum)
+
+    @async_to_sync
+    async def test_learned_first_delay(self):
+        overrides = {**check_overrides, "amqp_check_learn_delay": True}
+        mox = EventuallyAppliedSDMox(overrides=overrides, probes_until_applied=1)
+        mox.apply_latency.record(0.05)
+        await mox._check_unit(at, unit_uuid="uuid", unit_name="new name")
+        # Half of the learned delay, clamped to amqp_check_max_delay
+        self.assertGreaterEqual(mox.apply_latency.samples[-1], 0.002)
+
+
+class RecordingPublisher:
+    def __init__(self):
+        self.published = []
+
+    async def publish(self, body):
+        self.published.append(xmlparse(body))
+
+
+class StandInMO:
+    def __init__(self, units):
+        self.units = units
+        self.addresses = {}
+        self.reads = 0
+
+    async def read_ou(self, uuid, at=None):
+        self.reads += 1
+        return dict(self.units[str(uuid)])
+
+    async def read_ou_address(self, uuid, at=None, **kwargs):
+        self.reads += 1
+        return list(self.addresses.get(str(uuid), []))
+
+
+class StandInSDMox(TestableSDMox):
+    """SDMox against stand-ins for MO and SD, where SD applies changes at once."""
+
+    def __init__(self, *args, units, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.mo = StandInMO(units)
+        self.publisher = RecordingPublisher()
+        self.department_reads = 0
+        self.applied = {}
+        self.sd_levels = OrderedDict(
+            [("NY1-niveau", "uuid-c"), ("Afdelings-niveau", "uuid-b")]
+        )
+        self.level_by_uuid = {v: k for k, v in self.sd_levels.items()}
+
+    def _get_mora_helper(self):
+        return self.mo
+
+    async def load_levels(self):
+        pass
+
+    async def _read_department(
+        self, at, unit_code=None, unit_uuid=None, unit_level=None
+    ):
+        self.department_reads += 1
+        if unit_uuid is None:
+            # Parents exist, new unit codes do not
+            if unit_level is None:
+                return None
+            return {"DepartmentLevelIdentifier": "NY1-niveau"}
+        unit = self.mo.units[unit_uuid]
+        return {
+            "ActivationDate": at.strftime("%Y-%m-%d"),
+            "DepartmentName": unit["name"],
+            "DepartmentIdentifier": unit["user_key"],
+            "DepartmentUUIDIdentifier": unit_uuid,
+            "DepartmentLevelIdentifier": "Afdelings-niveau",
+            **self.applied,
+        }
+
+    async def _read_parent(self, at, unit_uuid=None):
+        return {"DepartmentUUIDIdentifier": new_parent["uuid"]}
+
+
+moved_unit = {
+    "name": "old name",
+    "uuid": "12345-33-33-33-12345",
+    "org_unit_level": {"uuid": "uuid-b"},
+    "user_key": "AB12",
+}
+new_parent = {
+    "name": "new parent",
+    "uuid": "12345-44-44-44-12345",
+    "org_unit_level": {"uuid": "uuid-c"},
+    "user_key": "CD34",
+}
+
+
+class RenameAndMoveTests(TestCase):
+    @async_to_sync
+    async def test_rename_and_move_verifies_once(self):
+        mox = StandInSDMox(
+            overrides=check_overrides,
+            units={new_parent["uuid"]: new_parent, moved_unit["uuid"]: moved_unit},
+        )
+        mox.applied = {"DepartmentName": "new name"}
+        await mox.rename_and_move_unit(
+            moved_unit["uuid"], "new name", new_parent["uuid"], at=at
+        )
+
+        # A ret message followed by a flyt message
+        self.assertEqual(len(mox.publisher.published), 2)
+        ret, flyt = mox.publisher.published
+        self.assertNotEqual(ret, flyt)
+        # Unit, addresses and the new parent
+        self.assertEqual(mox.mo.reads, 3)
+        # The new parent on moving, and the unit on a single verification
+        self.assertEqual(mox.department_reads, 2)
+
+    @async_to_sync
+    async def test_invalid_parent_publishes_nothing(self):
+        # The parent is at the same level as the unit
+        unit = {**moved_unit, "org_unit_level": {"uuid": "uuid-c"}}
+        mox = StandInSDMox(
+            overrides=check_overrides,
+            units={new_parent["uuid"]: new_parent, unit["uuid"]: unit},
+        )
+        with self.assertRaisesRegex(SDMoxError, "forældreenheden"):
+            await mox.rename_and_move_unit(
+                unit["uuid"], "new name", new_parent["uuid"], at=at
+            )
+        self.assertEqual(mox.publisher.published, [])
+
+
+class CreateUnitTests(TestCase):
+    @async_to_sync
+    async def test_create_with_addresses_verifies_once(self):
+        mox = StandInSDMox(
+            overrides=check_overrides,
+            units={new_parent["uuid"]: new_parent, moved_unit["uuid"]: moved_unit},
+        )
+        mox.applied = {
+            "ContactInformation": {"TelephoneNumberIdentifier": ["12345678"]}
+        }
+        unit_data = {
+            **moved_unit,
+            "details": [
+                {
+                    "address_type": {"scope": "PHONE", "user_key": "Telefon"},
+                    "value": "12345678",
+                }
+            ],
+        }
+        await mox.create_unit(moved_unit["uuid"], unit_data, new_parent, at=at)
+
+        # An import message followed by a ret message
+        self.assertEqual(len(mox.publisher.published), 2)
+        # Unit code, parent, and the unit on a single verification
+        self.assertEqual(mox.department_reads, 3)
+
+    @async_to_sync
+    async def test_create_verifies_addresses(self):
+        mox = StandInSDMox(
+            overrides={**check_overrides, "amqp_check_deadline": 0.02},
+            units={new_parent["uuid"]: new_parent, moved_unit["uuid"]: moved_unit},
+        )
+        unit_data = {
+            **moved_unit,
+            "details": [
+                {
+                    "address_type": {"scope": "PHONE", "user_key": "Telefon"},
+                    "value": "12345678",
+                }
+            ],
+        }
+        with self.assertRaisesRegex(SDMoxError, "Phone"):
+            await mox.create_unit(moved_unit["uuid"], unit_data, new_parent, at=at)
+
+
+class SlowSDConnector:
+    """SD stand-in which answers after a delay, and tracks overlapping calls."""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def _answer(self, answer):
+        self.calls += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.latency)
+            return answer
+        finally:
+            self.in_flight -= 1
+
+    async def getDepartment(self, department_identifier, **kwargs):
+        if department_identifier == "NEW":
+            return await self._answer({})
+        return await self._answer(
+            {
+                "Department": {
+                    "DepartmentIdentifier": department_identifier,
+                    "DepartmentUUIDIdentifier": department_identifier,
+                    "DepartmentLevelIdentifier": "NY1-niveau",
+                }
+            }
+        )
+
+    async def getDepartmentParent(self, **kwargs):
+        return await self._answer(
+            {"DepartmentParent": {"DepartmentUUIDIdentifier": new_parent["uuid"]}}
+        )
+
+
+class ConcurrentReadTests(TestCase):
+    latency = 0.05
+
+    def slow_mox(self, **overrides):
+        mox = TestableSDMox(overrides={**check_overrides, **overrides})
+        mox.sd_connector = SlowSDConnector(self.latency)
+        mox.sd_levels = OrderedDict(
+            [("NY1-niveau", "uuid-c"), ("Afdelings-niveau", "uuid-b")]
+        )
+        return mox
+
+    @async_to_sync
+    async def test_check_department_reads_concurrently(self):
+        mox = self.slow_mox()
+        started = time.monotonic()
+        department, errors = await mox._check_department(
+            at, unit_uuid=moved_unit["uuid"], parent={"uuid": new_parent["uuid"]}
+        )
+        elapsed = time.monotonic() - started
+
+        self.assertEqual(errors, [])
+        self.assertEqual(mox.sd_connector.max_in_flight, 2)
+        self.assertLess(elapsed, 1.5 * self.latency)
+
+    @async_to_sync
+    async def test_create_unit_reads_concurrently(self):
+        mox = self.slow_mox()
+        parent = {
+            "unit_code": "CD34",
+            "uuid": new_parent["uuid"],
+            "level": "NY1-niveau",
+        }
+        await mox._create_unit(
+            at, "name", "NEW", parent, "Afdelings-niveau", moved_unit["uuid"]
+        )
+        self.assertEqual(mox.sd_connector.max_in_flight, 2)
+
+    @async_to_sync
+    async def test_concurrency_is_bounded(self):
+        mox = self.slow_mox(sd_max_concurrency=1)
+        await mox._check_department(
+            at, unit_uuid=moved_unit["uuid"], parent={"uuid": new_parent["uuid"]}
+        )
+        self.assertEqual(mox.sd_connector.max_in_flight, 1)
+
+
+class DepartmentCacheTests(TestCase):
+    def setUp(self):
+        self.mox = TestableSDMox(overrides=check_overrides)
+        self.mox.sd_connector = SlowSDConnector(0.01)
+        self.mox.publisher = RecordingPublisher()
+
+    @async_to_sync
+    async def test_concurrent_lookups_are_collapsed(self):
+        parents = await asyncio.gather(
+            *(
+                self.mox._lookup_department(
+                    at, unit_code="CD34", unit_level="NY1-niveau"
+                )
+                for _ in range(10)
+            )
+        )
+        self.assertEqual(len({id(parent) for parent in parents}), 1)
+        self.assertEqual(self.mox.sd_connector.calls, 1)
+
+    @async_to_sync
+    async def test_unknown_unit_codes_are_cached(self):
+        self.assertEqual(await self.mox._validate_unit_code("NEW", at), [])
+        self.assertEqual(await self.mox._validate_unit_code("NEW", at), [])
+        self.assertEqual(self.mox.sd_connector.calls, 1)
+
+    @async_to_sync
+    async def test_publish_invalidates_unit(self):
+        await self.mox._validate_unit_code("NEW", at)
+        await self.mox._lookup_department(at, unit_code="CD34")
+        await self.mox._call("<xml/>", unit_uuid=moved_unit["uuid"], unit_code="NEW")
+
+        await self.mox._validate_unit_code("NEW", at)
+        await self.mox._lookup_department(at, unit_code="CD34")
+        self.assertEqual(self.mox.sd_connector.calls, 3)
+
+    @async_to_sync
+    async def test_verification_bypasses_cache(self):
+        await self.mox._lookup_department(at, unit_uuid=moved_unit["uuid"])
+        await self.mox._check_department(at, unit_uuid=moved_unit["uuid"])
+        await self.mox._check_department(at, unit_uuid=moved_unit["uuid"])
+        self.assertEqual(self.mox.sd_connector.calls, 3)
+
+
+dar_addresses = {
+    "0a3f507b-6331-32b8-e044-0003ba298018": DARRecord(
+        "Banegårdspladsen 1, 2750 Ballerup", "Banegårdspladsen 1", "2750", "Ballerup"
+    ),
+    "0a3f507b-7750-32b8-e044-0003ba298018": DARRecord(
+        "Toftebjerghaven 4, 2750 Ballerup", "Toftebjerghaven 4", "2750", "Ballerup"
+    ),
+}
+
+
+class StandInDARResolver(BaseDARResolver):
+    def __init__(self, addresses):
+        self.addresses = addresses
+        self.resolved = []
+
+    async def resolve(self, address_id):
+        self.resolved.append(address_id)
+        return self.addresses.get(address_id)
+
+
+def mo_address(scope, value, user_key=None):
+    return {"address_type": {"scope": scope, "user_key": user_key}, "value": value}
+
+
+class UnitProjectionTests(TestCase):
+    def setUp(self):
+        self.mox = StandInSDMox(
+            overrides=check_overrides, units={moved_unit["uuid"]: moved_unit}
+        )
+        self.mox.dar_resolver = StandInDARResolver(dar_addresses)
+        self.dar_id, record = next(iter(dar_addresses.items()))
+        self.mox.applied = {
+            "PostalAddress": {
+                "StandardAddressIdentifier": record.street,
+                "PostalCode": record.zip_code,
+                "DistrictName": record.city,
+            },
+            "ContactInformation": {"TelephoneNumberIdentifier": ["12345678"]},
+        }
+        # Projections as written to SD
+        self.written = []
+        payload_from_projection = self.mox._payload_from_projection
+
+        def record(projection):
+            self.written.append(projection)
+            return payload_from_projection(projection)
+
+        self.mox._payload_from_projection = record
+
+    @async_to_sync
+    async def test_address_triggers_read_mo_again(self):
+        unit_uuid = moved_unit["uuid"]
+        await self.mox.create_address(unit_uuid, mo_address("DAR", self.dar_id), at)
+        await self.mox.edit_address(unit_uuid, mo_address("PHONE", "12345678"), at)
+
+        # The unit and its addresses are read on both triggers
+        self.assertEqual(self.mox.mo.reads, 4)
+        # MO has yet to store the DAR address, which is still written to SD
+        projection = self.written[-1]
+        self.assertEqual(projection.phone, "12345678")
+        self.assertEqual(projection.adresse, dar_addresses[self.dar_id])
+
+    @async_to_sync
+    async def test_changes_in_mo_are_written(self):
+        unit_uuid = moved_unit["uuid"]
+        dar = mo_address("DAR", self.dar_id)
+        await self.mox.create_address(unit_uuid, dar, at)
+
+        # MO stores the address, later ends it and changes the unit code
+        self.mox.mo.addresses[unit_uuid] = [dar]
+        await self.mox.create_address(unit_uuid, mo_address("PHONE", "12345678"), at)
+        self.mox.mo.addresses[unit_uuid] = []
+        self.mox.mo.units = {unit_uuid: {**moved_unit, "user_key": "AB13"}}
+        await self.mox.edit_address(unit_uuid, mo_address("PHONE", "12345678"), at)
+
+        projection = self.written[-1]
+        self.assertEqual(projection.unit_code, "AB13")
+        self.assertIsNone(projection.dar_id)
+
+    @async_to_sync
+    async def test_concurrent_address_triggers_keep_each_other(self):
+        unit_uuid = moved_unit["uuid"]
+        await asyncio.gather(
+            self.mox.create_address(unit_uuid, mo_address("DAR", self.dar_id), at),
+            self.mox.create_address(unit_uuid, mo_address("PHONE", "12345678"), at),
+        )
+
+        projection = self.written[-1]
+        self.assertEqual(projection.phone, "12345678")
+        self.assertEqual(projection.adresse, dar_addresses[self.dar_id])
+
+
 @freeze_time("2020-01-01 12:00:00")
 class Tests(TestCase):
     def setUp(self):
-        from_date = datetime.datetime(2019, 7, 1, 0, 0)
-        self.mox = TestableSDMox(from_date, overrides=mox_overrides)
+        self.at = datetime.date(2019, 7, 1)
+        self.mox = TestableSDMox(overrides=mox_overrides)
+        self.mox.dar_resolver = StandInDARResolver(dar_addresses)
 
         from collections import OrderedDict
 
@@ -95,11 +576,12 @@ class Tests(TestCase):
         ]
         scoped, keyed = self.mox._grouped_addresses(addresses)
 
+        # DAR addresses are only resolved when used, see _payload_edit
         self.assertEqual(
             {
                 "DAR": [
-                    "Banegårdspladsen 1, 2750 Ballerup",
-                    "Toftebjerghaven 4, 2750 Ballerup",
+                    "0a3f507b-6331-32b8-e044-0003ba298018",
+                    "0a3f507b-7750-32b8-e044-0003ba298018",
                 ],
                 "PHONE": ["12345678"],
                 "PNUMBER": ["0123456789"],
@@ -147,6 +629,7 @@ class Tests(TestCase):
 
         expected = xmlparse(xml_create)
         actual = self.mox._create_xml_import(
+            self.at,
             unit_name=pc["unit_name"],
             unit_uuid=pc["unit_uuid"],
             unit_code=pc["unit_code"],
@@ -155,8 +638,9 @@ class Tests(TestCase):
         )
         self.assertEqual(expected, xmlparse(actual))
 
-    def test_payload_edit_simple(self):
-        pe = self.mox._payload_edit(
+    @async_to_sync
+    async def test_payload_edit_simple(self):
+        pe = await self.mox._payload_edit(
             unit_uuid="12345-22-22-22-12345",
             unit={
                 "name": "A-sdm2",
@@ -183,11 +667,12 @@ class Tests(TestCase):
         )
 
         expected = xmlparse(xml_edit_simple)
-        actual = self.mox._create_xml_ret(**pe)
+        actual = self.mox._create_xml_ret(self.at, **pe)
         self.assertEqual(expected, xmlparse(actual))
 
-    def test_payload_edit_address(self):
-        pe = self.mox._payload_edit(
+    @async_to_sync
+    async def test_payload_edit_address(self):
+        pe = await self.mox._payload_edit(
             unit_uuid="12345-22-22-22-12345",
             unit={
                 "name": "A-sdm2",
@@ -240,11 +725,28 @@ class Tests(TestCase):
         )
 
         expected = xmlparse(xml_edit_address)
-        actual = self.mox._create_xml_ret(**pe)
+        actual = self.mox._create_xml_ret(self.at, **pe)
         self.assertEqual(expected, xmlparse(actual))
 
-    def test_payload_edit_integration_values(self):
-        pe = self.mox._payload_edit(
+    @async_to_sync
+    async def test_payload_edit_resolves_used_address_only(self):
+        addresses = [
+            {
+                "address_type": {"scope": "DAR", "user_key": key},
+                "value": address_id,
+            }
+            for key, address_id in zip(["dar-key-1", "dar-key-2"], dar_addresses)
+        ]
+        await self.mox._payload_edit(
+            unit_uuid="12345-22-22-22-12345",
+            unit={"name": "A-sdm2", "user_key": "user-key-22222"},
+            addresses=addresses,
+        )
+        self.assertEqual(self.mox.dar_resolver.resolved, [addresses[0]["value"]])
+
+    @async_to_sync
+    async def test_payload_edit_integration_values(self):
+        pe = await self.mox._payload_edit(
             unit_uuid="12345-33-33-33-12345",
             unit={
                 "name": "A-sdm3",
@@ -281,7 +783,7 @@ class Tests(TestCase):
         )
 
         expected = xmlparse(xml_edit_integration_values)
-        actual = self.mox._create_xml_ret(**pe)
+        actual = self.mox._create_xml_ret(self.at, **pe)
         self.assertEqual(expected, xmlparse(actual))
 
     def test_payload_move_orgunit(self):
@@ -314,6 +816,7 @@ class Tests(TestCase):
 
         expected = xmlparse(xml_move)
         actual = self.mox._create_xml_flyt(
+            self.at,
             unit_name=pc["unit_name"],
             unit_uuid=pc["unit_uuid"],
             unit_code=pc["unit_code"],
@@ -321,3 +824,18 @@ class Tests(TestCase):
             parent_unit_uuid=pc["parent"]["uuid"],
         )
         self.assertEqual(expected, xmlparse(actual))
+
+    @async_to_sync
+    async def test_effective_date_per_call(self):
+        pe = await self.mox._payload_edit(
+            unit_uuid="12345-22-22-22-12345",
+            unit={"name": "A-sdm2", "user_key": "user-key-22222"},
+            addresses=[],
+        )
+        july = xmlparse(self.mox._create_xml_ret(self.at, **pe))
+        august = xmlparse(self.mox._create_xml_ret(datetime.date(2019, 8, 1), **pe))
+        self.assertEqual(july, xmlparse(xml_edit_simple))
+        self.assertNotEqual(july, august)
+
+        with self.assertRaises(SDMoxError):
+            self.mox._create_xml_ret(datetime.date(2019, 8, 2), **pe)
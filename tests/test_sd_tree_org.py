@@ -0,0 +1,389 @@
+# SPDX-FileCopyrightText: Magenta ApS
+#
+# SPDX-License-Identifier: MPL-2.0
+
+import asyncio
+import json
+import os
+import tempfile
+from array import array
+from unittest import TestCase
+from unittest.mock import AsyncMock, patch
+from uuid import uuid4
+
+from fastapi.testclient import TestClient
+
+from app.config import get_settings
+from app.main import app
+from app.sd_tree_org import (
+    NO_PARENT,
+    Organisation,
+    OrganisationSnapshot,
+    _chunks,
+    get_organisation_snapshot,
+    nest_tree_nodes,
+    read_organisation_snapshot,
+    read_snapshot_file,
+    sd_tree_org,
+    tree_nodes,
+    warm_organisation_snapshot,
+    write_snapshot_file,
+)
+from app.util import async_to_sync
+from tests.test_sd_mox import mox_overrides
+
+
+def department(uuid, parent=None, level="NY1-niveau"):
+    reference = {
+        "DepartmentUUIDIdentifier": uuid,
+        "DepartmentIdentifier": uuid.upper(),
+        "DepartmentLevelIdentifier": level,
+    }
+    if parent is not None:
+        reference["DepartmentReference"] = parent
+    return reference
+
+
+top = department("top", level="NY3-niveau")
+a = department("a", top, level="NY2-niveau")
+b = department("b", top)
+a1 = department("a1", a)
+a2 = department("a2", a)
+other = department("other")
+
+
+class StandInSDConnector:
+    def __init__(self, settings=None):
+        self.calls = 0
+
+    async def getDepartment(self):
+        self.calls += 1
+        await asyncio.sleep(0.01)
+        return {
+            "Department": [
+                {
+                    **reference,
+                    "DepartmentName": "Name " + reference["DepartmentIdentifier"],
+                }
+                for reference in [top, a, b, a1, a2, other]
+            ]
+        }
+
+    async def getOrganization(self):
+        # Leaves with their nested parents, as SD returns them
+        return {"Organization": {"DepartmentReference": [a2, a1, b, other]}}
+
+
+class SDTreeOrgTests(TestCase):
+    @async_to_sync
+    async def test_tree(self):
+        snapshot = await read_organisation_snapshot(StandInSDConnector())
+        tree = "".join(sd_tree_org(snapshot))
+        self.assertEqual(
+            tree,
+            "Name OTHER (OTHER, other)\n"
+            "\n"
+            "Name TOP (TOP, top)\n"
+            "├── Name A (A, a)\n"
+            "│   ├── Name A1 (A1, a1)\n"
+            "│   └── Name A2 (A2, a2)\n"
+            "└── Name B (B, b)\n"
+            "\n",
+        )
+
+    @async_to_sync
+    async def test_subtree(self):
+        snapshot = await read_organisation_snapshot(StandInSDConnector())
+        tree = "".join(sd_tree_org(snapshot, "a"))
+        self.assertEqual(
+            tree,
+            "Name A (A, a)\n├── Name A1 (A1, a1)\n└── Name A2 (A2, a2)\n\n",
+        )
+
+    @async_to_sync
+    async def test_max_depth(self):
+        snapshot = await read_organisation_snapshot(StandInSDConnector())
+        tree = "".join(sd_tree_org(snapshot, ["top"], max_depth=1))
+        self.assertEqual(
+            tree, "Name TOP (TOP, top)\n├── Name A (A, a)\n└── Name B (B, b)\n\n"
+        )
+        tree = "".join(sd_tree_org(snapshot, ["a", "b"], max_depth=0))
+        self.assertEqual(tree, "Name A (A, a)\n\nName B (B, b)\n\n")
+
+    def test_chunks(self):
+        lines = ["line\n"] * 10
+        chunks = list(_chunks(lines, size=20))
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual("".join(chunks), "".join(lines))
+
+
+class OrganisationTests(TestCase):
+    def test_organisation(self):
+        departments = [
+            {**reference, "DepartmentName": reference["DepartmentIdentifier"]}
+            for reference in [a1, a, top]
+        ]
+        organisation = Organisation.from_sd(departments, [a2, a1, b, other])
+        self.assertEqual(len(organisation), 6)
+
+        def uuids(positions):
+            return [organisation.departments[position].uuid for position in positions]
+
+        self.assertEqual(uuids(organisation.roots), ["other", "top"])
+        self.assertEqual(
+            uuids(organisation.children(organisation.positions["a"])), ["a1", "a2"]
+        )
+        self.assertEqual(organisation.children(organisation.positions["b"]), array("l"))
+        self.assertEqual(organisation.parents[organisation.positions["top"]], NO_PARENT)
+        self.assertEqual(
+            organisation.parents[organisation.positions["a2"]],
+            organisation.positions["a"],
+        )
+
+        # Departments only in the organisation have no name
+        a2_department = organisation.departments[organisation.positions["a2"]]
+        self.assertEqual(a2_department.name, "")
+        self.assertIs(
+            a2_department.level,
+            organisation.departments[organisation.positions["a1"]].level,
+        )
+
+
+class TreeNodesTests(TestCase):
+    def setUp(self):
+        self.snapshot = async_to_sync(read_organisation_snapshot)(StandInSDConnector())
+
+    def uuids(self, nodes):
+        return [(node["uuid"], node["depth"]) for node in nodes]
+
+    def test_nodes(self):
+        nodes = list(tree_nodes(self.snapshot))
+        self.assertEqual(
+            self.uuids(nodes),
+            [("other", 0), ("top", 0), ("a", 1), ("a1", 2), ("a2", 2), ("b", 1)],
+        )
+        self.assertEqual(
+            nodes[2],
+            {
+                "uuid": "a",
+                "identifier": "A",
+                "name": "Name A",
+                "level": "NY2-niveau",
+                "parent": "top",
+                "depth": 1,
+            },
+        )
+
+    def test_filters(self):
+        nodes = tree_nodes(self.snapshot, ["a", "b"], max_depth=0)
+        self.assertEqual(self.uuids(nodes), [("a", 0), ("b", 0)])
+        nodes = tree_nodes(self.snapshot, ["top"], max_depth=1, levels={"NY1-niveau"})
+        self.assertEqual(self.uuids(nodes), [("b", 1)])
+
+    def test_level_filter(self):
+        levels = ["NY1-niveau", "NY2-niveau", "NY3-niveau"]
+        for roots in [None, ["top"], ["a", "other"], ["a1", "top"]]:
+            for max_depth in [None, 0, 1, 2]:
+                for count in range(1, len(levels) + 1):
+                    chosen = set(levels[:count])
+                    walked = [
+                        node
+                        for node in tree_nodes(self.snapshot, roots, max_depth)
+                        if node["level"] in chosen
+                    ]
+                    nodes = tree_nodes(self.snapshot, roots, max_depth, chosen)
+                    self.assertEqual(list(nodes), walked)
+
+    def test_level_filter_visits_only_matches(self):
+        # Builds the index of levels
+        list(tree_nodes(self.snapshot, levels={"NY1-niveau"}))
+
+        node = Organisation.node
+        with patch.object(
+            Organisation, "children", side_effect=AssertionError("walked the tree")
+        ), patch.object(
+            Organisation, "node", autospec=True, side_effect=node
+        ) as visited:
+            nodes = list(tree_nodes(self.snapshot, ["top"], levels={"NY1-niveau"}))
+        self.assertEqual(self.uuids(nodes), [("a1", 2), ("a2", 2), ("b", 1)])
+        self.assertEqual(visited.call_count, 3)
+
+    def test_nest(self):
+        nested = nest_tree_nodes(self.snapshot, tree_nodes(self.snapshot, ["top"]))
+        self.assertEqual(
+            [[child["uuid"] for child in node["children"]] for node in nested],
+            [["a", "b"]],
+        )
+        self.assertEqual(
+            [child["uuid"] for child in nested[0]["children"][0]["children"]],
+            ["a1", "a2"],
+        )
+
+        # Units left out leave their children to the nearest unit shown
+        nodes = tree_nodes(self.snapshot, levels={"NY3-niveau", "NY1-niveau"})
+        nested = nest_tree_nodes(self.snapshot, nodes)
+        self.assertEqual([node["uuid"] for node in nested], ["other", "top"])
+        self.assertEqual(
+            [child["uuid"] for child in nested[1]["children"]], ["a1", "a2", "b"]
+        )
+
+    def test_nest_under_kept_ancestor(self):
+        # r > x1 and r > y > x2, where x2 is not below x1
+        r = department("r", level="NY3-niveau")
+        y = department("y", r, level="NY2-niveau")
+        x1 = department("x1", r)
+        x2 = department("x2", y)
+        snapshot = OrganisationSnapshot(Organisation.from_sd([], [x1, x2]))
+
+        nodes = tree_nodes(snapshot, ["r"], levels={"NY1-niveau"})
+        nested = nest_tree_nodes(snapshot, nodes)
+        self.assertEqual([node["uuid"] for node in nested], ["x1", "x2"])
+        self.assertEqual([node["children"] for node in nested], [[], []])
+
+
+class OrganisationSnapshotTests(TestCase):
+    @async_to_sync
+    async def test_snapshot_is_shared(self):
+        sd_connector = StandInSDConnector()
+        settings = get_settings(**mox_overrides)
+        with patch("app.sd_tree_org._snapshots", {}), patch(
+            "app.sd_tree_org.create_sd_connector", lambda settings: sd_connector
+        ):
+            snapshots = await asyncio.gather(
+                *(get_organisation_snapshot(settings) for _ in range(10))
+            )
+            snapshots.append(await get_organisation_snapshot(settings))
+        self.assertEqual(len({id(snapshot) for snapshot in snapshots}), 1)
+        self.assertEqual(sd_connector.calls, 1)
+
+    @async_to_sync
+    async def test_etag_follows_content(self):
+        first = await read_organisation_snapshot(StandInSDConnector())
+        second = await read_organisation_snapshot(StandInSDConnector())
+        self.assertEqual(first.etag, second.etag)
+        departments = (await StandInSDConnector().getDepartment())["Department"]
+        departments[0]["DepartmentName"] = "Renamed"
+        renamed = OrganisationSnapshot(
+            Organisation.from_sd(departments, [a2, a1, b, other])
+        )
+        self.assertNotEqual(renamed.etag, first.etag)
+
+
+class SnapshotFileTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "sd.snapshot")
+        self.snapshot = async_to_sync(read_organisation_snapshot)(StandInSDConnector())
+
+    def test_round_trip(self):
+        write_snapshot_file(self.snapshot, "sd kommune", self.path)
+        loaded = read_snapshot_file(self.path, "sd kommune")
+        self.assertEqual(loaded.etag, self.snapshot.etag)
+        self.assertEqual(
+            "".join(sd_tree_org(loaded)), "".join(sd_tree_org(self.snapshot))
+        )
+        self.assertEqual(
+            list(tree_nodes(loaded, ["a"])), list(tree_nodes(self.snapshot, ["a"]))
+        )
+        self.assertLess(loaded.age(), 5)
+
+    def test_empty(self):
+        empty = OrganisationSnapshot(Organisation.from_sd([], []))
+        write_snapshot_file(empty, "sd kommune", self.path)
+        self.assertEqual(
+            len(read_snapshot_file(self.path, "sd kommune").organisation), 0
+        )
+
+    def test_invalid(self):
+        write_snapshot_file(self.snapshot, "sd kommune", self.path)
+        with self.assertRaises(ValueError):
+            read_snapshot_file(self.path, "sd other")
+
+        with open(self.path, "rb") as snapshot_file:
+            content = snapshot_file.read()
+        with open(self.path, "wb") as snapshot_file:
+            snapshot_file.write(content[:-1])
+        with self.assertRaises(ValueError):
+            read_snapshot_file(self.path, "sd kommune")
+
+        with open(self.path, "wb") as snapshot_file:
+            snapshot_file.write(b"not a snapshot")
+        with self.assertRaises(ValueError):
+            read_snapshot_file(self.path, "sd kommune")
+
+    @async_to_sync
+    async def test_warm_start(self):
+        sd_connector = StandInSDConnector()
+        settings = get_settings(**mox_overrides, sd_snapshot_path=self.path)
+        source = f"{settings.sd_base_url} {settings.sd_institution}"
+        write_snapshot_file(self.snapshot, source, self.path)
+
+        with patch("app.sd_tree_org._snapshots", {}) as caches, patch(
+            "app.sd_tree_org.create_sd_connector", lambda settings: sd_connector
+        ):
+            # A fresh snapshot file is served without asking SD
+            warm_organisation_snapshot(settings)
+            snapshot = await get_organisation_snapshot(settings)
+            await asyncio.sleep(0.05)
+            self.assertEqual(snapshot.etag, self.snapshot.etag)
+            self.assertEqual(sd_connector.calls, 0)
+
+            # An old one is served too, while it is refreshed from SD
+            caches.clear()
+            old = OrganisationSnapshot(self.snapshot.organisation, age=1000)
+            write_snapshot_file(old, source, self.path)
+            warm_organisation_snapshot(settings)
+            snapshot = await get_organisation_snapshot(settings)
+            self.assertGreaterEqual(snapshot.age(), 999)
+            await asyncio.sleep(0.05)
+            refreshed = await get_organisation_snapshot(settings)
+        self.assertEqual(sd_connector.calls, 1)
+        self.assertLess(refreshed.age(), 5)
+        self.assertLess(read_snapshot_file(self.path, source).age(), 5)
+
+
+class SnapshotEndpointTests(TestCase):
+    def setUp(self):
+        snapshot = async_to_sync(read_organisation_snapshot)(StandInSDConnector())
+        for target, value in [
+            ("app.main.get_settings", lambda: None),
+            ("app.main.get_organisation_snapshot", AsyncMock(return_value=snapshot)),
+        ]:
+            patcher = patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.client = TestClient(app)
+
+    def test_not_modified(self):
+        for url in ["/tree", "/duplicates"]:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers["Age"], "0")
+
+            etag = response.headers["ETag"]
+            response = self.client.get(url, headers={"If-None-Match": etag})
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.headers["ETag"], etag)
+
+            response = self.client.get(url, headers={"If-None-Match": '"other"'})
+            self.assertEqual(response.status_code, 200)
+
+    def test_formats(self):
+        response = self.client.get("/tree", params={"format": "ndjson", "max_depth": 1})
+        self.assertEqual(response.headers["Content-Type"], "application/x-ndjson")
+        lines = [json.loads(line) for line in response.text.splitlines()]
+        self.assertEqual([line["uuid"] for line in lines], ["other", "top", "a", "b"])
+
+        response = self.client.get(
+            "/tree", params={"format": "json", "level": ["NY2-niveau", "NY3-niveau"]}
+        )
+        [node] = response.json()
+        self.assertEqual(node["uuid"], "top")
+        self.assertEqual([child["uuid"] for child in node["children"]], ["a"])
+
+    def test_errors(self):
+        response = self.client.get("/tree", params={"root_uuid": str(uuid4())})
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get("/tree", params={"level": "NY1-niveau"})
+        self.assertEqual(response.status_code, 400)
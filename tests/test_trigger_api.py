@@ -0,0 +1,258 @@
+# SPDX-FileCopyrightText: Magenta ApS
+#
+# SPDX-License-Identifier: MPL-2.0
+
+from datetime import date, timedelta
+from unittest import TestCase
+from unittest.mock import patch
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app.config import get_settings
+from app.mo import AsyncMoraHelper
+from app.routers import trigger_api
+from app.util import get_mora_helper_default
+from tests.test_sd_mox import StandInSDMox, check_overrides
+
+# Scope is only known from today on, and SD changes start on the 1st
+first_of_next_month = (date.today().replace(day=1) + timedelta(days=32)).replace(day=1)
+next_month = first_of_next_month.isoformat()
+
+root_uuid = "e3e38b32-61c0-4900-a200-000001510002"
+root = {"uuid": root_uuid, "parent": None}
+unit = {
+    "name": "old name",
+    "uuid": "25abf6f4-fa38-5bd8-b217-7130ce3552cd",
+    "org_unit_level": {"uuid": "uuid-b"},
+    "user_key": "AB12",
+    "parent": root,
+}
+new_parent = {
+    "name": "new parent",
+    "uuid": "dad7d0ad-c7a9-4a94-969d-464337e31fec",
+    "org_unit_level": {"uuid": "uuid-c"},
+    "user_key": "CD34",
+    "parent": root,
+}
+outside = {
+    "name": "outside",
+    "uuid": "5f1d1c3e-2c43-4a47-8a2f-07bbf0d9e4a1",
+    "org_unit_level": {"uuid": "uuid-b"},
+    "user_key": "GH78",
+    "parent": None,
+}
+new_unit = {
+    "name": "new unit",
+    "uuid": "389edd41-eb7f-468e-a02e-de4312f28bb3",
+    "org_unit_level": {"uuid": "uuid-b"},
+    "user_key": "EF56",
+    "parent": new_parent,
+}
+
+
+class CountingMoraHelper(AsyncMoraHelper):
+    """AsyncMoraHelper answering from units, recording every request to MO."""
+
+    def __init__(self, units):
+        super().__init__("http://mo.invalid")
+        self.units = units
+        self.requests = []
+
+    async def _request(self, full_url, params, timeout):
+        path = full_url[len(self.host) :]
+        self.requests.append(path)
+        if path == "o/":
+            return [{"uuid": "root-organisation"}]
+        if path.endswith("/details/address"):
+            return []
+        return dict(self.units[path.split("/")[1]])
+
+
+class TriggerSDMox(StandInSDMox):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.parents = {}
+
+    async def _read_parent(self, at, unit_uuid=None):
+        return {"DepartmentUUIDIdentifier": self.parents.get(unit_uuid)}
+
+
+def trigger(role_type, request_type, uuid, request):
+    return {
+        "event_type": "ON_BEFORE",
+        "request": request,
+        "request_type": request_type,
+        "role_type": role_type,
+        "uuid": uuid,
+    }
+
+
+class MOReadTests(TestCase):
+    """Every trigger reads each object from MO at most once."""
+
+    def setUp(self):
+        units = {u["uuid"]: u for u in [unit, new_parent, new_unit, outside]}
+        self.mox = TriggerSDMox(overrides=check_overrides, units=units)
+        self.mo = self.mox.mo = CountingMoraHelper(units)
+
+        settings = get_settings(**{**check_overrides, "triggered_uuids": [root_uuid]})
+        for target, value in [
+            ("app.config._settings", settings),
+            ("app.scope._indexes", {}),
+            ("app.routers.trigger_api.get_sdmox", lambda: self.mox),
+            ("app.dependencies.get_sdmox", lambda: self.mox),
+        ]:
+            patcher = patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        app = FastAPI()
+        app.include_router(trigger_api.router, prefix="/triggers")
+        app.dependency_overrides[get_mora_helper_default] = lambda: self.mo
+        self.client = TestClient(app)
+
+    def post(self, url, payload):
+        response = self.client.post(url, json=payload)
+        self.assertEqual(response.status_code, 200, response.text)
+
+    def test_address_create(self):
+        self.mox.applied = {
+            "ContactInformation": {"TelephoneNumberIdentifier": ["12345678"]}
+        }
+        request = {
+            "org_unit": {"uuid": unit["uuid"]},
+            "validity": {"from": "2019-07-01", "to": None},
+            "address_type": {"scope": "PHONE", "user_key": "PhoneUnit"},
+            "value": "12345678",
+        }
+        self.post(
+            "/triggers/address/CREATE",
+            trigger(
+                "address", "CREATE", "0b6a2e13-3c4b-4d07-9f3e-4a1e8c6f2b10", request
+            ),
+        )
+        self.assertEqual(
+            sorted(self.mo.requests),
+            [f"ou/{unit['uuid']}/", f"ou/{unit['uuid']}/details/address"],
+        )
+
+    def test_known_scope_is_not_read(self):
+        self.mox.applied = {
+            "ContactInformation": {"TelephoneNumberIdentifier": ["12345678"]}
+        }
+        request = {
+            "org_unit": {"uuid": unit["uuid"]},
+            "validity": {"from": next_month, "to": None},
+            "address_type": {"scope": "PHONE", "user_key": "PhoneUnit"},
+            "value": "12345678",
+        }
+        payload = trigger(
+            "address", "CREATE", "0b6a2e13-3c4b-4d07-9f3e-4a1e8c6f2b10", request
+        )
+        self.post("/triggers/address/CREATE", payload)
+        self.mo.requests.clear()
+
+        # Scope is known, only the unit and its addresses are read again. They
+        # are not cached, as MO offers nothing to tell a stale copy by
+        self.post("/triggers/address/CREATE", payload)
+        self.assertEqual(
+            sorted(self.mo.requests),
+            [f"ou/{unit['uuid']}/", f"ou/{unit['uuid']}/details/address"],
+        )
+
+    def test_out_of_scope_is_read_once(self):
+        request = {
+            "org_unit": {"uuid": outside["uuid"]},
+            "validity": {"from": next_month, "to": None},
+            "address_type": {"scope": "PHONE", "user_key": "PhoneUnit"},
+            "value": "12345678",
+        }
+        payload = trigger(
+            "address", "CREATE", "0b6a2e13-3c4b-4d07-9f3e-4a1e8c6f2b10", request
+        )
+        for _ in range(3):
+            response = self.client.post("/triggers/address/CREATE", json=payload)
+            self.assertIn("outside the configured allow list", response.text)
+        self.assertEqual(self.mo.requests, [f"ou/{outside['uuid']}/"])
+
+    def test_scope_in_the_past_is_read(self):
+        request = {
+            "org_unit": {"uuid": outside["uuid"]},
+            "validity": {"from": "2019-07-01", "to": None},
+            "address_type": {"scope": "PHONE", "user_key": "PhoneUnit"},
+            "value": "12345678",
+        }
+        payload = trigger(
+            "address", "CREATE", "0b6a2e13-3c4b-4d07-9f3e-4a1e8c6f2b10", request
+        )
+        for _ in range(2):
+            response = self.client.post("/triggers/address/CREATE", json=payload)
+            self.assertIn("outside the configured allow list", response.text)
+        # The scope known today need not hold in 2019
+        self.assertEqual(self.mo.requests, [f"ou/{outside['uuid']}/"] * 2)
+
+    def test_employee_addresses_are_not_validated(self):
+        # MO sends the whole trigger, only the fields looked at are given here
+        request = {"person": {"uuid": unit["uuid"]}, "org_unit": None}
+        for url in ["/triggers/address/CREATE", "/triggers/address/EDIT"]:
+            response = self.client.post(url, json={"request": request})
+            self.assertEqual(response.json(), {"status": "NOOP"})
+        self.assertEqual(self.mo.requests, [])
+
+    def test_ou_rename(self):
+        self.mox.applied = {"DepartmentName": "new name"}
+        request = {
+            "type": "org_unit",
+            "data": {
+                "name": "new name",
+                "uuid": unit["uuid"],
+                "validity": {"from": "2019-07-01"},
+            },
+        }
+        self.post(
+            "/triggers/org_unit/EDIT",
+            trigger("org_unit", "EDIT", unit["uuid"], request),
+        )
+        self.assertEqual(
+            sorted(self.mo.requests),
+            [f"ou/{unit['uuid']}/", f"ou/{unit['uuid']}/details/address"],
+        )
+
+    def test_ou_move(self):
+        self.mox.parents[unit["uuid"]] = new_parent["uuid"]
+        request = {
+            "type": "org_unit",
+            "data": {
+                "parent": {"uuid": new_parent["uuid"]},
+                "uuid": unit["uuid"],
+                "validity": {"from": "2019-07-01"},
+            },
+        }
+        self.post(
+            "/triggers/org_unit/EDIT",
+            trigger("org_unit", "EDIT", unit["uuid"], request),
+        )
+        self.assertEqual(
+            sorted(self.mo.requests),
+            sorted([f"ou/{unit['uuid']}/", f"ou/{new_parent['uuid']}/"]),
+        )
+
+    def test_ou_create(self):
+        self.mox.parents[new_unit["uuid"]] = new_parent["uuid"]
+        request = {
+            "validity": {"from": "2019-07-01", "to": None},
+            "name": new_unit["name"],
+            "user_key": new_unit["user_key"],
+            "parent": {"uuid": new_parent["uuid"]},
+            "org_unit_level": new_unit["org_unit_level"],
+            "details": [],
+        }
+        payload = trigger("org_unit", "CREATE", new_unit["uuid"], request)
+        self.post("/triggers/org_unit/CREATE", payload)
+        self.assertEqual(sorted(self.mo.requests), ["o/", f"ou/{new_parent['uuid']}/"])
+
+        # The root organisation is only read on the first request
+        self.mo.requests.clear()
+        self.post("/triggers/org_unit/CREATE", payload)
+        self.assertEqual(self.mo.requests, [f"ou/{new_parent['uuid']}/"])